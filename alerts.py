@@ -0,0 +1,143 @@
+from datetime import datetime, timedelta
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from models import db, User, Medicine, StockBalance, AlertRule, StockAlert
+from notifications import mailer
+
+# Low stock and expiry alert rules, evaluated as stock changes.
+#
+# refresh_stock_balances() queues every medicine whose balance figures
+# changed; just before the transaction commits, only those medicines are
+# checked against their AlertRule (or the ALERT_* defaults) in one query, so
+# alerts are written and their email queued atomically with the stock change.
+# An alert opens once per crossing: at most one StockAlert per medicine and
+# kind is open at a time. Low stock opens when available units drop to the
+# reorder level and only clears once they reach the restock level (reorder
+# level plus ALERT_RESTOCK_MARGIN unless set), so stock hovering around the
+# threshold does not alert on every dispense. Expiry opens when a stocked,
+# non-expired batch expires within the window and clears when no such batch
+# is left. Expiry windows also move with the calendar, so sweep() checks every
+# medicine once a day to catch batches entering the window without a write.
+
+LOW_STOCK = 'low_stock'
+EXPIRING = 'expiring'
+
+
+def queue_evaluation(medicine_ids):
+    """Check the alert rules of these medicines when the current transaction commits"""
+    db.session.info.setdefault('alert_medicines', set()).update(
+        int(medicine_id) for medicine_id in medicine_ids if medicine_id is not None
+    )
+
+
+@event.listens_for(Session, 'before_commit')
+def _evaluate_queued(session):
+    medicine_ids = session.info.pop('alert_medicines', None)
+    if medicine_ids and alert_rules.app is not None:
+        alert_rules.evaluate(medicine_ids, session)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_queued(session):
+    session.info.pop('alert_medicines', None)
+
+
+class AlertRules:
+    def __init__(self, app=None):
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ALERT_REORDER_LEVEL', 10)
+        app.config.setdefault('ALERT_RESTOCK_MARGIN', 5)
+        app.config.setdefault('ALERT_EXPIRY_DAYS', 30)
+        app.config.setdefault('ALERT_NOTIFY_ROLES', ('manager',))
+        self.app = app
+        app.extensions['alert_rules'] = self
+
+    def thresholds(self, rule):
+        """(reorder level, restock level, expiry days) of a rule, None for the defaults"""
+        config = self.app.config
+        reorder = config['ALERT_REORDER_LEVEL'] if rule is None or rule.reorder_level is None else rule.reorder_level
+        if rule is not None and rule.restock_level is not None:
+            restock = max(rule.restock_level, reorder + 1)
+        else:
+            restock = reorder + max(config['ALERT_RESTOCK_MARGIN'], 1)
+        expiry_days = config['ALERT_EXPIRY_DAYS'] if rule is None or rule.expiry_days is None else rule.expiry_days
+        return reorder, restock, expiry_days
+
+    def evaluate(self, medicine_ids=None, session=None):
+        """Open and resolve alerts of the given medicines (every medicine when None), returns the counts
+
+        Runs in the caller's transaction and does not commit.
+        """
+        session = session or db.session
+        if medicine_ids is not None:
+            medicine_ids = sorted(medicine_ids)
+            if not medicine_ids:
+                return {'opened': 0, 'resolved': 0}
+        today = datetime.now().date()
+        now = datetime.utcnow()
+
+        medicines = select(
+            Medicine.id, Medicine.name, StockBalance.available, StockBalance.nearest_expiry, AlertRule
+        ).outerjoin(StockBalance, StockBalance.medicine_id == Medicine.id) \
+         .outerjoin(AlertRule, AlertRule.medicine_id == Medicine.id)
+        open_alerts = select(StockAlert).where(StockAlert.resolved_at.is_(None))
+        if medicine_ids is not None:
+            medicines = medicines.where(Medicine.id.in_(medicine_ids))
+            open_alerts = open_alerts.where(StockAlert.medicine_id.in_(medicine_ids))
+        current = {(alert.medicine_id, alert.kind): alert for alert in session.scalars(open_alerts)}
+
+        opened = []
+        resolved = 0
+        for row in session.execute(medicines):
+            reorder, restock, expiry_days = self.thresholds(row.AlertRule)
+            available = row.available or 0
+            expiring = row.nearest_expiry is not None and row.nearest_expiry <= today + timedelta(days=expiry_days)
+            for kind, fires, clears, threshold in (
+                (LOW_STOCK, available <= reorder, available >= restock, reorder),
+                (EXPIRING, expiring, not expiring, expiry_days),
+            ):
+                alert = current.get((row.id, kind))
+                if alert is None and fires:
+                    alert = StockAlert(medicine_id=row.id, kind=kind, threshold=threshold, quantity=available,
+                                       nearest_expiry=row.nearest_expiry, opened_at=now)
+                    session.add(alert)
+                    opened.append((row.name, alert))
+                elif alert is not None and clears:
+                    alert.resolved_at = now
+                    resolved += 1
+
+        if opened:
+            self.notify(opened, session)
+        return {'opened': len(opened), 'resolved': resolved}
+
+    def notify(self, opened, session):
+        """Queue one digest of newly opened alerts for every notified user"""
+        recipients = [email for (email,) in session.execute(
+            select(User.email).where(User.role.in_(self.app.config['ALERT_NOTIFY_ROLES']))
+        )]
+        if recipients:
+            mailer.queue(recipients, 'Medicine Stock Alert', alert_digest(opened), session)
+
+    def sweep(self):
+        """Evaluate every medicine, for expiry windows that moved with the date; does not commit"""
+        return self.evaluate(None)
+
+
+alert_rules = AlertRules()
+
+
+def alert_digest(opened):
+    """Plain-text body listing (medicine name, StockAlert) pairs"""
+    body = "The following stock alerts were raised:\n\n"
+    for name, alert in sorted(opened, key=lambda item: (item[1].kind, item[0])):
+        body += f"Medicine: {name}\n"
+        if alert.kind == LOW_STOCK:
+            body += f"Low stock: {alert.quantity} available (reorder level {alert.threshold})\n\n"
+        else:
+            body += f"Expiring: nearest batch expires {alert.nearest_expiry} " \
+                    f"(within {alert.threshold} days), {alert.quantity} available\n\n"
+    return body
@@ -1,88 +1,271 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, Response
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from models import db, User, Supplier, Medicine, Batch, Order, OrderItem, StockTransaction
+from models import db, User, Supplier, Medicine, Batch, Order, OrderItem, StockTransaction, StockBalance, AlertRule, StockAlert
+from stock import (refresh_stock_balances, refresh_stale_balances, rebuild_stock_balances, stock_changes,
+                   STOCK_VERSION, STOCK_RESET)
+from data_versions import current_versions
+from dispensing import dispense, InsufficientStock, StockChanged
+from receiving import receive_orders, ReceiveConflict
+from importer import Importer, KINDS as IMPORT_KINDS
+import click
+import csv
+from migrations import upgrade, current_version, LATEST_VERSION
+from query_plans import check_query_plans
+from synthetic import generate, scale_counts, SCALES
+from medicine_search import search_medicines, SEARCH_LIMIT
 from datetime import datetime, timedelta
-from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 import os
+import time
 from sqlalchemy import func
-from io import BytesIO
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
+from sqlalchemy.orm import joinedload
+from reports import report_params, report_filename
+from report_jobs import report_jobs, TooManyReportJobs, DONE
+from report_cache import report_cache
+from summary_cache import summary_cache
+from notifications import mailer
+from alerts import alert_rules, queue_evaluation, LOW_STOCK
+from scheduling import job_scheduler
+from user_cache import user_cache
+from metrics import metrics
+from write_queue import write_queue, queued_write
+from fragment_cache import fragment_cache
+from stock_events import stock_events, record_movement, TooManyListeners, ADJUST, REMOVE
+from list_views import LISTS, page_json
+from pagination import InvalidCursor
+from query_budget import query_budgets, query_budget
 
 # Ensure all required packages are installed:
 # pip install flask flask-login sqlalchemy apscheduler reportlab
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your_secret_key_change_in_production'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///rhu_inventory.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///rhu_inventory.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 db.init_app(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
+report_jobs.init_app(app)
+report_cache.init_app(app)
+query_budgets.init_app(app)
+summary_cache.init_app(app)
+stock_events.init_app(app)
+mailer.init_app(app)
+alert_rules.init_app(app)
+job_scheduler.init_app(app)
+user_cache.init_app(app)
+metrics.init_app(app)
+write_queue.init_app(app)
+fragment_cache.init_app(app)
+
+@metrics.collector
+def component_metrics():
+    """Cache, live stream, report job and write queue figures read at every /metrics scrape"""
+    summary, users, reports = summary_cache.stats(), user_cache.stats(), report_cache.stats()
+    events, writes, fragments = stock_events.stats(), write_queue.stats(), fragment_cache.stats()
+    return [
+        ('rhu_summary_cache_hits_total', 'counter', 'Dashboard summary cache hits', summary['hits']),
+        ('rhu_summary_cache_misses_total', 'counter', 'Dashboard summary cache misses', summary['misses']),
+        ('rhu_user_cache_hits_total', 'counter', 'User identity cache hits', users['hits']),
+        ('rhu_user_cache_misses_total', 'counter', 'User identity cache misses', users['misses']),
+        ('rhu_report_cache_hits_total', 'counter', 'PDF report cache hits', reports['hits']),
+        ('rhu_report_cache_misses_total', 'counter', 'PDF report cache misses', reports['misses']),
+        ('rhu_report_cache_bytes', 'gauge', 'Size of the PDF report cache', reports['bytes']),
+        ('rhu_fragment_cache_hits_total', 'counter', 'Template fragment cache hits', fragments['hits']),
+        ('rhu_fragment_cache_misses_total', 'counter', 'Template fragment cache misses', fragments['misses']),
+        ('rhu_fragment_cache_evictions_total', 'counter', 'Template fragments evicted', fragments['evictions']),
+        ('rhu_fragment_cache_bytes', 'gauge', 'Size of the template fragment cache', fragments['bytes']),
+        ('rhu_stock_event_clients', 'gauge', 'Open live stock event streams', events['clients']),
+        ('rhu_stock_events_published_total', 'counter', 'Stock events published', events['published']),
+        ('rhu_report_jobs_active', 'gauge', 'Report jobs pending or running', report_jobs.active_count()),
+        ('rhu_write_groups_total', 'counter', 'Group commits of queued writes', writes['groups']),
+        ('rhu_write_group_requests_total', 'counter', 'Requests committed in write groups', writes['writes']),
+        ('rhu_write_groups_failed_total', 'counter', 'Group commits that failed', writes['failed_groups']),
+        ('rhu_write_queue_waiting', 'gauge', 'Requests waiting for the writer connection', writes['waiting']),
+    ]
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # A cached identity (id, username, role, email) instead of a User query per request
+    return user_cache.get(int(user_id))
 
-def check_expiring_medicines():
-    """Check for medicines expiring in the next 30 days"""
+def sweep_stock_alerts():
+    """Check every medicine's alert rules; stock writes check their own medicines as they happen"""
     with app.app_context():
-        thirty_days_from_now = datetime.now().date() + timedelta(days=30)
-        expiring_batches = Batch.query.filter(
-            Batch.expiration_date <= thirty_days_from_now,
-            Batch.expiration_date > datetime.now().date()
-        ).all()
-
-        if expiring_batches:
-            # Send email to managers
-            managers = User.query.filter_by(role='manager').all()
-            for manager in managers:
-                send_expiration_alert(manager.email, expiring_batches)
-
-def send_expiration_alert(email, batches):
-    """Send email alert for expiring medicines"""
-    # Configure your email settings
-    sender_email = "your-email@example.com"
-    sender_password = "your-password"
-
-    msg = MIMEMultipart()
-    msg['From'] = sender_email
-    msg['To'] = email
-    msg['Subject'] = "Medicine Expiration Alert"
-
-    body = "The following medicines are expiring soon:\n\n"
-    for batch in batches:
-        body += f"Medicine: {batch.medicine.name}\n"
-        body += f"Batch Number: {batch.batch_number}\n"
-        body += f"Expiration Date: {batch.expiration_date}\n"
-        body += f"Quantity Remaining: {batch.quantity}\n\n"
-
-    msg.attach(MIMEText(body, 'plain'))
+        result = alert_rules.sweep()
+        db.session.commit()
+        if result['opened'] or result['resolved']:
+            app.logger.info('Alert sweep: %(opened)s opened, %(resolved)s resolved', result)
+            deliver_outbound_email()
 
-    try:
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls()
-        server.login(sender_email, sender_password)
-        server.send_message(msg)
-        server.quit()
-    except Exception as e:
-        print(f"Failed to send email: {str(e)}")
-
-# Set up the scheduler
-scheduler = BackgroundScheduler()
-scheduler.add_job(
-    check_expiring_medicines,
+def deliver_outbound_email():
+    """Send queued emails that are due, retrying earlier failures"""
+    with app.app_context():
+        result = mailer.deliver_pending()
+        if result['sent'] or result['failed']:
+            app.logger.info('Outbound email: %(sent)s sent, %(failed)s failed', result)
+
+# Set up the scheduled jobs; only the worker holding the scheduler lock runs them
+job_scheduler.add_job(
+    sweep_stock_alerts,
     trigger=CronTrigger(hour=9),  # Run daily at 9 AM
-    id='check_expiring_medicines',
-    name='Check for expiring medicines'
+    id='sweep_stock_alerts',
+    name='Check alert rules of every medicine'
+)
+job_scheduler.add_job(
+    deliver_outbound_email,
+    trigger='interval',
+    minutes=5,
+    id='deliver_outbound_email',
+    name='Deliver queued emails'
 )
+job_scheduler.add_job(
+    report_jobs.cleanup,
+    trigger='interval',
+    minutes=10,
+    id='cleanup_report_jobs',
+    name='Remove expired report job files'
+)
+
+def roll_stock_balances():
+    """Move stock of batches that expired overnight out of the available balance"""
+    with app.app_context():
+        refresh_stale_balances()
+        db.session.commit()
+
+job_scheduler.add_job(
+    roll_stock_balances,
+    trigger=CronTrigger(hour=0, minute=5),  # Run daily just after midnight
+    id='roll_stock_balances',
+    name='Refresh stock balances of expired batches'
+)
+
+@app.cli.command('rebuild-stock-balances')
+def rebuild_stock_balances_command():
+    """Rebuild the per-medicine stock balance table from the batches"""
+    count = rebuild_stock_balances()
+    print(f"Rebuilt stock balances for {count} medicines")
+
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Create missing tables and apply pending schema migrations"""
+    db.create_all()
+    applied = upgrade(db.engine)
+    for number, description in applied:
+        print(f"Applied migration {number}: {description}")
+    if StockBalance.query.count() != Medicine.query.count():
+        rebuild_stock_balances()
+    print(f"Database schema at version {current_version(db.engine)} (latest {LATEST_VERSION})")
+
+@app.cli.command('deliver-email')
+def deliver_email_command():
+    """Send queued emails that are due now"""
+    result = mailer.deliver_pending()
+    stats = mailer.queue_stats()
+    print(f"{result['sent']} sent, {result['failed']} failed; queue: {stats['pending']} pending, "
+          f"{stats['sent']} sent, {stats['failed']} failed")
+
+@app.cli.command('send-test-email')
+@click.argument('address')
+def send_test_email_command(address):
+    """Queue a test email to address and deliver it with the configured SMTP settings"""
+    mailer.enqueue([address], 'RHU Inventory test email', 'Email delivery is working.')
+    result = mailer.deliver_pending()
+    print(f"{result['sent']} sent, {result['failed']} failed")
+
+@app.cli.command('scheduler-status')
+def scheduler_status_command():
+    """Show the scheduler leader and the last run and next run of every job"""
+    status = job_scheduler.status()
+    leader = status['leader']
+    if leader:
+        print(f"Leader: {leader['owner']} until {leader['expires_at']}{' (expired)' if leader['expired'] else ''}")
+    else:
+        print("Leader: none")
+    for job in status['jobs']:
+        duration = f"{job['last_duration']}s" if job['last_duration'] is not None else '-'
+        print(f"{job['id']}: last {job['last_outcome'] or 'never run'} at {job['last_finished_at'] or '-'} "
+              f"in {duration}, next {job['next_run_at'] or '-'} "
+              f"({job['run_count']} runs, {job['failure_count']} failed)")
+        if job['last_error']:
+            print(f"    {job['last_error']}")
+
+@app.cli.command('run-scheduler')
+def run_scheduler_command():
+    """Run scheduled jobs in this process until interrupted, for deployments with SCHEDULER_AUTOSTART=0"""
+    job_scheduler.start()
+    print(f"Scheduler {job_scheduler.owner} started in {app.config['SCHEDULER_MODE']} mode, Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        job_scheduler.shutdown()
+
+@app.cli.command('import-data')
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--kind', type=click.Choice(sorted(IMPORT_KINDS)), help='What the files contain, guessed from the file name when omitted')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), help='Guessed from the file extension when omitted')
+@click.option('--dry-run', is_flag=True, help='Validate and report without saving anything')
+@click.option('--chunk-size', default=1000, show_default=True, help='Rows per bulk insert')
+def import_data_command(paths, kind, fmt, dry_run, chunk_size):
+    """Bulk import suppliers, medicines and batches from CSV or NDJSON files, in the order given"""
+    importer = Importer(dry_run=dry_run, chunk_size=chunk_size)
+    for path in paths:
+        report = importer.import_file(path, kind=kind, fmt=fmt)
+        print(f"{path}: {report.inserted}/{report.rows} {report.kind} imported, {report.error_count} failed "
+              f"in {report.seconds:.2f}s ({report.rows_per_second} rows/sec)")
+        for line, error in report.errors:
+            print(f"    line {line}: {error}")
+    importer.finish()
+    print("Dry run, nothing was saved" if dry_run else "Import committed")
+
+@app.cli.command('seed-synthetic')
+@click.option('--scale', type=click.Choice(list(SCALES)), default='small', show_default=True)
+@click.option('--set', 'overrides', multiple=True, metavar='COUNT=N', help='Override one row count, e.g. transactions=2000000')
+@click.option('--seed', default=42, show_default=True)
+def seed_synthetic_command(scale, overrides, seed):
+    """Append a synthetic data set for benchmarks and load tests (user bench, password bench)"""
+    try:
+        counts = scale_counts(scale, **dict(item.split('=', 1) for item in overrides))
+    except ValueError as e:
+        raise SystemExit(str(e))
+    db.create_all()
+    upgrade(db.engine)
+    rows, seconds = generate(seed=seed, **counts)
+    print(', '.join(f"{count} {table}" for table, count in rows.items()) + f" in {seconds:.1f}s")
+
+@app.cli.command('explain-hot-queries')
+def explain_hot_queries_command():
+    """Show the query plan of every hot query and fail if one scans a table or a list page sorts its rows"""
+    failures = 0
+    for name, details, ok in check_query_plans():
+        print(f"[{'OK' if ok else 'SCAN'}] {name}")
+        for detail in details:
+            print(f"    {detail}")
+        if not ok:
+            failures += 1
+    if failures:
+        raise SystemExit(f"{failures} hot queries do not use an index in the order they need")
+
+@app.cli.command('check-query-budgets')
+@click.option('--user', 'username', help='User to view the pages as, the first admin when omitted')
+def check_query_budgets_command(username):
+    """Render every budgeted page against this database and fail if one runs too many queries"""
+    query = User.query.filter_by(username=username) if username else User.query.filter_by(role='admin')
+    user = query.order_by(User.id).first()
+    if user is None:
+        raise SystemExit('No such user to view the pages as')
+    failures = 0
+    for endpoint, status, count, budget in query_budgets.check_pages(user.id):
+        ok = status < 400 and count <= budget
+        print(f"[{'OK' if ok else 'FAIL'}] {endpoint}: {count}/{budget} queries (HTTP {status})")
+        if not ok:
+            failures += 1
+    if failures:
+        raise SystemExit(f"{failures} pages failed their query budget")
 
 @app.route('/')
 def index():
@@ -109,65 +292,119 @@ def logout():
     flash('You have been logged out successfully', 'success')
     return redirect(url_for('login'))
 
-@app.route('/dashboard')
-@login_required
-def dashboard():
-    # Get low stock items (quantity <= 10)
-    low_stock = Batch.query.filter(Batch.quantity <= 10).all()
+def dashboard_summary(today):
+    """Dashboard figures as plain data, so they can be cached and shared between requests"""
+    # Get medicines with an open low stock alert
+    low_stock = StockAlert.query.options(joinedload(StockAlert.medicine)).filter(
+        StockAlert.kind == LOW_STOCK,
+        StockAlert.resolved_at.is_(None)
+    )
     # Get items expiring in the next 30 days
-    thirty_days_from_now = datetime.now().date() + timedelta(days=30)
-    expiring_soon = Batch.query.filter(
+    thirty_days_from_now = today + timedelta(days=30)
+    expiring_soon = Batch.query.options(joinedload(Batch.medicine)).filter(
         Batch.expiration_date <= thirty_days_from_now,
-        Batch.expiration_date > datetime.now().date()
-    ).all()
-    # Get recent transactions
-    recent_transactions = StockTransaction.query.order_by(
+        Batch.expiration_date > today
+    )
+    # Get recent transactions, with the batch, medicine and user the table shows
+    recent_transactions = StockTransaction.query.options(
+        joinedload(StockTransaction.batch).joinedload(Batch.medicine),
+        joinedload(StockTransaction.user)
+    ).order_by(
         StockTransaction.transaction_date.desc()
     ).limit(10).all()
-    # Get total counts
-    total_medicines = Medicine.query.count()
-    total_suppliers = Supplier.query.count()
-    pending_orders = Order.query.filter_by(status='pending').count()
-    return render_template('dashboard.html',
-                         low_stock=low_stock,
-                         expiring_soon=expiring_soon,
-                         recent_transactions=recent_transactions,
-                         total_medicines=total_medicines,
-                         total_suppliers=total_suppliers,
-                         pending_orders=pending_orders)
 
-@app.route('/orders')
+    def batch_row(batch):
+        return {'medicine': {'name': batch.medicine.name}, 'batch_number': batch.batch_number,
+                'quantity': batch.quantity, 'expiration_date': batch.expiration_date}
+
+    return {
+        # The alert tables show five rows and a count of the rest
+        'low_stock': [{
+            'medicine': {'name': alert.medicine.name},
+            'available': alert.medicine.stock_balance.available if alert.medicine.stock_balance else 0,
+            'reorder_level': alert.threshold,
+            'opened_at': alert.opened_at,
+        } for alert in low_stock.order_by(StockAlert.opened_at.desc(), StockAlert.id).limit(5)],
+        'low_stock_count': low_stock.count(),
+        'expiring_soon': [batch_row(batch) for batch in expiring_soon.order_by(Batch.expiration_date, Batch.id).limit(5)],
+        'expiring_soon_count': expiring_soon.count(),
+        'recent_transactions': [{
+            'transaction_date': tx.transaction_date,
+            'batch': {'batch_number': tx.batch.batch_number,
+                      'medicine': {'name': tx.batch.medicine.name} if tx.batch.medicine else None} if tx.batch else None,
+            'transaction_type': tx.transaction_type,
+            'quantity': tx.quantity,
+            'performed_by': tx.performed_by,
+            'user': {'username': tx.user.username, 'role': tx.user.role} if tx.user else None,
+        } for tx in recent_transactions],
+        # Get total counts
+        'total_medicines': Medicine.query.count(),
+        'total_suppliers': Supplier.query.count(),
+        'pending_orders': Order.query.filter_by(status='pending').count(),
+    }
+
+@app.route('/dashboard')
 @login_required
-def orders():
-    orders = Order.query.order_by(Order.order_date.desc()).all()
+@query_budget(9)
+def dashboard():
+    # Cached until the next write; the expiry window moves at midnight, so the day is part of the key
+    today = datetime.now().date()
+    summary = summary_cache.get_or_compute(f'dashboard:{today.isoformat()}', lambda: dashboard_summary(today))
+    return render_template('dashboard.html', **summary)
 
-    # Filter medicines with total quantity > 0, but use generic_name instead of name
-    medicines = db.session.query(Medicine).join(Batch).group_by(Medicine.id).having(func.sum(Batch.quantity) > 0).all()
+def _list_page(name, endpoint):
+    """Keyset page of one of the LISTS for the current request, None for a bad cursor"""
+    try:
+        return LISTS[name].page(request.args, endpoint)
+    except InvalidCursor:
+        flash('That page link is no longer valid, showing the first page.', 'warning')
+        return None
 
-    # Pass medicines to template, but ensure template uses medicine.generic_name
-    return render_template('orders.html', orders=orders, medicines=medicines)
+@app.route('/orders')
+@login_required
+@query_budget(2)
+def orders():
+    page = _list_page('orders', 'orders')
+    if page is None:
+        return redirect(url_for('orders'))
+    # The dispense form's medicine picker loads its options from /api/medicines/search
+    return render_template('orders.html', orders=page.items, page=page)
 
 @app.route('/suppliers')
 @login_required
+@query_budget(2)
 def suppliers():
-    suppliers = Supplier.query.all()
-    return render_template('suppliers.html', suppliers=suppliers)
+    page = _list_page('suppliers', 'suppliers')
+    if page is None:
+        return redirect(url_for('suppliers'))
+    return render_template('suppliers.html', suppliers=page.items, page=page)
 
 @app.route('/inventory')
 @login_required
+@query_budget(3)
 def inventory():
-    medicines = Medicine.query.all()
-    return render_template('inventory.html', medicines=medicines)
+    # Stock figures come from the joined StockBalance row, so this is a single query,
+    # after the data versions that key the cached rows
+    rows_version = fragment_cache.version('medicine', 'batch', 'supplier')
+    page = _list_page('medicines', 'inventory')
+    if page is None:
+        return redirect(url_for('inventory'))
+    return render_template('inventory.html', medicines=page.items, page=page, rows_version=rows_version)
 
 @app.route('/batches')
 @login_required
+@query_budget(3)
 def batches():
-    batches = Batch.query.all()
+    rows_version = fragment_cache.version('batch', 'medicine')
+    page = _list_page('batches', 'batches')
+    if page is None:
+        return redirect(url_for('batches'))
     # Each batch has batch.medicine, so template can use batch.medicine.generic_name
-    return render_template('batches.html', batches=batches)
+    return render_template('batches.html', batches=page.items, page=page, rows_version=rows_version)
 
 @app.route('/reports')
 @login_required
+@query_budget(3)
 def reports():
     # Allow admin, sub-admin, and employee to access reports
     if current_user.role not in ['admin', 'sub-admin', 'employee']:
@@ -180,28 +417,119 @@ def reports():
     ).join(Batch).group_by(Medicine.name).all()
     # Expiring medicines report
     thirty_days_from_now = datetime.now().date() + timedelta(days=30)
-    expiring_report = Batch.query.filter(
+    expiring_report = Batch.query.options(joinedload(Batch.medicine)).filter(
         Batch.expiration_date <= thirty_days_from_now
     ).all()
     return render_template('reports.html',
                          stock_report=stock_report,
                          expiring_report=expiring_report)
 
+def stock_levels_tag():
+    """ETag of the stock level list: its stock counters and the medicine names it lists"""
+    versions = current_versions([STOCK_VERSION, STOCK_RESET, 'medicine'])
+    return f"stock-{versions[STOCK_VERSION]}-{versions[STOCK_RESET]}-{versions['medicine']}"
+
 @app.route('/api/stock-levels')
 @login_required
+@query_budget(3)
 def api_stock_levels():
-    """API endpoint for stock levels data"""
-    stock_data = db.session.query(
-        Medicine.name,
-        func.sum(Batch.quantity).label('total_quantity')
-    ).join(Batch).group_by(Medicine.name).all()
-    return jsonify([{
-        'medicine': item.name,
-        'quantity': item.total_quantity
-    } for item in stock_data])
+    """API endpoint for stock levels data
+
+    Answers If-None-Match with 304 while the stock levels are unchanged, after
+    one lookup of the persisted counters (shared by every worker, and moved by
+    the nightly expiry refresh too). With ?since=<version> it returns only the
+    medicines whose stock changed after that version (see stock.stock_changes).
+    """
+    etag = stock_levels_tag()
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return jsonify({'error': 'since must be a stock version number'}), 400
+        response = jsonify(stock_changes(since))
+    else:
+        stock_data = db.session.query(
+            Medicine.name,
+            func.sum(Batch.quantity).label('total_quantity')
+        ).join(Batch).group_by(Medicine.name).all()
+        response = jsonify([{
+            'medicine': item.name,
+            'quantity': item.total_quantity
+        } for item in stock_data])
+    response.set_etag(etag)
+    # Clients keep the body but must revalidate it on every poll
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/stock-events')
+@login_required
+def api_stock_events():
+    """Server-Sent Events stream of stock movements, see stock_events.py"""
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        subscription = stock_events.subscribe(int(last_event_id) if last_event_id else None)
+    except ValueError:
+        return jsonify({'error': 'Last-Event-ID must be an event number'}), 400
+    except TooManyListeners as e:
+        return jsonify({'error': str(e)}), 503
+    # The stream holds no request context or database session while it waits
+    return Response(stock_events.stream(subscription), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/alerts')
+@login_required
+@query_budget(2)
+def api_alerts():
+    """Open stock alerts, newest first; ?status=all includes resolved ones"""
+    query = StockAlert.query.options(joinedload(StockAlert.medicine))
+    if request.args.get('status') != 'all':
+        query = query.filter(StockAlert.resolved_at.is_(None))
+    limit = min(request.args.get('limit', 100, type=int) or 100, 500)
+    alerts = query.order_by(StockAlert.opened_at.desc(), StockAlert.id.desc()).limit(limit).all()
+    return jsonify({'alerts': [{
+        'id': alert.id,
+        'kind': alert.kind,
+        'medicine_id': alert.medicine_id,
+        'medicine': alert.medicine.name,
+        'threshold': alert.threshold,
+        'quantity': alert.quantity,
+        'nearest_expiry': alert.nearest_expiry.isoformat() if alert.nearest_expiry else None,
+        'opened_at': alert.opened_at.isoformat(),
+        'resolved_at': alert.resolved_at.isoformat() if alert.resolved_at else None,
+    } for alert in alerts]})
+
+@app.route('/api/medicines/search')
+@login_required
+@query_budget(2)
+def api_medicine_search():
+    """Medicines matching ?q= as word prefixes, best match first, with their stock (limit, in_stock=1)"""
+    try:
+        limit = int(request.args.get('limit', SEARCH_LIMIT))
+    except ValueError:
+        return jsonify({'error': 'limit must be a whole number'}), 400
+    in_stock = request.args.get('in_stock', '').lower() in ('1', 'true', 'yes', 'on')
+    return jsonify({'results': search_medicines(request.args.get('q', ''), limit, in_stock)})
+
+@app.route('/api/<any(medicines, batches, orders, suppliers):name>')
+@login_required
+@query_budget(3)
+def api_list(name):
+    """API endpoint for one keyset page of medicines, batches, orders or suppliers"""
+    try:
+        page = LISTS[name].page(request.args, for_api=True)
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(page_json(name, page))
 
 @app.route('/order/<int:id>/deliver', methods=['POST'])
 @login_required
+@queued_write
 def deliver_order(id):
     order = Order.query.get_or_404(id)
     order.status = 'delivered'
@@ -211,6 +539,7 @@ def deliver_order(id):
 
 @app.route('/order/<int:id>/process', methods=['POST'])
 @login_required
+@queued_write
 def process_order(id):
     # Only admin and sub-admin can process orders
     if current_user.role not in ['admin', 'sub-admin']:
@@ -220,43 +549,59 @@ def process_order(id):
     if order.status != 'pending':
         flash('Order is already processed.', 'warning')
         return redirect(url_for('orders'))
-    order.status = 'delivered'
-
-    for item in order.items:
-        # Find a batch for this medicine or create a new one (simple logic)
-        batch = Batch.query.filter_by(medicine_id=item.medicine_id).order_by(Batch.expiration_date.desc()).first()
-        if batch and not batch.is_expired:
-            batch.quantity += item.quantity
-            db.session.add(batch)
-        else:
-            batch = Batch(
-                batch_number=f"ORDER-{order.id}-{item.medicine_id}",
-                medicine_id=item.medicine_id,
-                quantity=item.quantity,
-                expiration_date=datetime.now().date() + timedelta(days=365),
-                manufacturing_date=datetime.now().date(),
-                unit_price=item.unit_price
-            )
-            db.session.add(batch)
-            db.session.flush()  # Ensure batch.id is available
-
-        # Only create StockTransaction if batch.id is available
-        if batch.id:
-            transaction = StockTransaction(
-                batch_id=batch.id,
-                transaction_type='in',
-                quantity=item.quantity,
-                performed_by=current_user.id,
-                notes=f"From Order #{order.id}"
-            )
-            db.session.add(transaction)
-
-    db.session.commit()
+    try:
+        receive_orders([order.id], current_user.id)
+    except ReceiveConflict:
+        flash('Order is already processed.', 'warning')
+        return redirect(url_for('orders'))
     flash('Order processed and stock updated. Transactions recorded.', 'success')
     return redirect(url_for('orders'))
 
+@app.route('/orders/process', methods=['POST'])
+@login_required
+@queued_write
+def process_orders():
+    """Receive every selected pending order in one transaction"""
+    if current_user.role not in ['admin', 'sub-admin']:
+        flash('You do not have permission to process orders.', 'danger')
+        return redirect(url_for('orders'))
+    try:
+        order_ids = [int(order_id) for order_id in request.form.getlist('order_id[]')]
+    except ValueError:
+        order_ids = []
+    if not order_ids:
+        flash('Select at least one pending order to process.', 'warning')
+        return redirect(url_for('orders'))
+    try:
+        summary = receive_orders(order_ids, current_user.id)
+    except ReceiveConflict as e:
+        flash(str(e), 'warning')
+        return redirect(url_for('orders'))
+    flash(f"Processed {len(summary['received'])} orders ({summary['items']} items). Stock updated and transactions recorded.", 'success')
+    if summary['skipped']:
+        flash(f"Skipped orders that were not pending: {', '.join(map(str, summary['skipped']))}", 'warning')
+    return redirect(url_for('orders'))
+
+@app.route('/api/orders/receive', methods=['POST'])
+@login_required
+@queued_write
+def api_receive_orders():
+    """Receive JSON {"order_ids": [1, 2, 3]} into stock, returns what was received and skipped"""
+    if current_user.role not in ['admin', 'sub-admin']:
+        return jsonify({'error': 'You do not have permission to process orders.'}), 403
+    data = request.get_json(silent=True) or {}
+    try:
+        order_ids = [int(order_id) for order_id in data.get('order_ids', [])]
+    except (TypeError, ValueError):
+        return jsonify({'error': 'order_ids must be a list of order ids'}), 400
+    try:
+        return jsonify(receive_orders(order_ids, current_user.id))
+    except ReceiveConflict as e:
+        return jsonify({'error': str(e)}), 409
+
 @app.route('/order/<int:id>/cancel', methods=['POST'])
 @login_required
+@queued_write
 def cancel_order(id):
     # Only admin can cancel orders
     if current_user.role != 'admin':
@@ -275,51 +620,47 @@ def cancel_order(id):
 
 @app.route('/dispense', methods=['POST'])
 @login_required
+@queued_write
 def process_dispense():
     medicine_ids = request.form.getlist('medicine_id[]')
     quantities = request.form.getlist('quantity[]')
 
-    for i in range(len(medicine_ids)):
-        if not (medicine_ids[i] and quantities[i]):
-            continue
-
-        medicine_id = int(medicine_ids[i])
-        quantity_to_dispense = int(quantities[i])
-
-        medicine = Medicine.query.get_or_404(medicine_id)
-
-        if medicine.total_quantity < quantity_to_dispense:
-            flash(f'Not enough stock for {medicine.name}. Available: {medicine.total_quantity}, Requested: {quantity_to_dispense}', 'danger')
-            return redirect(url_for('orders'))
-
-        # Dispense from batches, oldest first
-        batches = sorted(medicine.available_batches, key=lambda b: b.expiration_date)
-
-        temp_qty_to_dispense = quantity_to_dispense
-        for batch in batches:
-            if temp_qty_to_dispense == 0:
-                break
-
-            dispense_from_batch = min(temp_qty_to_dispense, batch.quantity)
-
-            if dispense_from_batch > 0:
-                batch.quantity -= dispense_from_batch
-                temp_qty_to_dispense -= dispense_from_batch
-
-                # Record transaction
-                transaction = StockTransaction(
-                    batch_id=batch.id,
-                    transaction_type='out',
-                    quantity=dispense_from_batch,
-                    performed_by=current_user.id,
-                    notes="Dispensed to patient"
-                )
-                db.session.add(transaction)
+    try:
+        lines = [(int(medicine_ids[i]), int(quantities[i]))
+                 for i in range(len(medicine_ids)) if medicine_ids[i] and quantities[i]]
+        # Allocates every line first-expiry-first-out and commits them together
+        allocations = dispense(lines, current_user.id)
+    except InsufficientStock as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('orders'))
+    except (ValueError, StockChanged) as e:
+        flash(str(e) if isinstance(e, StockChanged) else 'Please enter whole, positive quantities.', 'danger')
+        return redirect(url_for('orders'))
 
-    db.session.commit()
-    flash('Medicines dispensed successfully.', 'success')
+    used = ', '.join(f"{a['quantity']} from batch {a['batch_number']}" for a in allocations)
+    flash(f'Medicines dispensed successfully. {used}'.strip(), 'success')
     return redirect(url_for('orders'))
 
+@app.route('/api/dispense', methods=['POST'])
+@login_required
+@queued_write
+def api_dispense():
+    """Dispense JSON {"items": [{"medicine_id": 1, "quantity": 5}]}, returns the batch each unit came from"""
+    data = request.get_json(silent=True) or {}
+    try:
+        lines = [(int(item['medicine_id']), int(item['quantity'])) for item in data.get('items', [])]
+        allocations = dispense(lines, current_user.id)
+    except InsufficientStock as e:
+        return jsonify({'error': str(e), 'medicine_id': e.medicine_id,
+                        'available': e.available, 'requested': e.requested}), 409
+    except StockChanged as e:
+        return jsonify({'error': str(e)}), 409
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Each item needs a medicine_id and a positive quantity'}), 400
+    return jsonify({'allocations': [dict(a, expiration_date=a['expiration_date'].isoformat())
+                                    for a in allocations]})
+
+# Not a queued write: hashing the password would hold up every write queued behind it
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
@@ -366,6 +707,8 @@ def forgot_password():
 
 @app.route('/medicine/add', methods=['GET', 'POST'])
 @login_required
+@query_budget(2)
+@queued_write
 def add_medicine():
     if request.method == 'POST':
         medicine = Medicine(
@@ -376,34 +719,73 @@ def add_medicine():
             supplier_id=request.form['supplier_id']
         )
         db.session.add(medicine)
+        db.session.flush()
+        refresh_stock_balances([medicine.id])
         db.session.commit()
         flash('Medicine added successfully', 'success')
         return redirect(url_for('inventory'))
-    suppliers = Supplier.query.all()
-    return render_template('add_medicine.html', suppliers=suppliers)
+    # Not run when the supplier options come from the fragment cache
+    suppliers = Supplier.query
+    return render_template('add_medicine.html', suppliers=suppliers,
+                           suppliers_version=fragment_cache.version('supplier'))
+
+def _alert_thresholds(form):
+    """Optional alert rule fields of a medicine form, blank means the default"""
+    thresholds = {}
+    for field, label in (('reorder_level', 'Reorder level'), ('restock_level', 'Restock level'),
+                         ('expiry_days', 'Expiry warning days')):
+        value = form.get(field, '').strip()
+        if not value:
+            thresholds[field] = None
+            continue
+        if not value.isdigit():
+            raise ValueError(f'{label} must be a whole number of zero or more')
+        thresholds[field] = int(value)
+    if thresholds['reorder_level'] is not None and thresholds['restock_level'] is not None \
+            and thresholds['restock_level'] <= thresholds['reorder_level']:
+        raise ValueError('Restock level must be above the reorder level')
+    return thresholds
 
 @app.route('/medicine/<int:id>/edit', methods=['GET', 'POST'])
 @login_required
+@query_budget(3)
+@queued_write
 def edit_medicine(id):
     # Only admin and sub-admin can edit, employee cannot
     if current_user.role not in ['admin', 'sub-admin']:
         flash('You do not have permission to edit medicines.', 'danger')
         return redirect(url_for('inventory'))
-    medicine = Medicine.query.get_or_404(id)
+    medicine = Medicine.query.options(joinedload(Medicine.alert_rule)).get_or_404(id)
     if request.method == 'POST':
+        try:
+            thresholds = _alert_thresholds(request.form)
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('edit_medicine', id=id))
         medicine.name = request.form['name']
         medicine.generic_name = request.form['generic_name']
         medicine.category = request.form['category']
         medicine.unit = request.form['unit']
         medicine.supplier_id = request.form['supplier_id']
+        if any(value is not None for value in thresholds.values()):
+            if medicine.alert_rule is None:
+                medicine.alert_rule = AlertRule()
+            for field, value in thresholds.items():
+                setattr(medicine.alert_rule, field, value)
+        elif medicine.alert_rule is not None:
+            medicine.alert_rule = None
+        # New thresholds apply to the current stock straight away
+        queue_evaluation([medicine.id])
         db.session.commit()
         flash('Medicine updated successfully', 'success')
         return redirect(url_for('inventory'))
     suppliers = Supplier.query.all()
-    return render_template('edit_medicine.html', medicine=medicine, suppliers=suppliers)
+    return render_template('edit_medicine.html', medicine=medicine, suppliers=suppliers,
+                           alert_defaults=alert_rules.thresholds(None))
 
 @app.route('/medicine/<int:id>/delete', methods=['POST'])
 @login_required
+@queued_write
 def delete_medicine(id):
     # Only admin can delete, sub-admin cannot
     if current_user.role != 'admin':
@@ -421,6 +803,8 @@ def delete_medicine(id):
 
 @app.route('/batch/add', methods=['GET', 'POST'])
 @login_required
+@query_budget(1)
+@queued_write
 def add_batch():
     if request.method == 'POST':
         batch = Batch(
@@ -432,42 +816,76 @@ def add_batch():
             unit_price=float(request.form['unit_price'])
         )
         db.session.add(batch)
+        refresh_stock_balances([batch.medicine_id])
+        record_movement(ADJUST, batch.medicine_id, batch.id, int(batch.quantity), current_user.id,
+                        batch_number=batch.batch_number)
         db.session.commit()
         flash('Batch added successfully', 'success')
         return redirect(url_for('batches'))
-    medicines = Medicine.query.all()
-    return render_template('add_batch.html', medicines=medicines)
+    return render_template('add_batch.html')
 
 @app.route('/batch/<int:id>/edit', methods=['GET', 'POST'])
 @login_required
+@queued_write
 def edit_batch(id):
     batch = Batch.query.get_or_404(id)
     if request.method == 'POST':
+        previous_medicine_id = batch.medicine_id
+        previous_quantity = batch.quantity
+        # The quantity the form showed, when it posts one; otherwise the one read by this request,
+        # which only guards the moments between that read and the update below
+        expected_quantity = request.form.get('expected_quantity', type=int, default=previous_quantity)
+        quantity = int(request.form['quantity'])
         batch.batch_number = request.form['batch_number']
         batch.medicine_id = request.form['medicine_id']
-        batch.quantity = request.form['quantity']
         batch.expiration_date = datetime.strptime(request.form['expiration_date'], '%Y-%m-%d').date()
         batch.manufacturing_date = datetime.strptime(request.form['manufacturing_date'], '%Y-%m-%d').date()
         batch.unit_price = float(request.form['unit_price'])
+        # Only overwrite the quantity the user saw: a dispense or delivery committed in between
+        # would otherwise be lost, and the adjustment recorded below would not match the batch
+        if expected_quantity != previous_quantity or Batch.query.filter_by(
+                id=batch.id, quantity=previous_quantity).update({'quantity': quantity}) != 1:
+            db.session.rollback()
+            flash('The stock of this batch changed while you were editing it, please try again.', 'warning')
+            return redirect(url_for('batches'))
+        if quantity != previous_quantity:
+            db.session.add(StockTransaction(batch_id=batch.id, transaction_type='adjust',
+                                            quantity=quantity - previous_quantity,
+                                            performed_by=current_user.id, notes='Batch quantity edited'))
+        refresh_stock_balances([previous_medicine_id, batch.medicine_id])
+        if int(batch.medicine_id) == previous_medicine_id:
+            record_movement(ADJUST, previous_medicine_id, batch.id, quantity - previous_quantity,
+                            current_user.id, batch_number=batch.batch_number)
+        else:
+            # Moving a batch to another medicine takes its stock out of one and into the other
+            record_movement(REMOVE, previous_medicine_id, batch.id, -previous_quantity, current_user.id,
+                            batch_number=batch.batch_number)
+            record_movement(ADJUST, batch.medicine_id, batch.id, quantity, current_user.id,
+                            batch_number=batch.batch_number)
         db.session.commit()
         flash('Batch updated successfully', 'success')
         return redirect(url_for('batches'))
-    medicines = Medicine.query.all()
-    return render_template('edit_batch.html', batch=batch, medicines=medicines)
+    return render_template('edit_batch.html', batch=batch)
 
 @app.route('/batch/<int:id>/delete', methods=['POST'])
 @login_required
+@queued_write
 def delete_batch(id):
     batch = Batch.query.get_or_404(id)
     # Delete all stock transactions related to this batch first to avoid integrity error
     StockTransaction.query.filter_by(batch_id=batch.id).delete()
     db.session.delete(batch)
+    refresh_stock_balances([batch.medicine_id])
+    record_movement(REMOVE, batch.medicine_id, batch.id, -batch.quantity, current_user.id,
+                    batch_number=batch.batch_number)
     db.session.commit()
     flash('Batch deleted successfully', 'success')
     return redirect(url_for('batches'))
 
 @app.route('/supplier/add', methods=['GET', 'POST'])
 @login_required
+@query_budget(1)
+@queued_write
 def add_supplier():
     if request.method == 'POST':
         supplier = Supplier(
@@ -485,6 +903,8 @@ def add_supplier():
 
 @app.route('/supplier/<int:id>/edit', methods=['GET', 'POST'])
 @login_required
+@query_budget(2)
+@queued_write
 def edit_supplier(id):
     # Only admin and sub-admin can edit, employee cannot
     if current_user.role not in ['admin', 'sub-admin']:
@@ -504,6 +924,7 @@ def edit_supplier(id):
 
 @app.route('/supplier/<int:id>/delete', methods=['POST'])
 @login_required
+@queued_write
 def delete_supplier(id):
     # Only admin can delete, sub-admin cannot
     if current_user.role != 'admin':
@@ -524,6 +945,8 @@ def delete_supplier(id):
 
 @app.route('/order/add', methods=['GET', 'POST'])
 @login_required
+@query_budget(2)
+@queued_write
 def add_order():
     if request.method == 'POST':
         supplier_ids = request.form.getlist('supplier_id[]')
@@ -569,273 +992,153 @@ def add_order():
         db.session.commit()
         flash('Order created successfully.', 'success')
         return redirect(url_for('orders'))
-    suppliers = Supplier.query.all()
-    medicines = Medicine.query.all()
-    return render_template('add_order.html', suppliers=suppliers, medicines=medicines)
+    # Not run when the supplier options come from the fragment cache
+    suppliers = Supplier.query
+    return render_template('add_order.html', suppliers=suppliers,
+                           suppliers_version=fragment_cache.version('supplier'))
 
 @app.route('/download-purchase-history', methods=['GET'])
 @login_required
 def download_purchase_history():
-    # Get filter from query string: 'today' or 'all'
-    filter_type = request.args.get('filter', 'all')
-    query = StockTransaction.query.order_by(StockTransaction.transaction_date.desc())
-    if filter_type == 'today':
-        today = datetime.now().date()
-        query = query.filter(func.date(StockTransaction.transaction_date) == today)
-    transactions = query.all()
-
-    # Generate visually appealing PDF
-    buffer = BytesIO()
-    p = canvas.Canvas(buffer, pagesize=letter)
-    width, height = letter
-
-    # Header
-    p.setFillColorRGB(0.13, 0.45, 0.71)  # Blue header
-    p.rect(0, height - 70, width, 70, fill=1, stroke=0)
-    p.setFillColorRGB(1, 1, 1)
-    p.setFont("Helvetica-Bold", 22)
-    p.drawString(50, height - 45, "RHU Inventory Transaction History")
-    p.setFont("Helvetica", 12)
-    p.drawString(50, height - 65, f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    p.drawRightString(width - 50, height - 65, f"Filter: {'Today' if filter_type == 'today' else 'All'}")
-
-    # Table header styling
-    y = height - 90
-    p.setFillColorRGB(0.9, 0.9, 0.9)
-    p.rect(40, y - 5, width - 80, 25, fill=1, stroke=0)
-    p.setFillColorRGB(0.13, 0.45, 0.71)
-    p.setFont("Helvetica-Bold", 11)
-    p.drawString(45, y + 10, "Date")
-    p.drawString(110, y + 10, "Medicine")
-    p.drawString(220, y + 10, "Batch")
-    p.drawString(280, y + 10, "Type")
-    p.drawString(325, y + 10, "Qty")
-    p.drawString(360, y + 10, "Unit Price")
-    p.drawString(430, y + 10, "Total Price")
-    p.drawString(510, y + 10, "By")
-    p.drawString(570, y + 10, "Role")
-    # Draw a visible line under the table header
-    p.setStrokeColorRGB(0.13, 0.45, 0.71)
-    p.setLineWidth(1.5)
-    p.line(40, y - 2, width - 40, y - 2)
-    y -= 25  # More spacing after header
-
-    # Table rows
-    p.setFont("Helvetica", 10)
-    alt = False
-    for tx in transactions:
-        if y < 60:
-            p.showPage()
-            # Redraw header and table header on new page
-            p.setFillColorRGB(0.13, 0.45, 0.71)
-            p.rect(0, height - 70, width, 70, fill=1, stroke=0)
-            p.setFillColorRGB(1, 1, 1)
-            p.setFont("Helvetica-Bold", 22)
-            p.drawString(50, height - 45, "RHU Inventory Transaction History")
-            p.setFont("Helvetica", 12)
-            p.drawString(50, height - 65, f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-            p.drawRightString(width - 50, height - 65, f"Filter: {'Today' if filter_type == 'today' else 'All'}")
-            y = height - 90
-            p.setFillColorRGB(0.9, 0.9, 0.9)
-            p.rect(40, y - 5, width - 80, 25, fill=1, stroke=0)
-            p.setFillColorRGB(0.13, 0.45, 0.71)
-            p.setFont("Helvetica-Bold", 11)
-            p.drawString(45, y + 10, "Date")
-            p.drawString(110, y + 10, "Medicine")
-            p.drawString(220, y + 10, "Batch")
-            p.drawString(280, y + 10, "Type")
-            p.drawString(325, y + 10, "Qty")
-            p.drawString(360, y + 10, "Unit Price")
-            p.drawString(430, y + 10, "Total Price")
-            p.drawString(510, y + 10, "By")
-            p.drawString(570, y + 10, "Role")
-            p.setStrokeColorRGB(0.13, 0.45, 0.71)
-            p.setLineWidth(1.5)
-            p.line(40, y - 2, width - 40, y - 2)
-            y -= 25
-            p.setFont("Helvetica", 10)
-
-        # Alternate row color
-        if alt:
-            p.setFillColorRGB(0.96, 0.98, 1)
-            p.rect(40, y - 2, width - 80, 18, fill=1, stroke=0)
-        alt = not alt
-
-        # Data extraction
-        date_str = tx.transaction_date.strftime('%Y-%m-%d\n%H:%M')
-        medicine = tx.batch.medicine.name if tx.batch and tx.batch.medicine else "N/A"
-        batch_number = tx.batch.batch_number if tx.batch else "N/A"
-        tx_type = tx.transaction_type.upper()
-        qty = str(tx.quantity)
-        unit_price = f"{getattr(tx.batch, 'unit_price', 0):,.2f}" if tx.batch else "0.00"
-        try:
-            total_price = f"{float(unit_price.replace(',', '')) * tx.quantity:,.2f}"
-        except Exception:
-            total_price = "0.00"
-        username = tx.user.username if hasattr(tx, 'user') and tx.user else str(tx.performed_by)
-        role = tx.user.role if hasattr(tx, 'user') and tx.user and hasattr(tx.user, 'role') else "N/A"
-
-        # Type color
-        if tx_type == "IN":
-            p.setFillColorRGB(0.2, 0.7, 0.2)  # Green
-        elif tx_type == "OUT":
-            p.setFillColorRGB(0.85, 0.2, 0.2)  # Red
-        else:
-            p.setFillColorRGB(0.2, 0.2, 0.2)  # Gray
-
-        # Draw columns with more spacing and vertical lines
-        col_x = [45, 110, 220, 280, 325, 360, 430, 510, 570, width - 40]
-        p.setFont("Helvetica", 10)
-        p.setFillColorRGB(0, 0, 0)
-        p.drawRightString(col_x[1] - 5, y + 8, date_str)  # Date (right-aligned, multi-line)
-        p.drawString(col_x[1] + 2, y + 8, medicine)
-        p.drawString(col_x[2], y + 8, batch_number)
-        p.setFont("Helvetica-Bold", 10)
-        if tx_type == "IN":
-            p.setFillColorRGB(0.2, 0.7, 0.2)
-        elif tx_type == "OUT":
-            p.setFillColorRGB(0.85, 0.2, 0.2)
-        else:
-            p.setFillColorRGB(0.2, 0.2, 0.2)
-        p.drawString(col_x[3], y + 8, tx_type)
-        p.setFont("Helvetica", 10)
-        p.setFillColorRGB(0, 0, 0)
-        p.drawString(col_x[4], y + 8, qty)
-        p.drawRightString(col_x[5] + 55, y + 8, unit_price)
-        p.drawRightString(col_x[6] + 70, y + 8, total_price)
-        p.drawString(col_x[7], y + 8, username)
-        p.drawString(col_x[8], y + 8, role)
-
-        # Draw vertical lines for columns
-        p.setStrokeColorRGB(0.7, 0.7, 0.7)
-        p.setLineWidth(0.5)
-        for x in col_x:
-            p.line(x - 5, y - 2, x - 5, y + 16)
-
-        y -= 20  # Increased row height for clarity
-
-    # Footer
-    p.setFillColorRGB(0.13, 0.45, 0.71)
-    p.rect(0, 0, width, 30, fill=1, stroke=0)
-    p.setFillColorRGB(1, 1, 1)
-    p.setFont("Helvetica", 10)
-    p.drawString(50, 12, "RHU Inventory System | Transaction History Report")
-    p.drawRightString(width - 50, 12, f"Page 1")
-
-    p.save()
-    buffer.seek(0)
-    filename = f"transaction_history_{filter_type}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-    return send_file(buffer, as_attachment=True, download_name=filename, mimetype='application/pdf')
+    # Get filter from query string: 'today', 'week', 'month' or 'all', or explicit from/to dates
+    try:
+        params = report_params('history', request.args)
+    except ValueError as e:
+        flash(f'Invalid report range: {e}', 'danger')
+        return redirect(url_for('dashboard'))
+
+    # Served from the report cache while no transaction, batch, medicine or user changed
+    path = report_cache.get_or_render('history', params)
+    return send_file(path, as_attachment=True, download_name=report_filename('history', params), mimetype='application/pdf')
 
 @app.route('/report/today-total')
 @login_required
 def report_today_total():
     """Generate PDF report for total items stored today (StockTransaction type 'in'), total stock per item, supplier name, and generic name"""
-    today = datetime.now().date()
-    # Get all 'in' transactions for today
-    transactions = StockTransaction.query.filter(
-        func.date(StockTransaction.transaction_date) == today,
-        StockTransaction.transaction_type == 'in'
-    ).all()
-    total_quantity = sum(tx.quantity for tx in transactions)
+    params = report_params('today-total', request.args)
+    path = report_cache.get_or_render('today-total', params)
+    return send_file(path, as_attachment=True, download_name=report_filename('today-total', params), mimetype='application/pdf')
+
+def _report_job_for_user(job_id):
+    """Look up a report job the current user may see, admins see every job"""
+    job = report_jobs.get(job_id)
+    if job is None or (job.user_id != current_user.id and current_user.role != 'admin'):
+        return None
+    return job
+
+def _report_job_json(job):
+    data = job.to_dict()
+    data['status_url'] = url_for('report_job_status', job_id=job.id)
+    if job.status == DONE:
+        data['download_url'] = url_for('report_job_download', job_id=job.id)
+    return data
+
+@app.route('/reports/jobs', methods=['GET', 'POST'])
+@login_required
+@query_budget(1)
+def report_job_list():
+    """List the current user's report jobs, or submit a new one (report=history|today-total)"""
+    if request.method == 'GET':
+        return jsonify([_report_job_json(job) for job in report_jobs.jobs_for(current_user.id)])
+    args = request.get_json(silent=True) or request.form
+    report_type = args.get('report', 'history')
+    try:
+        params = report_params(report_type, args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        job = report_jobs.submit(current_user.id, report_type, params)
+    except TooManyReportJobs as e:
+        return jsonify({'error': str(e)}), 429
+    return jsonify(_report_job_json(job)), 202
 
-    # Get total stock per medicine, supplier, and generic name
-    stock_per_medicine = db.session.query(
-        Medicine.generic_name,
-        Medicine.name,
-        Supplier.name.label('supplier_name'),
-        func.sum(Batch.quantity).label('total_quantity')
-    ).join(Supplier, Medicine.supplier_id == Supplier.id).join(Batch).group_by(Medicine.generic_name, Medicine.name, Supplier.name).all()
-
-    # Generate PDF
-    buffer = BytesIO()
-    p = canvas.Canvas(buffer, pagesize=letter)
-    width, height = letter
-
-    # Header
-    p.setFillColorRGB(0.13, 0.45, 0.71)
-    p.rect(0, height - 70, width, 70, fill=1, stroke=0)
-    p.setFillColorRGB(1, 1, 1)
-    p.setFont("Helvetica-Bold", 22)
-    p.drawString(50, height - 45, "RHU Inventory - Today's Stored Items")
-    p.setFont("Helvetica", 12)
-    p.drawString(50, height - 65, f"Date: {today.strftime('%Y-%m-%d')}")
-
-    # Body
-    y = height - 120
-    p.setFont("Helvetica-Bold", 14)
-    p.setFillColorRGB(0, 0, 0)
-    p.drawString(50, y, f"Total Items Stored Today: {total_quantity}")
-
-    y -= 25
-    p.setFont("Helvetica-Bold", 12)
-    p.drawString(50, y, "Total Current Stock per Item:")
-    y -= 20
-    p.setFont("Helvetica", 10)
-    p.drawString(50, y, "Generic Name")
-    p.drawString(170, y, "Medicine (Brand Name)")
-    p.drawString(320, y, "Supplier")
-    p.drawString(450, y, "Total Stock")
-    y -= 15
-    p.setStrokeColorRGB(0.13, 0.45, 0.71)
-    p.line(50, y, width - 50, y)
-    y -= 10
-
-    for item in stock_per_medicine:
-        if y < 60:
-            p.showPage()
-            y = height - 80
-        p.setFont("Helvetica", 10)
-        p.drawString(50, y, str(item.generic_name))
-        p.drawString(170, y, str(item.name))
-        p.drawString(320, y, str(item.supplier_name))
-        p.drawString(450, y, str(item.total_quantity))
-        y -= 15
-
-    y -= 20
-    p.setFont("Helvetica-Bold", 12)
-    p.drawString(50, y, "Breakdown of Today's Added Items:")
-    y -= 20
-    p.setFont("Helvetica", 10)
-    p.drawString(50, y, "Generic Name")
-    p.drawString(170, y, "Medicine")
-    p.drawString(320, y, "Batch")
-    p.drawString(420, y, "Quantity")
-    y -= 15
-    p.setStrokeColorRGB(0.13, 0.45, 0.71)
-    p.line(50, y, width - 50, y)
-    y -= 10
-
-    for tx in transactions:
-        if y < 60:
-            p.showPage()
-            y = height - 80
-        generic_name = tx.batch.medicine.generic_name if tx.batch and tx.batch.medicine else "N/A"
-        medicine = tx.batch.medicine.name if tx.batch and tx.batch.medicine else "N/A"
-        batch_number = tx.batch.batch_number if tx.batch else "N/A"
-        qty = tx.quantity
-        p.setFont("Helvetica", 10)
-        p.drawString(50, y, str(generic_name))
-        p.drawString(170, y, str(medicine))
-        p.drawString(320, y, str(batch_number))
-        p.drawString(420, y, str(qty))
-        y -= 15
-
-    # Footer
-    p.setFillColorRGB(0.13, 0.45, 0.71)
-    p.rect(0, 0, width, 30, fill=1, stroke=0)
-    p.setFillColorRGB(1, 1, 1)
-    p.setFont("Helvetica", 10)
-    p.drawString(50, 12, "RHU Inventory System | Today's Stored Items Report")
-    p.drawRightString(width - 50, 12, f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-
-    p.save()
-    buffer.seek(0)
-    filename = f"today_total_stored_{today.strftime('%Y%m%d')}.pdf"
-    return send_file(buffer, as_attachment=True, download_name=filename, mimetype='application/pdf')
+@app.route('/reports/jobs/<job_id>')
+@login_required
+def report_job_status(job_id):
+    job = _report_job_for_user(job_id)
+    if job is None:
+        return jsonify({'error': 'Report job not found'}), 404
+    return jsonify(_report_job_json(job))
+
+@app.route('/reports/jobs/<job_id>/download')
+@login_required
+def report_job_download(job_id):
+    job = _report_job_for_user(job_id)
+    if job is None or job.status != DONE or not os.path.exists(job.path):
+        flash('That report is not available. It may have expired, please generate it again.', 'warning')
+        return redirect(url_for('reports'))
+    return send_file(job.path, as_attachment=True, download_name=job.filename, mimetype='application/pdf')
+
+@app.route('/reports/jobs/<job_id>/cancel', methods=['POST'])
+@login_required
+def report_job_cancel(job_id):
+    job = _report_job_for_user(job_id)
+    if job is None:
+        return jsonify({'error': 'Report job not found'}), 404
+    report_jobs.cancel(job.id)
+    return jsonify(_report_job_json(job))
+
+@app.route('/scheduler/jobs')
+@login_required
+@query_budget(4)
+def scheduler_jobs():
+    """Scheduler leader and last run, outcome and next run of every scheduled job"""
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Only admins can view scheduled jobs'}), 403
+    return jsonify(job_scheduler.status())
+
+@app.route('/users/cache')
+@login_required
+@query_budget(1)
+def user_cache_stats():
+    """Hit/miss counters of the logged in user identity cache"""
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Only admins can view cache statistics'}), 403
+    return jsonify(user_cache.stats())
+
+@app.route('/reports/cache')
+@login_required
+@query_budget(1)
+def report_cache_stats():
+    """Hit/miss counters and size of the PDF report cache"""
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Only admins can view cache statistics'}), 403
+    return jsonify(report_cache.stats())
+
+@app.route('/fragments/cache')
+@login_required
+@query_budget(1)
+def fragment_cache_stats():
+    """Hit/miss counters and size of the template fragment cache"""
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Only admins can view cache statistics'}), 403
+    return jsonify(fragment_cache.stats())
+
+@app.route('/import', methods=['POST'])
+@login_required
+def import_data():
+    """Bulk import an uploaded CSV/NDJSON file (form fields: file, kind, format, dry_run), returns a per-row report"""
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Only admins can import data'}), 403
+    upload = request.files.get('file')
+    kind = request.form.get('kind')
+    if upload is None or kind not in IMPORT_KINDS:
+        return jsonify({'error': f"Send a file and a kind ({', '.join(sorted(IMPORT_KINDS))})"}), 400
+    dry_run = request.form.get('dry_run', '').lower() in ('1', 'true', 'yes', 'on')
+    importer = Importer(dry_run=dry_run)
+    try:
+        report = importer.import_upload(upload, kind, request.form.get('format'))
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        # A file that cannot be read to the end saves nothing; the report shows the rows read before it
+        db.session.rollback()
+        report = importer.reports[-1].to_dict() if importer.reports else {}
+        return jsonify(dict(report, error=str(e), inserted=0, dry_run=dry_run)), 400
+    importer.finish()
+    return jsonify(dict(report.to_dict(), dry_run=dry_run))
 
 @app.route('/clear-transactions', methods=['POST'])
 @login_required
+@queued_write
 def clear_transactions():
     # Only admin can clear all transactions
     if current_user.role != 'admin':
@@ -848,6 +1151,7 @@ def clear_transactions():
 
 @app.route('/clear-orders', methods=['POST'])
 @login_required
+@queued_write
 def clear_orders():
     # Only admin can clear all orders
     if current_user.role != 'admin':
@@ -863,6 +1167,7 @@ def clear_orders():
 
 @app.route('/batch/<int:id>/delete-medicine', methods=['POST'])
 @login_required
+@queued_write
 def delete_medicine_from_batch(id):
     # Only admin and sub-admin can delete medicines from batch
     if current_user.role not in ['admin', 'sub-admin']:
@@ -886,6 +1191,8 @@ def delete_medicine_from_batch(id):
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+        # Bring databases created by older versions up to the current schema
+        upgrade(db.engine)
         # Create default admin user if it doesn't exist
         if not User.query.filter_by(username='admin').first():
             admin = User(
@@ -916,10 +1223,13 @@ if __name__ == '__main__':
             db.session.add(bot_user)
 
         db.session.commit()
+        # Backfill the stock balance projection for databases created before it existed
+        if StockBalance.query.count() != Medicine.query.count():
+            rebuild_stock_balances()
         # Start the scheduler only if not already running
         try:
-            if not getattr(scheduler, 'running', False):
-                scheduler.start()
+            if not job_scheduler.running:
+                job_scheduler.start()
         except Exception as e:
             print(f"Error starting scheduler: {e}")
     app.run(debug=True, port=5000)
\ No newline at end of file
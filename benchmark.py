@@ -0,0 +1,388 @@
+"""Route benchmarks at several synthetic data scales, compared against stored baselines
+
+    python benchmark.py --scales tiny,small
+    python benchmark.py --scales small --update-baseline
+    python benchmark.py --scales medium --set transactions=2000000 --repeats 50
+
+Each scale runs in a fresh SQLite database in its own process (so peak
+memory is per scale), filled by synthetic.generate(). Every route of app.py
+is requested through the Flask test client: --repeats timed requests after a
+warm-up, then one more under tracemalloc for its peak allocation. Results
+are p50/p95/p99 latency, the SQL statement count and peak memory per route.
+A route slower than its baseline p95 by more than --tolerance (and 5 ms),
+running more queries, or allocating more than 1.5x its baseline peak is a
+regression and makes the run exit with status 1, as does any route that
+fails, any route of app.py the suite does not know about, and any scale
+without a stored baseline (record one with --update-baseline on the machine
+the comparisons will run on, since latencies are only comparable there).
+"""
+import argparse
+import io
+import json
+import math
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+LATENCY_SLACK_MS = 5
+MEMORY_FACTOR = 1.5
+
+# Routes that are not benchmarked, and why
+SKIPPED = {
+    'static': 'static files are served by the web server',
+    'api_stock_events': 'an endless event stream',
+    'logout': 'ends the benchmark session',
+    'edit_batch': 'edit_batch.html does not exist yet',
+    'clear_orders': 'destroys the data set',
+    'clear_transactions': 'destroys the data set',
+    'delete_medicine': 'destroys the data set',
+    'delete_medicine_from_batch': 'destroys the data set',
+    'delete_supplier': 'destroys the data set',
+    'delete_batch': 'destroys the data set',
+}
+
+
+def _pending_order(ctx):
+    return ctx['pending_orders'].pop()
+
+
+def _stock_line(ctx):
+    return {'medicine_id[]': [str(ctx['stocked_medicine'])], 'quantity[]': ['1']}
+
+
+def _batch_form(ctx):
+    ctx['serial'] += 1
+    return {'batch_number': f"BENCH-{ctx['serial']}", 'medicine_id': str(ctx['medicine_id']), 'quantity': '25',
+            'expiration_date': ctx['far_expiry'], 'manufacturing_date': ctx['today'], 'unit_price': '2.5'}
+
+
+def _medicine_form(ctx):
+    return {'name': f"Bench medicine {ctx['medicine_id']}", 'generic_name': 'Paracetamol', 'category': 'Analgesics',
+            'unit': 'Tablets', 'supplier_id': str(ctx['supplier_id'])}
+
+
+def _supplier_form(ctx):
+    return {'name': f"Supplier {ctx['supplier_id']:05d}", 'contact_person': 'Bench', 'phone': '0912345678',
+            'email': 'bench-supplier@example.com', 'address': '1 Main Street'}
+
+
+def _order_form(ctx):
+    return {'supplier_id[]': [str(ctx['supplier_id'])], 'medicine_id[]': [str(ctx['medicine_id'])],
+            'quantity[]': ['10'], 'unit_price[]': ['1.5']}
+
+
+def _import_form(ctx):
+    ctx['serial'] += 1
+    csv_data = f"name,contact_person\nImported supplier {ctx['serial']},Bench\n".encode()
+    return {'kind': 'suppliers', 'format': 'csv', 'file': (io.BytesIO(csv_data), 'suppliers.csv')}
+
+
+def _register_form(ctx):
+    ctx['serial'] += 1
+    return {'username': f"bench-new-{ctx['serial']}", 'password': 'bench', 'email': f"new{ctx['serial']}@example.com",
+            'role': 'employee'}
+
+
+# (method, path, options): path may use {placeholders} of the context or be a function of it. Options:
+# form/json (dict or function of the context), statuses other than 200, 201, 202, 302 and 304 that are fine,
+# repeats for routes too slow by design (password hashing) to time --repeats times, and orders for routes
+# that use up a pending order per request.
+ROUTES = [
+    ('GET', '/', {}),
+    ('GET', '/login', {}),
+    ('POST', '/login', {'form': {'username': 'bench', 'password': 'bench'}, 'repeats': 3}),
+    ('GET', '/register', {}),
+    ('POST', '/register', {'form': _register_form, 'repeats': 3}),
+    ('GET', '/forgot-password', {}),
+    ('POST', '/forgot-password', {'form': {'email': 'nobody@example.com'}}),
+    ('GET', '/dashboard', {}),
+    ('GET', '/inventory', {}),
+    ('GET', '/inventory?q=Para&sort=stock&dir=desc', {}),
+    ('GET', '/batches', {}),
+    ('GET', '/batches?sort=quantity&dir=desc', {}),
+    ('GET', '/orders', {}),
+    ('GET', '/orders?status=pending', {}),
+    ('GET', '/suppliers', {}),
+    ('GET', '/reports', {}),
+    ('GET', '/api/stock-levels', {}),
+    ('GET', '/api/stock-levels?since={stock_version}', {}),
+    ('GET', '/api/medicines', {}),
+    ('GET', '/api/medicines/search?q=para', {}),
+    ('GET', '/api/medicines/search?q=am&in_stock=1', {}),
+    ('GET', '/api/medicines/search', {}),
+    ('GET', '/api/batches', {}),
+    ('GET', '/api/orders', {}),
+    ('GET', '/api/suppliers', {}),
+    ('GET', '/api/alerts', {}),
+    ('GET', '/medicine/add', {}),
+    ('POST', '/medicine/add', {'form': _medicine_form}),
+    ('GET', '/medicine/{medicine_id}/edit', {}),
+    ('POST', '/medicine/{medicine_id}/edit', {'form': _medicine_form}),
+    ('GET', '/batch/add', {}),
+    ('POST', '/batch/add', {'form': _batch_form}),
+    ('GET', '/supplier/add', {}),
+    ('POST', '/supplier/add', {'form': _supplier_form}),
+    ('GET', '/supplier/{supplier_id}/edit', {}),
+    ('POST', '/supplier/{supplier_id}/edit', {'form': _supplier_form}),
+    ('GET', '/order/add', {}),
+    ('POST', '/order/add', {'form': _order_form}),
+    ('POST', lambda ctx: f'/order/{_pending_order(ctx)}/process', {'orders': True}),
+    ('POST', lambda ctx: f'/order/{_pending_order(ctx)}/deliver', {'orders': True}),
+    ('POST', lambda ctx: f'/order/{_pending_order(ctx)}/cancel', {'orders': True}),
+    ('POST', '/orders/process', {'form': lambda ctx: {'order_id[]': [str(_pending_order(ctx))]}, 'orders': True}),
+    ('POST', '/api/orders/receive', {'json': lambda ctx: {'order_ids': [_pending_order(ctx)]}, 'orders': True}),
+    ('POST', '/dispense', {'form': _stock_line}),
+    ('POST', '/api/dispense', {'json': lambda ctx: {'items': [{'medicine_id': ctx['stocked_medicine'],
+                                                               'quantity': 1}]}, 'statuses': (409,)}),
+    ('GET', '/download-purchase-history?filter=today', {}),
+    ('GET', '/download-purchase-history?filter=week', {}),
+    ('GET', '/report/today-total', {}),
+    ('GET', '/reports/jobs', {}),
+    ('POST', '/reports/jobs', {'form': {'report': 'today-total'}, 'statuses': (429,)}),
+    ('GET', '/reports/jobs/{job_id}', {}),
+    ('GET', '/reports/jobs/{job_id}/download', {}),
+    ('POST', '/reports/jobs/{job_id}/cancel', {}),
+    ('GET', '/reports/cache', {}),
+    ('GET', '/users/cache', {}),
+    ('GET', '/fragments/cache', {}),
+    ('GET', '/scheduler/jobs', {}),
+    ('GET', '/metrics', {}),
+    ('POST', '/import', {'form': _import_form}),
+]
+OK_STATUSES = (200, 201, 202, 302, 304)
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def _context(app):
+    """Ids and values the ROUTES placeholders refer to"""
+    from datetime import date, timedelta
+    from models import db, User, Medicine, Supplier, Order, StockBalance
+    from data_versions import current_versions
+    from stock import STOCK_VERSION
+    from report_jobs import report_jobs
+    with app.app_context():
+        stocked = db.session.query(StockBalance.medicine_id).order_by(StockBalance.available.desc()).first()
+        pending = [order_id for (order_id,) in db.session.query(Order.id).filter_by(status='pending')
+                   .order_by(Order.id.desc())]
+        user = User.query.filter_by(username='bench').one()
+        job = report_jobs.submit(user.id, 'today-total', {'date': date.today().isoformat()})
+        return {
+            'medicine_id': db.session.query(Medicine.id).order_by(Medicine.id).first()[0],
+            'stocked_medicine': stocked[0],
+            'supplier_id': db.session.query(Supplier.id).order_by(Supplier.id).first()[0],
+            'pending_orders': pending,
+            'stock_version': max(current_versions([STOCK_VERSION])[STOCK_VERSION] - 5, 1),
+            'job_id': job.id,
+            'today': date.today().isoformat(),
+            'far_expiry': (date.today() + timedelta(days=720)).isoformat(),
+            'serial': 0,
+        }
+
+
+def _request(client, method, path, options, ctx):
+    if callable(path):
+        path = path(ctx)
+    path = path.format(**ctx)
+    kwargs = {}
+    for key in ('form', 'json'):
+        value = options.get(key)
+        if value is not None:
+            value = value(ctx) if callable(value) else value
+            kwargs['data' if key == 'form' else 'json'] = value
+    return client.open(path, method=method, **kwargs)
+
+
+def check_coverage(app):
+    """Endpoints of the app that neither ROUTES nor SKIPPED mention"""
+    adapter = app.url_map.bind('localhost')
+    covered = set()
+    sample = {'pending_orders': [1] * len(ROUTES), 'medicine_id': 1, 'stocked_medicine': 1, 'supplier_id': 1,
+              'stock_version': 1, 'job_id': 'x', 'today': '', 'far_expiry': '', 'serial': 0}
+    for method, path, options in ROUTES:
+        path = path(sample) if callable(path) else path.format(**sample)
+        covered.add(adapter.match(path.split('?')[0], method=method)[0])
+    return sorted(set(rule.endpoint for rule in app.url_map.iter_rules()) - covered - set(SKIPPED))
+
+
+def run_scale(scale, overrides, repeats, seed):
+    """Seed a fresh database at DATABASE_URL and time every route, returns the results dict"""
+    from app import app
+    from models import db
+    from migrations import upgrade
+    from synthetic import generate, scale_counts
+    scratch = tempfile.mkdtemp(prefix='rhu-bench-')
+    app.config.update(TESTING=False, QUERY_BUDGET_ENFORCE=False, QUERY_BUDGET_HEADER=True,
+                      REPORT_CACHE_DIR=os.path.join(scratch, 'report_cache'),
+                      REPORT_JOB_DIR=os.path.join(scratch, 'report_jobs'))
+    counts = scale_counts(scale, **overrides)
+    with app.app_context():
+        db.create_all()
+        upgrade(db.engine)
+        # Every run of an order route receives, delivers or cancels one pending order
+        needed = sum(1 for _, _, options in ROUTES if options.get('orders')) * (repeats + 2)
+        rows, seed_seconds = generate(seed=seed, pending=needed, **counts)
+    print(f"[{scale}] seeded {sum(rows.values())} rows in {seed_seconds:.1f}s", file=sys.stderr)
+
+    ctx = _context(app)
+    client = app.test_client()
+    response = client.post('/login', data={'username': 'bench', 'password': 'bench'})
+    assert response.status_code == 302, 'benchmark user could not log in'
+    results = {}
+    for method, path, options in ROUTES:
+        label = f"{method} {path if isinstance(path, str) else path({'pending_orders': ['<id>']})}"
+        allowed = OK_STATUSES + tuple(options.get('statuses', ()))
+        timings = []
+        queries = 0
+        failures = []
+        try:
+            for attempt in range(min(repeats, options.get('repeats', repeats)) + 1):
+                started = time.perf_counter()
+                response = _request(client, method, path, options, ctx)
+                elapsed = (time.perf_counter() - started) * 1000
+                response.close()
+                if response.status_code not in allowed:
+                    failures.append(response.status_code)
+                if attempt:
+                    timings.append(elapsed)
+                queries = max(queries, int(response.headers.get('X-Query-Count', 0)))
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+            _request(client, method, path, options, ctx).close()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        except IndexError:
+            results[label] = {'error': 'ran out of pending orders, raise the orders count'}
+            continue
+        results[label] = {
+            'p50_ms': round(percentile(timings, 0.50), 3),
+            'p95_ms': round(percentile(timings, 0.95), 3),
+            'p99_ms': round(percentile(timings, 0.99), 3),
+            'queries': queries,
+            'peak_kb': round(peak / 1024, 1),
+        }
+        if failures:
+            results[label]['error'] = f'HTTP {sorted(set(failures))}'
+    shutil.rmtree(scratch, ignore_errors=True)
+    return {
+        'scale': scale,
+        'counts': counts,
+        'seed_seconds': round(seed_seconds, 2),
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'uncovered': check_coverage(app),
+        'routes': results,
+    }
+
+
+def compare(result, baseline, tolerance):
+    """Regression messages of one scale's results against its baseline"""
+    problems = []
+    for label, now in result['routes'].items():
+        if 'error' in now:
+            problems.append(f"{label}: {now['error']}")
+            continue
+        before = baseline.get('routes', {}).get(label)
+        if not before or 'error' in before:
+            continue
+        if now['p95_ms'] > before['p95_ms'] * (1 + tolerance) + LATENCY_SLACK_MS:
+            problems.append(f"{label}: p95 {now['p95_ms']}ms, baseline {before['p95_ms']}ms")
+        if now['queries'] > before['queries']:
+            problems.append(f"{label}: {now['queries']} queries, baseline {before['queries']}")
+        if now['peak_kb'] > before['peak_kb'] * MEMORY_FACTOR:
+            problems.append(f"{label}: peak {now['peak_kb']}KB, baseline {before['peak_kb']}KB")
+    for endpoint in result['uncovered']:
+        problems.append(f"{endpoint}: route is not benchmarked, add it to ROUTES or SKIPPED in benchmark.py")
+    return problems
+
+
+def print_table(result):
+    print(f"\n== {result['scale']}: {result['counts']} (seeded in {result['seed_seconds']}s, "
+          f"max RSS {result['max_rss_kb'] // 1024}MB)")
+    print(f"{'route':60} {'p50':>9} {'p95':>9} {'p99':>9} {'queries':>7} {'peak KB':>9}")
+    for label, row in result['routes'].items():
+        if 'p50_ms' in row:
+            print(f"{label[:60]:60} {row['p50_ms']:9.2f} {row['p95_ms']:9.2f} {row['p99_ms']:9.2f} "
+                  f"{row['queries']:7} {row['peak_kb']:9.1f}" + (f"  {row['error']}" if 'error' in row else ''))
+        else:
+            print(f"{label[:60]:60} {row['error']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', default='tiny,small', help='Comma separated scales from synthetic.SCALES')
+    parser.add_argument('--set', action='append', default=[], metavar='COUNT=N',
+                        help='Override a row count of every scale, e.g. transactions=2000000')
+    parser.add_argument('--repeats', type=int, default=20, help='Timed requests per route')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--tolerance', type=float, default=0.5, help='Allowed p95 slowdown as a fraction')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--update-baseline', action='store_true', help='Store these results as the baseline')
+    parser.add_argument('--output', help='Also write the results as JSON to this file')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    overrides = dict(item.split('=', 1) for item in args.set)
+
+    if args.worker:
+        scale, output = args.worker.split(':', 1)
+        result = run_scale(scale, overrides, args.repeats, args.seed)
+        with open(output, 'w') as out:
+            json.dump(result, out)
+        return 0
+
+    results = {}
+    for scale in args.scales.split(','):
+        with tempfile.TemporaryDirectory(prefix='rhu-bench-') as scratch:
+            output = os.path.join(scratch, 'result.json')
+            env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(scratch, 'bench.db')}",
+                       SCHEDULER_AUTOSTART='0')
+            command = [sys.executable, os.path.abspath(__file__), '--worker', f'{scale}:{output}',
+                       '--repeats', str(args.repeats), '--seed', str(args.seed)]
+            for item in args.set:
+                command += ['--set', item]
+            subprocess.run(command, env=env, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+            with open(output) as result_file:
+                results[scale] = json.load(result_file)
+        print_table(results[scale])
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    if args.update_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as out:
+            json.dump(baseline, out, indent=2, sort_keys=True)
+        print(f"\nBaseline for {', '.join(results)} written to {args.baseline}")
+        return 0
+
+    problems = []
+    for scale, result in results.items():
+        if scale not in baseline:
+            problems.append(f"[{scale}] no baseline in {args.baseline}, run with --update-baseline to record one")
+            problems += [f"[{scale}] {message}" for message in compare(result, {}, args.tolerance)]
+            continue
+        problems += [f"[{scale}] {message}" for message in compare(result, baseline[scale], args.tolerance)]
+    if problems:
+        print('\nRegressions:')
+        for message in problems:
+            print(f'  {message}')
+        return 1
+    print('\nNo regressions')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+import functools
+from sqlalchemy import event
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from models import db, DataVersion
+
+# Per-table change counters.
+#
+# Every flush that inserts, updates or deletes rows, and every bulk
+# insert/update/delete statement run through the session, bumps the
+# DataVersion row of each table it touched. The bump runs on the same
+# connection, so it commits or rolls back together with the change itself.
+# Caches key their entries on these counters instead of re-reading the data.
+# Callbacks registered with on_commit hear about the changed tables once the
+# transaction commits, for caches that must not query to find out. A session
+# that is part of a write group (see write_queue.py) only commits a savepoint,
+# so its callbacks wait for the group's commit (after_durable_commit).
+
+# Tables whose changes nobody caches on, and the counter table itself
+UNTRACKED_TABLES = {'data_version', 'stock_balance'}
+
+# Session.info key of the list a write group collects its sessions' commit callbacks in
+DEFERRED_CALLBACKS = 'deferred_commit_callbacks'
+
+_commit_callbacks = []
+
+
+def on_commit(callback):
+    """Register callback(table names) to run after each commit that changed tracked tables"""
+    _commit_callbacks.append(callback)
+    return callback
+
+
+def bump_versions(connection, names):
+    """Increment the counters of the given tables on a connection"""
+    names = sorted(set(names) - UNTRACKED_TABLES)
+    if not names:
+        return
+    table = DataVersion.__table__
+    for name in names:
+        statement = insert(table).values(name=name, version=1)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.name],
+            set_={'version': table.c.version + 1}
+        )
+        connection.execute(statement)
+
+
+def next_version(name, connection=None):
+    """Increment one counter in the current transaction (or on connection) and return its new value"""
+    table = DataVersion.__table__
+    statement = insert(table).values(name=name, version=1).on_conflict_do_update(
+        index_elements=[table.c.name],
+        set_={'version': table.c.version + 1}
+    ).returning(table.c.version)
+    return (connection or db.session).execute(statement).scalar_one()
+
+
+def _record(session, names):
+    names = set(names) - UNTRACKED_TABLES
+    if names:
+        session.info.setdefault('changed_tables', set()).update(names)
+
+
+@event.listens_for(Session, 'after_flush')
+def _bump_flushed_tables(session, flush_context):
+    names = set()
+    for obj in session.new:
+        names.add(obj.__table__.name)
+    for obj in session.deleted:
+        names.add(obj.__table__.name)
+    for obj in session.dirty:
+        if session.is_modified(obj, include_collections=False):
+            names.add(obj.__table__.name)
+    _record(session, names)
+    bump_versions(session.connection(), names)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _bump_bulk_statement_tables(orm_execute_state):
+    statement = orm_execute_state.statement
+    if not getattr(statement, 'is_dml', False):
+        return
+    table = getattr(statement, 'table', None)
+    name = getattr(table, 'name', None)
+    if name:
+        _record(orm_execute_state.session, [name])
+        bump_versions(orm_execute_state.session.connection(), [name])
+
+
+def after_durable_commit(session, callback):
+    """Call callback() now, or when the write group of session commits"""
+    deferred = session.info.get(DEFERRED_CALLBACKS)
+    if deferred is None:
+        callback()
+    else:
+        deferred.append(callback)
+
+
+def _run_commit_callbacks(names):
+    for callback in _commit_callbacks:
+        callback(names)
+
+
+@event.listens_for(Session, 'after_commit')
+def _notify_commit(session):
+    names = session.info.pop('changed_tables', None)
+    if names:
+        after_durable_commit(session, functools.partial(_run_commit_callbacks, frozenset(names)))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_rolled_back(session):
+    session.info.pop('changed_tables', None)
+
+
+def current_versions(names=None):
+    """Return {table name: version} for the given tables (every tracked table when None)"""
+    query = db.session.query(DataVersion.name, DataVersion.version)
+    if names is not None:
+        query = query.filter(DataVersion.name.in_(list(names)))
+    versions = dict(query.all())
+    if names is not None:
+        for name in names:
+            versions.setdefault(name, 0)
+    return versions
+
+
+def watermark(names):
+    """A hashable snapshot of the given tables' versions, changes whenever one of them is written"""
+    versions = current_versions(names)
+    return tuple((name, versions[name]) for name in sorted(names))
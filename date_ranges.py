@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+
+# Shared date-range handling for transaction reports and history queries.
+#
+# Periods are turned into half-open [start, end) datetime ranges and compared
+# against the bare column, e.g. transaction_date >= start AND transaction_date < end.
+# Wrapping the column in func.date() instead would stop SQLite from using the
+# transaction_date indexes and scan the whole transaction log.
+
+PERIODS = {
+    'today': 'Today',
+    'week': 'This Week',
+    'month': 'This Month',
+    'all': 'All',
+}
+
+
+def parse_date(value):
+    """Parse a YYYY-MM-DD query parameter, raises ValueError on bad input"""
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def period_range(period, now=None):
+    """Return the (start, end) datetimes of a named period, (None, None) for 'all'"""
+    now = now or datetime.now()
+    start_of_day = datetime.combine(now.date(), datetime.min.time())
+    if period == 'today':
+        return start_of_day, start_of_day + timedelta(days=1)
+    if period == 'week':
+        start = start_of_day - timedelta(days=now.weekday())
+        return start, start + timedelta(days=7)
+    if period == 'month':
+        start = start_of_day.replace(day=1)
+        end = (start + timedelta(days=32)).replace(day=1)
+        return start, end
+    if period == 'all':
+        return None, None
+    raise ValueError(f"Unknown period: {period}")
+
+
+def resolve_range(period='all', date_from=None, date_to=None, now=None):
+    """Turn a named period or from/to dates into (start, end, label)
+
+    Explicit dates win over the period. date_to is inclusive, so the range ends
+    at midnight after it. Raises ValueError for unknown periods or bad dates.
+    """
+    if date_from or date_to:
+        start = datetime.combine(parse_date(date_from), datetime.min.time()) if date_from else None
+        end = datetime.combine(parse_date(date_to) + timedelta(days=1), datetime.min.time()) if date_to else None
+        if start and end and start >= end:
+            raise ValueError("The 'from' date must not be after the 'to' date")
+        label = f"{date_from or '...'} to {date_to or '...'}"
+        return start, end, label
+    start, end = period_range(period, now)
+    return start, end, PERIODS[period]
+
+
+def range_from_args(args, default_period='all'):
+    """Resolve the range requested by a request's query string (filter, from, to)"""
+    return resolve_range(
+        args.get('filter', default_period),
+        args.get('from') or None,
+        args.get('to') or None
+    )
+
+
+def apply_range(query, column, start, end):
+    """Restrict a query to start <= column < end, leaving open bounds unfiltered"""
+    if start is not None:
+        query = query.filter(column >= start)
+    if end is not None:
+        query = query.filter(column < end)
+    return query
@@ -0,0 +1,132 @@
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import insert
+from sqlalchemy.exc import OperationalError
+from models import db, Medicine, Batch, StockTransaction
+from stock import refresh_stock_balances
+from stock_events import record_movement, DISPENSE
+
+# First-expiry-first-out dispensing.
+#
+# All requested lines are allocated in one pass over a single query of the
+# usable batches (stocked, not expired) ordered by expiry. Each allocation is
+# then applied with a guarded UPDATE ... WHERE quantity >= n, so two
+# pharmacists dispensing the same batch at the same time can never drive it
+# negative: the loser's update matches no row, the transaction is rolled back
+# and the allocation is recomputed from fresh quantities.
+
+MAX_ATTEMPTS = 3
+
+
+class InsufficientStock(Exception):
+    """Raised when a medicine has fewer usable units than requested"""
+
+    def __init__(self, medicine_id, name, available, requested):
+        self.medicine_id = medicine_id
+        self.name = name
+        self.available = available
+        self.requested = requested
+        super().__init__(f'Not enough stock for {name}. Available: {available}, Requested: {requested}')
+
+
+class StockChanged(Exception):
+    """Raised when a batch kept changing under the allocator and it gave up retrying"""
+
+
+def merge_lines(lines):
+    """Sum (medicine_id, quantity) pairs per medicine, keeping first-seen order"""
+    merged = OrderedDict()
+    for medicine_id, quantity in lines:
+        if quantity <= 0:
+            raise ValueError('Quantities must be positive')
+        merged[medicine_id] = merged.get(medicine_id, 0) + quantity
+    return merged
+
+
+def allocate(requested):
+    """Plan FEFO allocations for {medicine_id: quantity}, raises InsufficientStock
+
+    Returns a list of dicts with medicine_id, batch_id, batch_number,
+    expiration_date and quantity, in dispensing order.
+    """
+    today = datetime.now().date()
+    batches = db.session.query(
+        Batch.id, Batch.medicine_id, Batch.batch_number, Batch.quantity, Batch.expiration_date
+    ).filter(
+        Batch.medicine_id.in_(list(requested)),
+        Batch.quantity > 0,
+        Batch.expiration_date >= today
+    ).order_by(Batch.medicine_id, Batch.expiration_date, Batch.id).all()
+
+    remaining = dict(requested)
+    allocations = []
+    for batch in batches:
+        need = remaining.get(batch.medicine_id, 0)
+        if need == 0:
+            continue
+        take = min(need, batch.quantity)
+        remaining[batch.medicine_id] = need - take
+        allocations.append({
+            'medicine_id': batch.medicine_id,
+            'batch_id': batch.id,
+            'batch_number': batch.batch_number,
+            'expiration_date': batch.expiration_date,
+            'quantity': take,
+        })
+
+    for medicine_id, short in remaining.items():
+        if short:
+            medicine = db.session.get(Medicine, medicine_id)
+            name = medicine.name if medicine else f'medicine #{medicine_id}'
+            requested_qty = requested[medicine_id]
+            raise InsufficientStock(medicine_id, name, requested_qty - short, requested_qty)
+    return sorted(allocations, key=lambda a: list(requested).index(a['medicine_id']))
+
+
+def _apply(allocations, user_id, notes):
+    table = Batch.__table__
+    for allocation in allocations:
+        result = db.session.execute(
+            table.update()
+            .where(table.c.id == allocation['batch_id'], table.c.quantity >= allocation['quantity'])
+            .values(quantity=table.c.quantity - allocation['quantity'])
+        )
+        if result.rowcount != 1:
+            return False
+    db.session.execute(insert(StockTransaction), [{
+        'batch_id': allocation['batch_id'],
+        'transaction_type': 'out',
+        'quantity': allocation['quantity'],
+        'performed_by': user_id,
+        'notes': notes,
+    } for allocation in allocations])
+    for allocation in allocations:
+        record_movement(DISPENSE, allocation['medicine_id'], allocation['batch_id'], -allocation['quantity'],
+                        user_id, batch_number=allocation['batch_number'])
+    return True
+
+
+def dispense(lines, user_id, notes='Dispensed to patient'):
+    """Dispense (medicine_id, quantity) lines FEFO and commit, returns the allocations
+
+    Either every line is dispensed or nothing is. Raises InsufficientStock,
+    ValueError for non-positive quantities, or StockChanged after
+    MAX_ATTEMPTS lost races.
+    """
+    requested = merge_lines(lines)
+    if not requested:
+        return []
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            allocations = allocate(requested)
+            if _apply(allocations, user_id, notes):
+                refresh_stock_balances(requested)
+                db.session.commit()
+                return allocations
+        except OperationalError:
+            # SQLite reports a writer that lost the race as a locked database
+            if attempt == MAX_ATTEMPTS - 1:
+                db.session.rollback()
+                raise
+        db.session.rollback()
+    raise StockChanged('Stock changed while dispensing, please try again.')
@@ -0,0 +1,121 @@
+import threading
+from collections import OrderedDict
+from datetime import date
+from flask_login import current_user
+from jinja2 import nodes
+from jinja2.ext import Extension
+from data_versions import watermark
+
+# Cache of rendered template fragments.
+#
+#     {% cache 'inventory_rows', version, request.query_string %}
+#         ... expensive rows ...
+#     {% endcache %}
+#
+# keeps the HTML of the block in memory under the fragment name, the version
+# and any further values given (page arguments, sort), plus the role of the
+# logged in user, since templates show admins and employees different
+# buttons. The view reads the version with fragment_cache.version(tables)
+# before it queries the rows, so a write committed in between gives a new
+# version rather than old rows under it. The version is the data watermark
+# of those tables (one query, shared by every worker process) and today's
+# date, because expiry badges and stock figures also change with the date.
+# Whatever the block reads lazily (a query iterated inside it) only runs on
+# a miss. Entries of older versions are never looked up again and fall out
+# through LRU eviction once FRAGMENT_CACHE_SIZE entries or
+# FRAGMENT_CACHE_MAX_BYTES characters are held.
+
+
+class FragmentCacheExtension(Extension):
+    """The {% cache name, version, *vary %} ... {% endcache %} tag"""
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [nodes.List(args)]), [], [], body).set_lineno(lineno)
+
+    def _render(self, args, caller):
+        return fragment_cache.get_or_render(tuple(_hashable(arg) for arg in args), caller)
+
+
+def _hashable(value):
+    if isinstance(value, dict):
+        return tuple(sorted((key, _hashable(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(item) for item in value)
+    return value
+
+
+class FragmentCache:
+    def __init__(self, app=None):
+        self.app = None
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FRAGMENT_CACHE_ENABLED', True)
+        app.config.setdefault('FRAGMENT_CACHE_SIZE', 500)
+        app.config.setdefault('FRAGMENT_CACHE_MAX_BYTES', 16 * 1024 * 1024)
+        self.app = app
+        app.jinja_env.add_extension(FragmentCacheExtension)
+        app.extensions['fragment_cache'] = self
+
+    def version(self, *tables):
+        """Version of fragments rendered from tables, read before querying them"""
+        if not self.app.config['FRAGMENT_CACHE_ENABLED']:
+            return None
+        return watermark(tables), date.today().isoformat()
+
+    def get_or_render(self, key, render):
+        """Cached HTML for key, rendering and storing it on a miss"""
+        if not self.app.config['FRAGMENT_CACHE_ENABLED'] or key[1] is None:
+            return render()
+        key += (getattr(current_user, 'role', None),)
+        with self.lock:
+            html = self.entries.get(key)
+            if html is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return html
+            self.misses += 1
+        html = render()
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = html
+                self.size += len(html)
+            while self.entries and (len(self.entries) > self.app.config['FRAGMENT_CACHE_SIZE']
+                                    or self.size > self.app.config['FRAGMENT_CACHE_MAX_BYTES']):
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+        return html
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+fragment_cache = FragmentCache()
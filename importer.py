@@ -0,0 +1,243 @@
+import csv
+import io
+import json
+import os
+import time
+from datetime import datetime
+from sqlalchemy import Integer, Float, Date, String, insert
+from models import db, Supplier, Medicine, Batch
+from stock import refresh_stock_balances
+
+# Streaming bulk import of suppliers, medicines and batches.
+#
+# Rows are read one at a time from CSV or NDJSON, validated against the
+# column types, lengths and NOT NULL constraints declared in models.py, and
+# written with executemany inserts of chunk_size rows. Supplier and medicine
+# names are resolved to ids through in-memory maps loaded once per import and
+# extended as new rows are inserted, so files imported together can refer to
+# each other. Invalid rows are skipped and reported with their line number.
+# Everything is one transaction: committed at the end, or rolled back for a
+# dry run.
+
+KINDS = {
+    'suppliers': (Supplier, ['name', 'contact_person', 'phone', 'email', 'address']),
+    'medicines': (Medicine, ['name', 'generic_name', 'category', 'unit', 'supplier_id']),
+    'batches': (Batch, ['batch_number', 'medicine_id', 'quantity', 'expiration_date',
+                        'manufacturing_date', 'unit_price']),
+}
+# Reference columns that may be given by name instead of id
+REFERENCES = {
+    'supplier_id': ('supplier', 'suppliers'),
+    'medicine_id': ('medicine', 'medicines'),
+}
+
+
+class RowError(Exception):
+    """A row that does not fit the schema"""
+
+
+def kind_for_filename(path):
+    """Guess the import kind from a file name such as medicines.csv"""
+    name = os.path.basename(path).lower()
+    for kind in KINDS:
+        if name.startswith(kind) or name.startswith(kind.rstrip('s')):
+            return kind
+    raise ValueError(f"Cannot tell what {path} contains, name it suppliers/medicines/batches or pass --kind")
+
+
+def format_for_filename(path):
+    return 'ndjson' if path.lower().endswith(('.ndjson', '.jsonl', '.json')) else 'csv'
+
+
+def read_rows(stream, fmt):
+    """Yield (line number, dict) from a text stream of CSV with a header row or NDJSON"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        try:
+            for row in reader:
+                yield reader.line_num, row
+        except csv.Error as e:
+            raise csv.Error(f'line {reader.line_num}: {e}') from e
+    elif fmt == 'ndjson':
+        for line_no, line in enumerate(stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_no, RowError(f'Invalid JSON: {e}')
+                continue
+            yield line_no, row if isinstance(row, dict) else RowError('Each line must be a JSON object')
+    else:
+        raise ValueError(f"Unknown format: {fmt}")
+
+
+class ImportReport:
+    def __init__(self, kind, source):
+        self.kind = kind
+        self.source = source
+        self.rows = 0
+        self.inserted = 0
+        self.errors = []
+        self.error_count = 0
+        self.seconds = 0.0
+
+    @property
+    def rows_per_second(self):
+        return round(self.rows / self.seconds, 1) if self.seconds else 0.0
+
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'source': self.source,
+            'rows': self.rows,
+            'inserted': self.inserted,
+            'failed': self.error_count,
+            'errors': [{'line': line, 'error': error} for line, error in self.errors],
+            'seconds': round(self.seconds, 3),
+            'rows_per_second': self.rows_per_second,
+        }
+
+
+class Importer:
+    def __init__(self, dry_run=False, chunk_size=1000, max_reported_errors=1000):
+        self.dry_run = dry_run
+        self.chunk_size = chunk_size
+        self.max_reported_errors = max_reported_errors
+        self.reports = []
+        self.touched_medicines = set()
+        # name (lower case) -> id, None when the name is ambiguous; and the set of known ids
+        self.names = {'suppliers': {}, 'medicines': {}}
+        self.ids = {'suppliers': set(), 'medicines': set()}
+        for kind, model in (('suppliers', Supplier), ('medicines', Medicine)):
+            for row_id, name in db.session.query(model.id, model.name):
+                self._remember(kind, row_id, name)
+
+    def _remember(self, kind, row_id, name):
+        self.ids[kind].add(row_id)
+        key = (name or '').strip().lower()
+        if key:
+            names = self.names[kind]
+            names[key] = row_id if key not in names else None
+
+    def _resolve(self, column, row):
+        name_field, kind = REFERENCES[column]
+        value = row.get(column)
+        if value not in (None, ''):
+            try:
+                row_id = int(value)
+            except (TypeError, ValueError):
+                raise RowError(f'{column} must be a number')
+            if row_id not in self.ids[kind]:
+                raise RowError(f'{column} {row_id} does not exist')
+            return row_id
+        name = (row.get(name_field) or '').strip()
+        if not name:
+            raise RowError(f'{name_field} or {column} is required')
+        key = name.lower()
+        if key not in self.names[kind]:
+            raise RowError(f'Unknown {name_field} "{name}"')
+        if self.names[kind][key] is None:
+            raise RowError(f'{name_field} "{name}" matches several records, use {column}')
+        return self.names[kind][key]
+
+    def _coerce(self, column, value):
+        if isinstance(value, str):
+            value = value.strip()
+        if value in (None, ''):
+            if not column.nullable and column.default is None:
+                raise RowError(f'{column.name} is required')
+            return None
+        try:
+            if isinstance(column.type, Integer):
+                number = float(value)
+                if not number.is_integer():
+                    raise ValueError
+                return int(number)
+            if isinstance(column.type, Float):
+                return float(value)
+            if isinstance(column.type, Date):
+                return datetime.strptime(str(value), '%Y-%m-%d').date()
+        except ValueError:
+            expected = 'a YYYY-MM-DD date' if isinstance(column.type, Date) else 'a number'
+            raise RowError(f'{column.name} must be {expected}')
+        value = str(value)
+        if isinstance(column.type, String) and column.type.length and len(value) > column.type.length:
+            raise RowError(f'{column.name} is longer than {column.type.length} characters')
+        return value
+
+    def validate(self, kind, row):
+        """Turn a raw row into column values for kind, raises RowError"""
+        model, fields = KINDS[kind]
+        columns = model.__table__.columns
+        values = {}
+        for field in fields:
+            if field in REFERENCES:
+                values[field] = self._resolve(field, row)
+            else:
+                values[field] = self._coerce(columns[field], row.get(field))
+        if kind == 'batches' and values['quantity'] < 0:
+            raise RowError('quantity must not be negative')
+        return values
+
+    def import_stream(self, kind, stream, fmt, source='<stream>'):
+        """Import rows of one kind from a text stream, returns its ImportReport"""
+        report = ImportReport(kind, source)
+        # Listed before reading so a file that breaks off still has its report
+        self.reports.append(report)
+        started = time.perf_counter()
+        chunk = []
+        for line_no, row in read_rows(stream, fmt):
+            report.rows += 1
+            try:
+                if isinstance(row, RowError):
+                    raise row
+                chunk.append(self.validate(kind, row))
+            except RowError as e:
+                report.error_count += 1
+                if len(report.errors) < self.max_reported_errors:
+                    report.errors.append((line_no, str(e)))
+                continue
+            if len(chunk) >= self.chunk_size:
+                report.inserted += self._write(kind, chunk)
+                chunk = []
+        if chunk:
+            report.inserted += self._write(kind, chunk)
+        report.seconds = time.perf_counter() - started
+        return report
+
+    def import_file(self, path, kind=None, fmt=None):
+        kind = kind or kind_for_filename(path)
+        with open(path, newline='', encoding='utf-8-sig') as stream:
+            return self.import_stream(kind, stream, fmt or format_for_filename(path), source=path)
+
+    def import_upload(self, file_storage, kind, fmt=None):
+        """Import a werkzeug FileStorage without reading it into memory first"""
+        fmt = fmt or format_for_filename(file_storage.filename or '')
+        stream = io.TextIOWrapper(file_storage.stream, encoding='utf-8-sig', newline='')
+        return self.import_stream(kind, stream, fmt, source=file_storage.filename)
+
+    def _write(self, kind, rows):
+        model = KINDS[kind][0]
+        table = model.__table__
+        if kind == 'batches':
+            db.session.execute(insert(table), rows)
+            self.touched_medicines.update(row['medicine_id'] for row in rows)
+        else:
+            # Ids are needed so later rows and files can refer to these records by name
+            created = db.session.execute(insert(table).returning(table.c.id, table.c.name), rows)
+            for row_id, name in created:
+                self._remember(kind, row_id, name)
+                if kind == 'medicines':
+                    self.touched_medicines.add(row_id)
+        return len(rows)
+
+    def finish(self):
+        """Commit the import, or roll it back for a dry run"""
+        if self.dry_run:
+            db.session.rollback()
+            return
+        # Past a few hundred medicines one pass over every balance beats a huge IN list
+        refresh_stock_balances(self.touched_medicines if len(self.touched_medicines) <= 500 else None)
+        db.session.commit()
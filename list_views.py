@@ -0,0 +1,271 @@
+from datetime import datetime, timedelta
+from flask import url_for
+from sqlalchemy import func, or_, literal_column
+from sqlalchemy.orm import contains_eager, joinedload, selectinload
+from models import Medicine, Supplier, Batch, Order, StockBalance
+from pagination import keyset_page, parse_limit
+
+# Sort and filter definitions for the paginated list pages and their JSON APIs.
+#
+# Each list has a base query, a dict of sort name -> SQL expression and a
+# function applying the filters found in the request arguments. The HTML
+# view and the /api/... endpoint of a list share all of it, so a page of
+# /inventory and a page of /api/medicines with the same arguments hold the
+# same rows. Sort expressions never produce NULL (see keyset_page), and each
+# one is served by an index (see query_plans.py) so that every page costs the
+# same however deep it is: nullable text columns sort on coalesce(column, '')
+# with an expression index to match, and the literal '' is inlined because
+# SQLite only uses such an index for the identical expression, never for a
+# bound parameter.
+
+LOW_STOCK_THRESHOLD = 10
+EXPIRING_DAYS = 30
+
+
+def _int_arg(args, name):
+    try:
+        return int(args.get(name, ''))
+    except ValueError:
+        return None
+
+
+def _prefix(value):
+    """LIKE pattern matching values that start with value"""
+    escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'{escaped}%'
+
+
+def _text_sort(column):
+    return func.coalesce(column, literal_column("''"))
+
+
+def _medicine_query():
+    # contains_eager reuses the sort join instead of the relationship's own joined load. Every medicine
+    # gets its balance row when it is created, and an inner join lets the stock sort start from
+    # the balance index.
+    return Medicine.query.join(StockBalance, StockBalance.medicine_id == Medicine.id).options(
+        contains_eager(Medicine.stock_balance), joinedload(Medicine.supplier)
+    )
+
+
+def _medicine_filters(query, args):
+    q = args.get('q', '').strip()
+    if q:
+        pattern = _prefix(q)
+        query = query.filter(or_(Medicine.name.like(pattern, escape='\\'),
+                                 Medicine.generic_name.like(pattern, escape='\\')))
+    if args.get('category'):
+        query = query.filter(Medicine.category == args['category'])
+    supplier_id = _int_arg(args, 'supplier_id')
+    if supplier_id is not None:
+        query = query.filter(Medicine.supplier_id == supplier_id)
+    if args.get('stock') == 'low':
+        query = query.filter(StockBalance.on_hand <= LOW_STOCK_THRESHOLD)
+    elif args.get('stock') == 'in':
+        query = query.filter(StockBalance.on_hand > 0)
+    return query
+
+
+def _batch_query():
+    return Batch.query.options(joinedload(Batch.medicine))
+
+
+def _batch_filters(query, args):
+    q = args.get('q', '').strip()
+    if q:
+        query = query.filter(Batch.batch_number.like(_prefix(q), escape='\\'))
+    medicine_id = _int_arg(args, 'medicine_id')
+    if medicine_id is not None:
+        query = query.filter(Batch.medicine_id == medicine_id)
+    status = args.get('status')
+    if status == 'expired':
+        query = query.filter(Batch.is_expired)
+    elif status == 'expiring':
+        query = query.filter(Batch.expires_within(EXPIRING_DAYS))
+    elif status == 'good':
+        query = query.filter(Batch.expiration_date > datetime.now().date() + timedelta(days=EXPIRING_DAYS))
+    if args.get('stock') == 'low':
+        query = query.filter(Batch.quantity <= LOW_STOCK_THRESHOLD)
+    return query
+
+
+def _order_query():
+    return Order.query.options(joinedload(Order.supplier), joinedload(Order.creator))
+
+
+def _order_filters(query, args):
+    if args.get('status'):
+        query = query.filter(Order.status == args['status'])
+    supplier_id = _int_arg(args, 'supplier_id')
+    if supplier_id is not None:
+        query = query.filter(Order.supplier_id == supplier_id)
+    return query
+
+
+def _supplier_filters(query, args):
+    q = args.get('q', '').strip()
+    if q:
+        query = query.filter(Supplier.name.like(_prefix(q), escape='\\'))
+    return query
+
+
+class ListView:
+    def __init__(self, model, query, sorts, default_sort, default_descending, filters, api_options=(),
+                 tiebreaks=None):
+        self.model = model
+        self.query = query
+        self.sorts = sorts
+        # Per sort, a column equal to the model's id that the sort's index is ordered by
+        self.tiebreaks = tiebreaks or {}
+        self.default_sort = default_sort
+        self.default_descending = default_descending
+        self.filters = filters
+        # Extra loader options for the fields only the JSON form serializes
+        self.api_options = api_options
+
+    def sort_for(self, args):
+        """Return (sort name, descending) from ?sort=&dir=, falling back to the defaults"""
+        sort = args.get('sort')
+        if sort not in self.sorts:
+            return self.default_sort, self.default_descending
+        direction = args.get('dir')
+        if direction not in ('asc', 'desc'):
+            return sort, self.default_descending if sort == self.default_sort else False
+        return sort, direction == 'desc'
+
+    def tiebreak(self, sort):
+        """The id expression that orders rows with equal sort values"""
+        return self.tiebreaks.get(sort, self.model.id)
+
+    def page(self, args, endpoint=None, for_api=False):
+        """Return the Page for request args; raises InvalidCursor for a bad cursor
+
+        With an endpoint, page.next_url and page.prev_url link to the
+        neighbouring pages with the same sort and filters.
+        """
+        sort, descending = self.sort_for(args)
+        query = self.filters(self.query(), args)
+        if for_api and self.api_options:
+            query = query.options(*self.api_options)
+        page = keyset_page(query, self.sorts[sort], self.tiebreak(sort), descending=descending,
+                           limit=parse_limit(args.get('limit')),
+                           after=args.get('after') or None, before=args.get('before') or None)
+        page.sort = sort
+        page.descending = descending
+        if endpoint:
+            base = {key: value for key, value in args.items() if key not in ('after', 'before')}
+            if page.has_next:
+                page.next_url = url_for(endpoint, **base, after=page.next_cursor)
+            if page.has_prev:
+                page.prev_url = url_for(endpoint, **base, before=page.prev_cursor)
+        return page
+
+
+LISTS = {
+    'medicines': ListView(Medicine, _medicine_query, {
+        'name': Medicine.name,
+        'generic_name': _text_sort(Medicine.generic_name),
+        'category': _text_sort(Medicine.category),
+        'stock': StockBalance.on_hand,
+        'id': Medicine.id,
+    }, 'name', False, _medicine_filters, tiebreaks={'stock': StockBalance.medicine_id}),
+    'batches': ListView(Batch, _batch_query, {
+        'expiration_date': Batch.expiration_date,
+        'batch_number': Batch.batch_number,
+        'quantity': Batch.quantity,
+        'id': Batch.id,
+    }, 'expiration_date', False, _batch_filters),
+    'orders': ListView(Order, _order_query, {
+        # order_date always has its default; the bare column keeps the index usable
+        'order_date': Order.order_date,
+        'id': Order.id,
+    }, 'order_date', True, _order_filters, api_options=(selectinload(Order.items),)),
+    'suppliers': ListView(Supplier, lambda: Supplier.query, {
+        'name': Supplier.name,
+        'id': Supplier.id,
+    }, 'name', False, _supplier_filters),
+}
+
+
+def _date(value):
+    return value.isoformat() if value else None
+
+
+def medicine_json(medicine):
+    balance = medicine.stock_balance
+    return {
+        'id': medicine.id,
+        'name': medicine.name,
+        'generic_name': medicine.generic_name,
+        'category': medicine.category,
+        'unit': medicine.unit,
+        'supplier': {'id': medicine.supplier.id, 'name': medicine.supplier.name},
+        'total_quantity': medicine.total_quantity,
+        'available_quantity': medicine.available_quantity,
+        'nearest_expiry': _date(balance.nearest_expiry) if balance else None,
+    }
+
+
+def batch_json(batch):
+    if batch.is_expired:
+        status = 'expired'
+    elif batch.days_until_expiration <= EXPIRING_DAYS:
+        status = 'expiring'
+    else:
+        status = 'good'
+    return {
+        'id': batch.id,
+        'batch_number': batch.batch_number,
+        'medicine': {'id': batch.medicine.id, 'name': batch.medicine.name,
+                     'generic_name': batch.medicine.generic_name},
+        'quantity': batch.quantity,
+        'manufacturing_date': _date(batch.manufacturing_date),
+        'expiration_date': _date(batch.expiration_date),
+        'days_until_expiration': batch.days_until_expiration,
+        'unit_price': batch.unit_price,
+        'status': status,
+    }
+
+
+def order_json(order):
+    return {
+        'id': order.id,
+        'supplier': {'id': order.supplier.id, 'name': order.supplier.name},
+        'order_date': _date(order.order_date),
+        'status': order.status,
+        'created_by': {'id': order.creator.id, 'username': order.creator.username},
+        'total_items': order.total_items,
+        'total_amount': order.total_amount,
+    }
+
+
+def supplier_json(supplier):
+    return {
+        'id': supplier.id,
+        'name': supplier.name,
+        'contact_person': supplier.contact_person,
+        'phone': supplier.phone,
+        'email': supplier.email,
+        'address': supplier.address,
+    }
+
+
+SERIALIZERS = {
+    'medicines': medicine_json,
+    'batches': batch_json,
+    'orders': order_json,
+    'suppliers': supplier_json,
+}
+
+
+def page_json(name, page):
+    """JSON body for a page of one of LISTS"""
+    return {
+        'items': [SERIALIZERS[name](item) for item in page.items],
+        'next_cursor': page.next_cursor,
+        'prev_cursor': page.prev_cursor,
+        'sort': page.sort,
+        'dir': 'desc' if page.descending else 'asc',
+        'limit': page.limit,
+    }
+
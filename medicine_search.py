@@ -0,0 +1,98 @@
+import re
+from sqlalchemy import event, text
+from models import db, Medicine, StockBalance
+
+# Full-text medicine search behind the medicine pickers.
+#
+# medicine_fts is an SQLite FTS5 index over the name, generic name and
+# category of every medicine. It is an external-content table, so it stores
+# only the index and reads the text from medicine. Triggers on medicine keep
+# it in step with every insert, update and delete, whichever code path makes
+# them (routes, imports, bulk inserts). Every word typed is matched as a
+# prefix, results are ranked by bm25 with the name weighing most, then the
+# generic name, then the category, and come with the medicine's stock balance.
+# Prefix indexes for two and three characters keep the first keystrokes fast
+# on large catalogues. create_all() builds the index with the medicine table;
+# migration 9 adds it to existing databases.
+
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 50
+# bm25 weights of name, generic_name and category
+RANK_WEIGHTS = (10.0, 5.0, 1.0)
+
+INDEX_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS medicine_fts USING fts5("
+    "name, generic_name, category, content='medicine', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS medicine_fts_insert AFTER INSERT ON medicine BEGIN "
+    "INSERT INTO medicine_fts (rowid, name, generic_name, category) "
+    "VALUES (new.id, new.name, new.generic_name, new.category); END",
+    "CREATE TRIGGER IF NOT EXISTS medicine_fts_delete AFTER DELETE ON medicine BEGIN "
+    "INSERT INTO medicine_fts (medicine_fts, rowid, name, generic_name, category) "
+    "VALUES ('delete', old.id, old.name, old.generic_name, old.category); END",
+    "CREATE TRIGGER IF NOT EXISTS medicine_fts_update AFTER UPDATE OF name, generic_name, category ON medicine "
+    "BEGIN "
+    "INSERT INTO medicine_fts (medicine_fts, rowid, name, generic_name, category) "
+    "VALUES ('delete', old.id, old.name, old.generic_name, old.category); "
+    "INSERT INTO medicine_fts (rowid, name, generic_name, category) "
+    "VALUES (new.id, new.name, new.generic_name, new.category); END",
+]
+
+
+def create_search_index(conn):
+    """Create medicine_fts and its triggers if missing, and index every medicine"""
+    for statement in INDEX_DDL:
+        conn.exec_driver_sql(statement)
+    conn.exec_driver_sql("INSERT INTO medicine_fts (medicine_fts) VALUES ('rebuild')")
+
+
+@event.listens_for(Medicine.__table__, 'after_create')
+def _create_with_medicine_table(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        create_search_index(connection)
+
+
+def match_expression(query):
+    """FTS5 query matching every word of query as a prefix, None when it has no words"""
+    words = re.findall(r'\w+', query.lower())
+    if not words:
+        return None
+    # Quoting each word keeps FTS5 operators and punctuation typed by users out of the query
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def search_medicines(query, limit=SEARCH_LIMIT, in_stock=False):
+    """Medicines matching query, best first, as dicts with their stock; the first by name when query is blank
+
+    in_stock keeps only medicines with units that can still be dispensed.
+    """
+    limit = max(1, min(int(limit), MAX_SEARCH_LIMIT))
+    expression = match_expression(query or '')
+    if expression is None:
+        rows = db.session.query(
+            Medicine.id, Medicine.name, Medicine.generic_name, Medicine.category, Medicine.unit,
+            StockBalance.on_hand, StockBalance.available
+        ).outerjoin(StockBalance, StockBalance.medicine_id == Medicine.id)
+        if in_stock:
+            rows = rows.filter(StockBalance.available > 0)
+        rows = rows.order_by(Medicine.name).limit(limit).all()
+    else:
+        rows = db.session.execute(text(
+            'SELECT medicine.id, medicine.name, medicine.generic_name, medicine.category, medicine.unit, '
+            'stock_balance.on_hand, stock_balance.available '
+            'FROM medicine_fts '
+            'JOIN medicine ON medicine.id = medicine_fts.rowid '
+            'LEFT JOIN stock_balance ON stock_balance.medicine_id = medicine.id '
+            'WHERE medicine_fts MATCH :expression'
+            + (' AND stock_balance.available > 0' if in_stock else '') +
+            ' ORDER BY bm25(medicine_fts, {}, {}, {}), medicine.name LIMIT :limit'.format(*RANK_WEIGHTS)
+        ), {'expression': expression, 'limit': limit}).all()
+    return [{
+        'id': row.id,
+        'name': row.name,
+        'generic_name': row.generic_name,
+        'category': row.category,
+        'unit': row.unit,
+        'on_hand': row.on_hand or 0,
+        'available': row.available or 0,
+    } for row in rows]
@@ -0,0 +1,283 @@
+import bisect
+import hmac
+import os
+import sqlite3
+import threading
+import time
+from flask import Response, abort, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Request, SQL and background job instrumentation, served at /metrics in the
+# Prometheus text format.
+#
+# Every request is timed and counted by endpoint, method and status, and
+# in-flight requests are gauged. Engine events time every SQL statement; the
+# totals of the current request (statements, SQL seconds, rows) are kept in
+# a thread-local and observed per endpoint when it finishes. Rows returned are
+# counted by the SQLite cursor handed out through the do_connect event, plus
+# the rowcount of writes. Report renders and scheduled jobs observe their own
+# duration histograms. Samples live in this process: with several
+# workers, scrape each one or aggregate in Prometheus. Recording costs a
+# dictionary update under a lock per sample, so it can stay on in production.
+#
+# The figures describe the app's endpoints, errors and queues, so /metrics
+# only answers requests made from this host (127.0.0.1 or ::1, not relayed
+# by a proxy) by default. To let a remote Prometheus scrape it, set
+# METRICS_TOKEN (config or environment) and have it send
+# "Authorization: Bearer <token>"; with a token set, every request must
+# carry it.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+# Clients allowed to scrape without METRICS_TOKEN
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+_local = threading.local()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return [f'{self.name}{_labels(self.label_names, labels)} {_number(value)}' for labels, value in items]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, labels=(), value=0):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self.lock:
+            items = sorted((labels, (list(counts), total, count)) for labels, (counts, total, count)
+                           in self.values.items())
+        lines = []
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = _labels(self.label_names, labels, [('le', _number(bound))])
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, labels)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, labels)} {count}')
+        return lines
+
+
+class _CountingCursor(sqlite3.Cursor):
+    """SQLite cursor that adds the rows it hands out to the current request's totals"""
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            _count_rows(1)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = super().fetchmany(*args, **kwargs)
+        _count_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        _count_rows(len(rows))
+        return rows
+
+
+class _CountingConnection(sqlite3.Connection):
+    def cursor(self, factory=_CountingCursor):
+        return super().cursor(factory)
+
+
+def _count_rows(count):
+    totals = getattr(_local, 'totals', None)
+    if totals is not None:
+        totals[2] += count
+
+
+def _use_counting_connection(dialect, conn_rec, cargs, cparams):
+    if dialect.name == 'sqlite' and 'factory' not in cparams:
+        cparams['factory'] = _CountingConnection
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['metrics_started'].pop()
+    totals = getattr(_local, 'totals', None)
+    if totals is not None:
+        totals[0] += 1
+        totals[1] += elapsed
+        # SQLite reports -1 for SELECT, so this only counts rows written
+        if cursor.rowcount > 0:
+            totals[2] += cursor.rowcount
+    metrics.sql_queries.inc()
+    metrics.sql_seconds.inc((), elapsed)
+
+
+class Metrics:
+    def __init__(self, app=None):
+        self.app = None
+        self.collectors = []
+        self.registry = []
+        self.requests = self.counter('rhu_http_requests_total', 'Requests by endpoint, method and status',
+                                     ('endpoint', 'method', 'status'))
+        self.latency = self.histogram('rhu_http_request_duration_seconds', 'Request latency by endpoint',
+                                      ('endpoint', 'method'))
+        self.in_flight = self.gauge('rhu_http_requests_in_flight', 'Requests being served')
+        self.request_queries = self.histogram('rhu_http_request_queries', 'SQL statements per request by endpoint',
+                                              ('endpoint',), QUERY_BUCKETS)
+        self.request_sql_seconds = self.histogram('rhu_http_request_sql_seconds',
+                                                  'Time spent in SQL per request by endpoint', ('endpoint',))
+        self.request_rows = self.counter('rhu_http_request_sql_rows_total',
+                                         'Rows fetched or written by requests by endpoint', ('endpoint',))
+        self.sql_queries = self.counter('rhu_sql_queries_total', 'SQL statements executed')
+        self.sql_seconds = self.counter('rhu_sql_seconds_total', 'Time spent executing SQL statements')
+        self.report_seconds = self.histogram('rhu_report_render_seconds', 'PDF report render time',
+                                             ('report', 'outcome'), DURATION_BUCKETS)
+        self.job_seconds = self.histogram('rhu_job_duration_seconds', 'Scheduled job run time',
+                                          ('job', 'outcome'), DURATION_BUCKETS)
+        if app is not None:
+            self.init_app(app)
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def _register(self, metric):
+        self.registry.append(metric)
+        return metric
+
+    def collector(self, func):
+        """Register func() returning [(name, type, help, value)] read at every scrape"""
+        self.collectors.append(func)
+        return func
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.config.setdefault('METRICS_TOKEN', os.environ.get('METRICS_TOKEN'))
+        self.app = app
+        if app.config['METRICS_ENABLED']:
+            for name, listener in (('do_connect', _use_counting_connection),
+                                   ('before_cursor_execute', _before_cursor_execute),
+                                   ('after_cursor_execute', _after_cursor_execute)):
+                if not event.contains(Engine, name, listener):
+                    event.listen(Engine, name, listener)
+            app.before_request(self._start)
+            app.after_request(self._status)
+            app.teardown_request(self._finish)
+        app.add_url_rule('/metrics', 'metrics', self.view)
+        app.extensions['metrics'] = self
+
+    def _start(self):
+        g.metrics_started = time.perf_counter()
+        _local.totals = [0, 0.0, 0]
+        self.in_flight.inc()
+
+    def _status(self, response):
+        g.metrics_status = response.status_code
+        return response
+
+    def _finish(self, exc):
+        started = g.pop('metrics_started', None)
+        totals = getattr(_local, 'totals', None)
+        _local.totals = None
+        if started is None:
+            return
+        self.in_flight.inc((), -1)
+        endpoint = request.endpoint or 'unmatched'
+        status = g.pop('metrics_status', 500)
+        self.requests.inc((endpoint, request.method, str(status)))
+        self.latency.observe((endpoint, request.method), time.perf_counter() - started)
+        if totals is not None:
+            self.request_queries.observe((endpoint,), totals[0])
+            self.request_sql_seconds.observe((endpoint,), totals[1])
+            if totals[2]:
+                self.request_rows.inc((endpoint,), totals[2])
+
+    def render(self):
+        lines = []
+        for metric in self.registry:
+            lines.extend(metric.header())
+            lines.extend(metric.samples())
+        for collect in self.collectors:
+            for name, kind, help, value in collect():
+                lines.extend([f'# HELP {name} {help}', f'# TYPE {name} {kind}', f'{name} {_number(value)}'])
+        return '\n'.join(lines) + '\n'
+
+    def view(self):
+        token = self.app.config['METRICS_TOKEN']
+        if token:
+            if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+                abort(401)
+        elif request.remote_addr not in LOCAL_ADDRESSES or 'X-Forwarded-For' in request.headers:
+            abort(403)
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+
+metrics = Metrics()
@@ -0,0 +1,144 @@
+from datetime import datetime
+from sqlalchemy.orm import Session
+from models import StockBalance, DataVersion, OutboundEmail, AlertRule, StockAlert, SchedulerLock, JobStat
+from medicine_search import create_search_index
+from data_versions import next_version
+from stock import STOCK_VERSION
+from alerts import alert_rules
+
+# Versioned schema migrations for existing SQLite databases.
+#
+# db.create_all() only creates missing tables, so columns and indexes added to
+# models.py never reach a database that already exists. Each entry below is
+# (version, description, step) where step is a list of SQL statements or a
+# callable taking a connection. The applied version is kept in SQLite's
+# PRAGMA user_version. Steps must be idempotent (IF NOT EXISTS, checkfirst)
+# because a fresh database already has everything create_all() builds.
+# Never edit a released migration: append a new one with the next version.
+
+
+def _create_stock_balance(conn):
+    StockBalance.__table__.create(conn, checkfirst=True)
+
+
+def _create_data_version(conn):
+    DataVersion.__table__.create(conn, checkfirst=True)
+
+
+def _add_stock_balance_version(conn):
+    columns = {row[1] for row in conn.exec_driver_sql('PRAGMA table_info(stock_balance)')}
+    if 'version' not in columns:
+        conn.exec_driver_sql('ALTER TABLE stock_balance ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_stock_balance_version ON stock_balance (version)')
+
+
+def _create_outbound_email(conn):
+    OutboundEmail.__table__.create(conn, checkfirst=True)
+
+
+def _create_alert_tables(conn):
+    AlertRule.__table__.create(conn, checkfirst=True)
+    StockAlert.__table__.create(conn, checkfirst=True)
+
+
+def _create_scheduler_tables(conn):
+    SchedulerLock.__table__.create(conn, checkfirst=True)
+    JobStat.__table__.create(conn, checkfirst=True)
+
+
+def _backfill_stock_balances(conn):
+    # The medicine list inner-joins stock_balance, so a medicine without a row would not be listed
+    missing = conn.exec_driver_sql(
+        'SELECT COUNT(*) FROM medicine WHERE id NOT IN (SELECT medicine_id FROM stock_balance)'
+    ).scalar()
+    if not missing:
+        return
+    # Stamped like refresh_stock_balances() does, so delta sync clients receive the new rows
+    version = next_version(STOCK_VERSION, conn)
+    today = datetime.now().date().isoformat()
+    conn.exec_driver_sql(
+        'INSERT INTO stock_balance (medicine_id, on_hand, available, batch_count, nearest_expiry, version, updated_at) '
+        'SELECT medicine.id, COALESCE(SUM(batch.quantity), 0), '
+        'COALESCE(SUM(CASE WHEN batch.expiration_date >= ? THEN batch.quantity ELSE 0 END), 0), '
+        'COALESCE(SUM(CASE WHEN batch.quantity > 0 THEN 1 ELSE 0 END), 0), '
+        'MIN(CASE WHEN batch.quantity > 0 AND batch.expiration_date >= ? THEN batch.expiration_date END), ?, ? '
+        'FROM medicine LEFT JOIN batch ON batch.medicine_id = medicine.id '
+        'WHERE medicine.id NOT IN (SELECT medicine_id FROM stock_balance) '
+        'GROUP BY medicine.id',
+        (today, today, version, str(datetime.utcnow()))
+    )
+
+
+def _open_current_alerts(conn):
+    # Alerts otherwise only open on the next stock change or the daily sweep, leaving the dashboard empty until then
+    session = Session(bind=conn)
+    try:
+        alert_rules.evaluate(None, session)
+        session.flush()
+    finally:
+        session.close()
+
+
+MIGRATIONS = [
+    (1, 'Create stock_balance projection table', _create_stock_balance),
+    (2, 'Add secondary indexes for hot queries', [
+        'CREATE INDEX IF NOT EXISTS ix_medicine_supplier_id ON medicine (supplier_id)',
+        'CREATE INDEX IF NOT EXISTS ix_batch_medicine_expiration ON batch (medicine_id, expiration_date)',
+        'CREATE INDEX IF NOT EXISTS ix_batch_expiration_date ON batch (expiration_date)',
+        'CREATE INDEX IF NOT EXISTS ix_batch_quantity ON batch (quantity)',
+        'CREATE INDEX IF NOT EXISTS ix_order_status ON "order" (status)',
+        'CREATE INDEX IF NOT EXISTS ix_order_order_date ON "order" (order_date)',
+        'CREATE INDEX IF NOT EXISTS ix_order_supplier_creator_date ON "order" (supplier_id, created_by, order_date)',
+        'CREATE INDEX IF NOT EXISTS ix_order_item_order_id ON order_item (order_id)',
+        'CREATE INDEX IF NOT EXISTS ix_order_item_medicine_id ON order_item (medicine_id)',
+        'CREATE INDEX IF NOT EXISTS ix_stock_transaction_date ON stock_transaction (transaction_date)',
+        'CREATE INDEX IF NOT EXISTS ix_stock_transaction_type_date ON stock_transaction (transaction_type, transaction_date)',
+        'CREATE INDEX IF NOT EXISTS ix_stock_transaction_batch_id ON stock_transaction (batch_id)',
+    ]),
+    (3, 'Create data_version change counters', _create_data_version),
+    (4, 'Add indexes for keyset-paginated list sorts', [
+        'CREATE INDEX IF NOT EXISTS ix_medicine_name ON medicine (name)',
+        'CREATE INDEX IF NOT EXISTS ix_supplier_name ON supplier (name)',
+        'CREATE INDEX IF NOT EXISTS ix_batch_batch_number ON batch (batch_number)',
+    ]),
+    (5, 'Track the stock version of each balance for delta sync', _add_stock_balance_version),
+    (6, 'Create outbound_email notification queue', _create_outbound_email),
+    (7, 'Create alert_rule and stock_alert tables', _create_alert_tables),
+    (8, 'Create scheduler_lock and job_stat tables', _create_scheduler_tables),
+    (9, 'Create medicine_fts full-text search index', create_search_index),
+    (10, 'Add indexes for the medicine list sorts', [
+        "CREATE INDEX IF NOT EXISTS ix_medicine_generic_name_sort ON medicine (coalesce(generic_name, ''))",
+        "CREATE INDEX IF NOT EXISTS ix_medicine_category_sort ON medicine (coalesce(category, ''))",
+        'CREATE INDEX IF NOT EXISTS ix_stock_balance_on_hand ON stock_balance (on_hand)',
+    ]),
+    (11, 'Backfill missing stock_balance rows', _backfill_stock_balances),
+    (12, 'Open alerts for the current stock', _open_current_alerts),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(engine):
+    """Return the schema version recorded in the database"""
+    with engine.connect() as conn:
+        return conn.exec_driver_sql('PRAGMA user_version').scalar()
+
+
+def upgrade(engine, target=None):
+    """Apply every migration newer than the database's version, returns the ones applied"""
+    target = LATEST_VERSION if target is None else target
+    version = current_version(engine)
+    applied = []
+    for number, description, step in MIGRATIONS:
+        if number <= version or number > target:
+            continue
+        with engine.begin() as conn:
+            if callable(step):
+                step(conn)
+            else:
+                for statement in step:
+                    conn.exec_driver_sql(statement)
+            # PRAGMA does not accept bound parameters; number comes from MIGRATIONS
+            conn.exec_driver_sql(f'PRAGMA user_version = {int(number)}')
+        applied.append((number, description))
+    return applied
@@ -1,6 +1,8 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
-from datetime import datetime
+from datetime import datetime, timedelta
+from sqlalchemy import func, select, cast, Integer
+from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
 
 db = SQLAlchemy()
 
@@ -23,6 +25,10 @@ class Supplier(db.Model):
     email = db.Column(db.String(120))
     address = db.Column(db.String(200))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_supplier_name', 'name'),
+    )
     
     # Relationships
     medicines = db.relationship('Medicine', backref='supplier', lazy=True)
@@ -39,16 +45,55 @@ class Medicine(db.Model):
     unit = db.Column(db.String(20))  # e.g., tablets, bottles, etc.
     supplier_id = db.Column(db.Integer, db.ForeignKey('supplier.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # Index names are shared with migrations.py, which adds them to existing databases
+    __table_args__ = (
+        db.Index('ix_medicine_supplier_id', 'supplier_id'),
+        db.Index('ix_medicine_name', 'name'),
+        # Match the list sorts on coalesce(column, '') (see list_views.py)
+        db.Index('ix_medicine_generic_name_sort', db.text("coalesce(generic_name, '')")),
+        db.Index('ix_medicine_category_sort', db.text("coalesce(category, '')")),
+    )
     
     # Relationships
     batches = db.relationship('Batch', backref='medicine', lazy=True)
     order_items = db.relationship('OrderItem', backref='medicine', lazy=True)
+    stock_balance = db.relationship('StockBalance', backref='medicine', uselist=False, lazy='joined',
+                                    cascade='all, delete-orphan')
+    alert_rule = db.relationship('AlertRule', backref='medicine', uselist=False, lazy=True,
+                                 cascade='all, delete-orphan')
+    alerts = db.relationship('StockAlert', backref='medicine', lazy=True, cascade='all, delete-orphan')
 
-    @property
+    @hybrid_property
     def total_quantity(self):
         """Calculate total quantity across all batches"""
+        if self.stock_balance is not None:
+            return self.stock_balance.on_hand
         return sum(batch.quantity for batch in self.batches)
 
+    @total_quantity.expression
+    def total_quantity(cls):
+        return select(func.coalesce(func.sum(StockBalance.on_hand), 0)).where(
+            StockBalance.medicine_id == cls.id
+        ).correlate_except(StockBalance).scalar_subquery()
+
+    @hybrid_property
+    def available_quantity(self):
+        """Calculate quantity held in batches that have not expired yet"""
+        balance = self.stock_balance
+        if balance is not None and not balance.is_stale:
+            return balance.available
+        today = datetime.now().date()
+        return sum(batch.quantity for batch in self.batches if batch.expiration_date >= today)
+
+    @available_quantity.expression
+    def available_quantity(cls):
+        today = datetime.now().date()
+        return select(func.coalesce(func.sum(Batch.quantity), 0)).where(
+            Batch.medicine_id == cls.id,
+            Batch.expiration_date >= today
+        ).correlate_except(Batch).scalar_subquery()
+
     @property
     def available_batches(self):
         """Get batches with quantity > 0"""
@@ -57,6 +102,61 @@ class Medicine(db.Model):
     def __repr__(self):
         return f'<Medicine {self.name}>'
 
+class StockBalance(db.Model):
+    """Per-medicine stock projection, kept in step with the batch table by stock.refresh_stock_balances"""
+    medicine_id = db.Column(db.Integer, db.ForeignKey('medicine.id'), primary_key=True)
+    on_hand = db.Column(db.Integer, nullable=False, default=0)  # every unit in every batch
+    available = db.Column(db.Integer, nullable=False, default=0)  # units in non-expired batches
+    batch_count = db.Column(db.Integer, nullable=False, default=0)  # batches with quantity > 0
+    nearest_expiry = db.Column(db.Date)  # earliest expiry among stocked, non-expired batches
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    version = db.Column(db.Integer, nullable=False, default=0)  # stock_levels counter value when the figures last changed
+
+    __table_args__ = (
+        db.Index('ix_stock_balance_version', 'version'),
+        db.Index('ix_stock_balance_on_hand', 'on_hand'),
+    )
+
+    @property
+    def is_stale(self):
+        """True once a batch counted as available has expired since the last refresh"""
+        return self.nearest_expiry is not None and self.nearest_expiry < datetime.now().date()
+
+    def __repr__(self):
+        return f'<StockBalance medicine={self.medicine_id} on_hand={self.on_hand}>'
+
+class AlertRule(db.Model):
+    """Per-medicine alert thresholds, empty columns fall back to the ALERT_* defaults (see alerts.py)"""
+    medicine_id = db.Column(db.Integer, db.ForeignKey('medicine.id'), primary_key=True)
+    reorder_level = db.Column(db.Integer)  # low stock once available units drop to this
+    restock_level = db.Column(db.Integer)  # low stock clears once available units reach this
+    expiry_days = db.Column(db.Integer)  # expiring once a stocked batch expires within this many days
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<AlertRule medicine={self.medicine_id} reorder={self.reorder_level}>'
+
+class StockAlert(db.Model):
+    """One crossing of an alert threshold, open until the condition clears"""
+    id = db.Column(db.Integer, primary_key=True)
+    medicine_id = db.Column(db.Integer, db.ForeignKey('medicine.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # low_stock, expiring
+    threshold = db.Column(db.Integer, nullable=False)  # reorder level or expiry window when opened
+    quantity = db.Column(db.Integer, nullable=False)  # available units when opened
+    nearest_expiry = db.Column(db.Date)  # nearest stocked expiry when opened
+    opened_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    resolved_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        # At most one open alert per medicine and kind
+        db.Index('ix_stock_alert_open', 'medicine_id', 'kind', unique=True,
+                 sqlite_where=db.text('resolved_at IS NULL')),
+        db.Index('ix_stock_alert_opened_at', 'opened_at'),
+    )
+
+    def __repr__(self):
+        return f'<StockAlert {self.kind} medicine={self.medicine_id}>'
+
 class Batch(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     batch_number = db.Column(db.String(50), nullable=False)
@@ -66,26 +166,55 @@ class Batch(db.Model):
     manufacturing_date = db.Column(db.Date)
     unit_price = db.Column(db.Float)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_batch_medicine_expiration', 'medicine_id', 'expiration_date'),
+        db.Index('ix_batch_expiration_date', 'expiration_date'),
+        db.Index('ix_batch_quantity', 'quantity'),
+        db.Index('ix_batch_batch_number', 'batch_number'),
+    )
     
     # Relationships
     transactions = db.relationship('StockTransaction', backref='batch', lazy=True)
 
-    @property
+    # The SQL forms below compare the bare column against today's date bound as a
+    # parameter, so filters on them can use the expiration_date index.
+
+    @hybrid_property
     def is_expired(self):
         """Check if batch is expired"""
         return self.expiration_date < datetime.now().date()
 
-    @property
+    @is_expired.expression
+    def is_expired(cls):
+        return cls.expiration_date < datetime.now().date()
+
+    @hybrid_property
     def days_until_expiration(self):
         """Calculate days until expiration"""
         delta = self.expiration_date - datetime.now().date()
         return delta.days
 
-    @property
-    def is_expiring_soon(self, days=30):
-        """Check if batch is expiring within specified days"""
+    @days_until_expiration.expression
+    def days_until_expiration(cls):
+        today = datetime.now().date()
+        return cast(func.julianday(cls.expiration_date) - func.julianday(today), Integer)
+
+    @hybrid_method
+    def expires_within(self, days):
+        """Check if batch expires between today and the given number of days from now"""
         return 0 <= self.days_until_expiration <= days
 
+    @expires_within.expression
+    def expires_within(cls, days):
+        today = datetime.now().date()
+        return cls.expiration_date.between(today, today + timedelta(days=days))
+
+    @hybrid_property
+    def is_expiring_soon(self):
+        """Check if batch is expiring within the next 30 days"""
+        return self.expires_within(30)
+
     def __repr__(self):
         return f'<Batch {self.batch_number} - {self.medicine.name}>'
 
@@ -95,21 +224,39 @@ class Order(db.Model):
     order_date = db.Column(db.DateTime, default=datetime.utcnow)
     status = db.Column(db.String(20), default='pending')  # pending, delivered, cancelled
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_order_status', 'status'),
+        db.Index('ix_order_order_date', 'order_date'),
+        db.Index('ix_order_supplier_creator_date', 'supplier_id', 'created_by', 'order_date'),
+    )
     
     # Relationships
     items = db.relationship('OrderItem', backref='order', lazy=True, cascade='all, delete-orphan')
     creator = db.relationship('User', backref='orders')
 
-    @property
+    @hybrid_property
     def total_amount(self):
         """Calculate total order amount"""
         return sum(item.total_price for item in self.items)
 
-    @property
+    @total_amount.expression
+    def total_amount(cls):
+        return select(func.coalesce(func.sum(OrderItem.total_price), 0)).where(
+            OrderItem.order_id == cls.id
+        ).correlate_except(OrderItem).scalar_subquery()
+
+    @hybrid_property
     def total_items(self):
         """Calculate total number of items"""
         return sum(item.quantity for item in self.items)
 
+    @total_items.expression
+    def total_items(cls):
+        return select(func.coalesce(func.sum(OrderItem.quantity), 0)).where(
+            OrderItem.order_id == cls.id
+        ).correlate_except(OrderItem).scalar_subquery()
+
     def __repr__(self):
         return f'<Order #{self.id} - {self.supplier.name}>'
 
@@ -120,25 +267,93 @@ class OrderItem(db.Model):
     quantity = db.Column(db.Integer, nullable=False)
     unit_price = db.Column(db.Float)
 
-    @property
+    __table_args__ = (
+        db.Index('ix_order_item_order_id', 'order_id'),
+        db.Index('ix_order_item_medicine_id', 'medicine_id'),
+    )
+
+    @hybrid_property
     def total_price(self):
         """Calculate total price for this item"""
         return (self.unit_price or 0) * self.quantity
 
+    @total_price.expression
+    def total_price(cls):
+        return func.coalesce(cls.unit_price, 0) * cls.quantity
+
     def __repr__(self):
         return f'<OrderItem {self.medicine.name} - {self.quantity} units>'
     
 class StockTransaction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     batch_id = db.Column(db.Integer, db.ForeignKey('batch.id'), nullable=False)
-    transaction_type = db.Column(db.String(20), nullable=False)  # in, out
+    transaction_type = db.Column(db.String(20), nullable=False)  # in, out, adjust (signed quantity)
     quantity = db.Column(db.Integer, nullable=False)
     transaction_date = db.Column(db.DateTime, default=datetime.utcnow)
     performed_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     notes = db.Column(db.String(200))
+
+    __table_args__ = (
+        db.Index('ix_stock_transaction_date', 'transaction_date'),
+        db.Index('ix_stock_transaction_type_date', 'transaction_type', 'transaction_date'),
+        db.Index('ix_stock_transaction_batch_id', 'batch_id'),
+    )
     
     # Relationships
     user = db.relationship('User', backref='transactions')
 
     def __repr__(self):
-        return f'<Transaction {self.transaction_type} - {self.batch.medicine.name}>'
\ No newline at end of file
+        return f'<Transaction {self.transaction_type} - {self.batch.medicine.name}>'
+
+class DataVersion(db.Model):
+    """Change counter per table, bumped in the same transaction as every write (see data_versions.py)"""
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<DataVersion {self.name}={self.version}>'
+
+class OutboundEmail(db.Model):
+    """Queued notification email, delivered and retried by notifications.py"""
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_outbound_email_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+
+    def __repr__(self):
+        return f'<OutboundEmail {self.recipient} {self.status}>'
+
+class SchedulerLock(db.Model):
+    """Lease held by the one worker process that runs scheduled jobs (see scheduling.py)"""
+    name = db.Column(db.String(50), primary_key=True)
+    owner = db.Column(db.String(120), nullable=False)
+    acquired_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<SchedulerLock {self.name} {self.owner}>'
+
+class JobStat(db.Model):
+    """Outcome of the latest run of a scheduled job, with run and failure totals"""
+    job_id = db.Column(db.String(100), primary_key=True)
+    last_started_at = db.Column(db.DateTime)
+    last_finished_at = db.Column(db.DateTime)
+    last_duration = db.Column(db.Float)  # seconds
+    last_outcome = db.Column(db.String(20))  # success, error, missed
+    last_error = db.Column(db.String(500))
+    last_owner = db.Column(db.String(120))  # worker that ran it
+    run_count = db.Column(db.Integer, nullable=False, default=0)
+    failure_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<JobStat {self.job_id} {self.last_outcome}>'
@@ -0,0 +1,161 @@
+import os
+import smtplib
+import threading
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+from sqlalchemy import insert
+from models import db, OutboundEmail
+
+# Outbound email queue.
+#
+# Messages are rows of OutboundEmail, so nothing is lost when the SMTP server
+# is down or the process restarts. deliver_pending() sends every due message
+# over a single SMTP connection (one STARTTLS and login per run, not per
+# recipient). A recipient the server refuses is retried on its own; a dropped
+# connection puts the rest of the run back in the queue. Failed messages are
+# retried with exponential backoff (MAIL_RETRY_DELAY * 2^attempts) and marked
+# failed after MAIL_MAX_ATTEMPTS. Point MAIL_SERVER/MAIL_PORT at a local
+# stand-in with MAIL_USE_TLS off to test, e.g.
+# `python -m aiosmtpd -n -l localhost:1025`.
+
+PENDING = 'pending'
+SENT = 'sent'
+FAILED = 'failed'
+
+
+def _connection_lost(error):
+    """True for errors that end the SMTP session rather than reject one message"""
+    # SMTPException is an OSError too, so socket errors have to be told apart from replies
+    return isinstance(error, smtplib.SMTPServerDisconnected) or not isinstance(error, smtplib.SMTPException)
+
+
+class Mailer:
+    def __init__(self, app=None):
+        self.app = None
+        # One delivery run at a time per process
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MAIL_SERVER', os.environ.get('MAIL_SERVER', 'smtp.gmail.com'))
+        app.config.setdefault('MAIL_PORT', int(os.environ.get('MAIL_PORT', 587)))
+        app.config.setdefault('MAIL_USE_TLS', os.environ.get('MAIL_USE_TLS', '1') != '0')
+        app.config.setdefault('MAIL_USERNAME', os.environ.get('MAIL_USERNAME'))
+        app.config.setdefault('MAIL_PASSWORD', os.environ.get('MAIL_PASSWORD'))
+        app.config.setdefault('MAIL_SENDER', os.environ.get('MAIL_SENDER', 'your-email@example.com'))
+        app.config.setdefault('MAIL_TIMEOUT', 30)
+        app.config.setdefault('MAIL_MAX_ATTEMPTS', 5)
+        app.config.setdefault('MAIL_RETRY_DELAY', 60)
+        app.config.setdefault('MAIL_BATCH_SIZE', 100)
+        self.app = app
+        app.extensions['mailer'] = self
+
+    def enqueue(self, recipients, subject, body):
+        """Queue one message per recipient and commit, returns how many were queued"""
+        count = self.queue(recipients, subject, body)
+        if count:
+            db.session.commit()
+        return count
+
+    def queue(self, recipients, subject, body, session=None):
+        """Queue one message per recipient in the current transaction, returns how many were queued"""
+        recipients = sorted({recipient.strip() for recipient in recipients if recipient and recipient.strip()})
+        if not recipients:
+            return 0
+        now = datetime.utcnow()
+        (session or db.session).execute(insert(OutboundEmail), [{
+            'recipient': recipient,
+            'subject': subject,
+            'body': body,
+            'status': PENDING,
+            'attempts': 0,
+            'next_attempt_at': now,
+            'created_at': now,
+        } for recipient in recipients])
+        return len(recipients)
+
+    def connect(self):
+        config = self.app.config
+        server = smtplib.SMTP(config['MAIL_SERVER'], config['MAIL_PORT'], timeout=config['MAIL_TIMEOUT'])
+        if config['MAIL_USE_TLS']:
+            server.starttls()
+        if config['MAIL_USERNAME']:
+            server.login(config['MAIL_USERNAME'], config['MAIL_PASSWORD'])
+        return server
+
+    def build_message(self, email):
+        message = MIMEText(email.body, 'plain')
+        message['From'] = self.app.config['MAIL_SENDER']
+        message['To'] = email.recipient
+        message['Subject'] = email.subject
+        return message
+
+    def _failed(self, email, error, now):
+        email.attempts += 1
+        email.last_error = str(error)[:500]
+        if email.attempts >= self.app.config['MAIL_MAX_ATTEMPTS']:
+            email.status = FAILED
+            self.app.logger.error('Giving up on email %s to %s: %s', email.id, email.recipient, error)
+        else:
+            delay = self.app.config['MAIL_RETRY_DELAY'] * 2 ** (email.attempts - 1)
+            email.next_attempt_at = now + timedelta(seconds=delay)
+            self.app.logger.warning('Email %s to %s failed, retrying in %ss: %s',
+                                    email.id, email.recipient, delay, error)
+
+    def deliver_pending(self):
+        """Send every due message over one connection and commit, returns {'sent': n, 'failed': n}"""
+        with self.lock:
+            now = datetime.utcnow()
+            due = OutboundEmail.query.filter(
+                OutboundEmail.status == PENDING,
+                OutboundEmail.next_attempt_at <= now
+            ).order_by(OutboundEmail.next_attempt_at, OutboundEmail.id).limit(self.app.config['MAIL_BATCH_SIZE']).all()
+            result = {'sent': 0, 'failed': 0}
+            if not due:
+                return result
+
+            try:
+                server = self.connect()
+            except OSError as e:
+                for email in due:
+                    self._failed(email, e, now)
+                result['failed'] = len(due)
+                db.session.commit()
+                return result
+
+            try:
+                for position, email in enumerate(due):
+                    try:
+                        server.send_message(self.build_message(email))
+                    except OSError as e:
+                        if not _connection_lost(e):
+                            self._failed(email, e, now)
+                            result['failed'] += 1
+                            continue
+                        # The rest of this run never reached the server
+                        for unsent in due[position:]:
+                            self._failed(unsent, e, now)
+                        result['failed'] += len(due) - position
+                        break
+                    else:
+                        email.status = SENT
+                        email.sent_at = datetime.utcnow()
+                        email.attempts += 1
+                        email.last_error = None
+                        result['sent'] += 1
+            finally:
+                try:
+                    server.quit()
+                except OSError:
+                    pass
+            db.session.commit()
+            return result
+
+    def queue_stats(self):
+        counts = dict(db.session.query(OutboundEmail.status, db.func.count(OutboundEmail.id))
+                      .group_by(OutboundEmail.status).all())
+        return {status: counts.get(status, 0) for status in (PENDING, SENT, FAILED)}
+
+
+mailer = Mailer()
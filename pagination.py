@@ -0,0 +1,107 @@
+import base64
+import json
+from datetime import date, datetime
+from sqlalchemy import and_, or_, Date, DateTime, Float, Integer
+
+# Keyset (cursor) pagination.
+#
+# A page is the next `limit` rows after (or before) the sort key and id of
+# the last row the client saw, so every page is an index range scan instead
+# of an OFFSET that re-reads every earlier row. Cursors are opaque tokens
+# holding that (sort value, id) pair.
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+
+class InvalidCursor(ValueError):
+    """Raised for a cursor token that cannot be decoded"""
+
+
+def encode_cursor(value, row_id):
+    if isinstance(value, (date, datetime)):
+        value = value.isoformat()
+    raw = json.dumps([value, row_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token, sort_expr):
+    """Turn a cursor back into (sort value, id), typed like sort_expr"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        value, row_id = json.loads(raw)
+        sort_type = getattr(sort_expr, 'type', None)
+        if value is not None:
+            if isinstance(sort_type, DateTime):
+                value = datetime.fromisoformat(value)
+            elif isinstance(sort_type, Date):
+                value = date.fromisoformat(value)
+            elif isinstance(sort_type, Integer):
+                value = int(value)
+            elif isinstance(sort_type, Float):
+                value = float(value)
+        return value, int(row_id)
+    except (ValueError, TypeError):
+        raise InvalidCursor('Invalid page cursor')
+
+
+def parse_limit(value, default=DEFAULT_LIMIT):
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(limit, MAX_LIMIT))
+
+
+class Page:
+    def __init__(self, items, next_cursor, prev_cursor, limit):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.limit = limit
+        self.next_url = None
+        self.prev_url = None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def keyset_page(query, sort_expr, id_expr, descending=False, limit=DEFAULT_LIMIT, after=None, before=None):
+    """Return the Page of query after (or before) a cursor, ordered by (sort_expr, id_expr)
+
+    sort_expr must not produce NULLs; wrap nullable columns in coalesce().
+    """
+    backwards = before is not None
+    cursor = before if backwards else after
+    # Paging backwards walks the opposite order and flips the rows afterwards
+    walk_descending = descending != backwards
+    if cursor is not None:
+        value, last_id = decode_cursor(cursor, sort_expr)
+        if walk_descending:
+            query = query.filter(or_(sort_expr < value, and_(sort_expr == value, id_expr < last_id)))
+        else:
+            query = query.filter(or_(sort_expr > value, and_(sort_expr == value, id_expr > last_id)))
+    if walk_descending:
+        query = query.order_by(sort_expr.desc(), id_expr.desc())
+    else:
+        query = query.order_by(sort_expr.asc(), id_expr.asc())
+
+    rows = query.add_columns(sort_expr.label('page_sort_key')).limit(limit + 1).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+    items = [row[0] for row in rows]
+    keys = [encode_cursor(row[-1], row[0].id) for row in rows]
+
+    if not keys:
+        return Page(items, None, None, limit)
+    if backwards:
+        # We came from a later page, so there is always one after this
+        return Page(items, keys[-1], keys[0] if more else None, limit)
+    return Page(items, keys[-1] if more else None, keys[0] if cursor is not None else None, limit)
@@ -0,0 +1,104 @@
+import re
+from array import array
+
+# Joins PDF documents written by ReportLab into one, part by part.
+#
+# ReportLab's canvas keeps every finished page until save(), so a long
+# report is rendered as a series of small documents instead, each handed to
+# PdfConcatenator.add_part() as soon as it is saved. Their objects are copied
+# to the output with new numbers, located through each part's xref table
+# rather than by searching the bytes, and only the dictionary before a
+# stream is rewritten, never the stream data. The parts' catalogs, page
+# trees and all but the first document info are dropped; their pages join
+# a single page tree written by finish(). Between parts only the object
+# offsets and page numbers are kept, so memory stays at one part plus a few
+# bytes per page however long the report is.
+
+_REFERENCE = re.compile(rb'(\d+) 0 R\b')
+_STREAM = re.compile(rb'>>\s*stream\r?\n')
+
+
+class PdfConcatenator:
+    def __init__(self, out):
+        self.out = out
+        self.position = 0
+        # offsets[n - 1] is where object n starts; 1 and 2 are the page tree root and catalog
+        self.offsets = array('q', [0, 0])
+        self.pages = array('q')
+        self.info = None
+        self._write(b'%PDF-1.3\n%\x93\x8c\x8b\x9e\n')
+
+    def _write(self, data):
+        self.out.write(data)
+        self.position += len(data)
+
+    def _object(self, number, body):
+        self.offsets[number - 1] = self.position
+        self._write(b'%d 0 obj\n' % number + body + b'\nendobj\n')
+
+    def _reserve(self):
+        self.offsets.append(0)
+        return len(self.offsets)
+
+    def add_part(self, data):
+        """Append the pages of one complete PDF written by ReportLab"""
+        objects, root, info = _read_objects(data)
+        catalog = objects.pop(root)
+        tree = int(re.search(rb'/Pages (\d+) 0 R', catalog).group(1))
+        objects.pop(tree)
+        if self.info is None:
+            self.info = objects.pop(info)
+        else:
+            objects.pop(info)
+        numbers = {tree: 1}
+        for old in objects:
+            numbers[old] = self._reserve()
+        for old, body in objects.items():
+            head, stream = _split_stream(body)
+            head = _REFERENCE.sub(lambda match: b'%d 0 R' % numbers[int(match.group(1))], head)
+            self._object(numbers[old], head + stream)
+            if re.search(rb'/Type /Page\b', head):
+                self.pages.append(numbers[old])
+
+    def finish(self):
+        """Write the page tree, catalog, document info and cross-reference table"""
+        kids = b' '.join(b'%d 0 R' % page for page in self.pages)
+        self._object(1, b'<<\n/Count %d /Kids [ %s ] /Type /Pages\n>>' % (len(self.pages), kids))
+        self._object(2, b'<<\n/PageMode /UseNone /Pages 1 0 R /Type /Catalog\n>>')
+        info = self._reserve()
+        self._object(info, self.info or b'<<\n>>')
+        xref = self.position
+        size = len(self.offsets) + 1
+        self._write(b'xref\n0 %d\n0000000000 65535 f \n' % size)
+        for offset in self.offsets:
+            self._write(b'%010d 00000 n \n' % offset)
+        self._write(b'trailer\n<<\n/Info %d 0 R\n/Root 2 0 R\n/Size %d\n>>\nstartxref\n%d\n%%%%EOF\n'
+                    % (info, size, xref))
+
+
+def _read_objects(data):
+    """{number: body} of the objects of a PDF, with its catalog and document info numbers"""
+    xref = int(re.findall(rb'startxref\s+(\d+)', data)[-1])
+    lines = data[xref:].split(b'\n')
+    count = int(lines[1].split()[1])
+    starts = {number: int(lines[2 + number][:10]) for number in range(1, count)}
+    trailer = data[xref:]
+    root = int(re.search(rb'/Root (\d+) 0 R', trailer).group(1))
+    info = int(re.search(rb'/Info (\d+) 0 R', trailer).group(1))
+    # Each object runs up to the next one in the file, the last up to the xref table
+    ends = sorted(starts.values()) + [xref]
+    following = {start: ends[index + 1] for index, start in enumerate(ends[:-1])}
+    objects = {}
+    for number, start in sorted(starts.items()):
+        chunk = data[start:following[start]].rstrip()
+        header = re.match(rb'\d+ 0 obj\s*', chunk)
+        objects[number] = chunk[header.end():-len(b'endobj')].rstrip()
+    return objects, root, info
+
+
+def _split_stream(body):
+    """The dictionary of an object and its stream (empty for objects without one)"""
+    match = _STREAM.search(body)
+    if match is None:
+        return body, b''
+    return body[:match.end()], body[match.end():]
@@ -0,0 +1,108 @@
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Per-route SQL query budgets.
+#
+# Views declare the most statements one request may run with @query_budget(n),
+# counting the user load of Flask-Login for when it misses the user cache. Pages load their rows and the
+# relationships their templates walk with eager loading, so a budget is a
+# constant: a lazy load that sneaks into a template makes the count grow with
+# the row count and blows the budget on any non-trivial data set. Over-budget requests raise QueryBudgetExceeded when
+# QUERY_BUDGET_ENFORCE is set (it follows TESTING by default) and are logged
+# as warnings otherwise. The check-query-budgets command runs every budgeted
+# page against the current database.
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised when a request runs more queries than its view's budget"""
+
+
+def query_budget(limit):
+    """Declare the most SQL statements a GET request to a view may run"""
+    def decorator(view):
+        view.query_budget = limit
+        return view
+    return decorator
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    # Background threads have an app context but no request to charge
+    if has_request_context() and 'query_count' in g:
+        g.query_count += 1
+
+
+class QueryBudget:
+    def __init__(self, app=None):
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('QUERY_BUDGET_ENFORCE', None)
+        app.config.setdefault('QUERY_BUDGET_HEADER', False)
+        self.app = app
+        if not event.contains(Engine, 'before_cursor_execute', _count_query):
+            event.listen(Engine, 'before_cursor_execute', _count_query)
+        app.before_request(self._start)
+        app.after_request(self._check)
+        app.extensions['query_budget'] = self
+
+    def budget_for(self, endpoint):
+        view = self.app.view_functions.get(endpoint)
+        return getattr(view, 'query_budget', None)
+
+    def _start(self):
+        g.query_count = 0
+
+    def _check(self, response):
+        count = g.pop('query_count', None)
+        if count is None:
+            return response
+        if self.app.config['QUERY_BUDGET_HEADER']:
+            response.headers['X-Query-Count'] = str(count)
+        # Form posts write and redirect; only page views have a fixed shape
+        budget = self.budget_for(request.endpoint) if request.method in ('GET', 'HEAD') else None
+        if budget is not None and count > budget:
+            message = f'{request.endpoint} ran {count} queries, its budget is {budget}'
+            enforce = self.app.config['QUERY_BUDGET_ENFORCE']
+            if enforce is None:
+                enforce = self.app.testing
+            if enforce:
+                raise QueryBudgetExceeded(message)
+            self.app.logger.warning(message)
+        return response
+
+    def budgeted_pages(self):
+        """(endpoint, url path, budget) of budgeted GET views that take no URL arguments"""
+        pages = []
+        for rule in self.app.url_map.iter_rules():
+            budget = self.budget_for(rule.endpoint)
+            if budget is not None and 'GET' in rule.methods and not rule.arguments:
+                pages.append((rule.endpoint, rule.rule, budget))
+        return sorted(pages, key=lambda page: page[1])
+
+    def check_pages(self, user_id):
+        """Request every budgeted page as user_id, returns (endpoint, status, count, budget)"""
+        config = self.app.config
+        saved = config['QUERY_BUDGET_ENFORCE'], config['QUERY_BUDGET_HEADER']
+        config['QUERY_BUDGET_ENFORCE'], config['QUERY_BUDGET_HEADER'] = False, True
+        results = []
+        try:
+            client = self.app.test_client()
+            with client.session_transaction() as session:
+                session['_user_id'] = str(user_id)
+                session['_fresh'] = True
+            for endpoint, path, budget in self.budgeted_pages():
+                # A fresh app context gives each request its own session, so rows
+                # left in the identity map by an earlier page cannot hide lazy loads
+                with self.app.app_context():
+                    response = client.get(path)
+                count = int(response.headers.get('X-Query-Count', 0))
+                results.append((endpoint, response.status_code, count, budget))
+        finally:
+            config['QUERY_BUDGET_ENFORCE'], config['QUERY_BUDGET_HEADER'] = saved
+        return results
+
+
+query_budgets = QueryBudget()
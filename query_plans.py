@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta
+from models import db, Medicine, Batch, Order, StockTransaction
+from list_views import LISTS
+
+# EXPLAIN QUERY PLAN check for the queries the app runs on every page view.
+# Each entry builds the same query the route issues; the check fails when
+# SQLite answers one of them with a plain table scan instead of an index.
+# The first page of every list in every sort must also come straight out of
+# an index in sort order, so that LIMIT stops the walk after one page
+# instead of sorting the whole table first.
+
+
+def hot_queries():
+    """Return (name, query) pairs for the queries that must stay index-backed"""
+    today = datetime.now().date()
+    now = datetime.now()
+    start_of_day = datetime.combine(today, datetime.min.time())
+    return [
+        ('dashboard low stock', Batch.query.filter(Batch.quantity <= 10)),
+        ('dashboard expiring soon', Batch.query.filter(
+            Batch.expiration_date <= today + timedelta(days=30),
+            Batch.expiration_date > today
+        )),
+        ('dashboard recent transactions', StockTransaction.query.order_by(
+            StockTransaction.transaction_date.desc()
+        ).limit(10)),
+        ('dashboard pending orders', Order.query.filter_by(status='pending')),
+        ('add_order double-submit check', Order.query.filter_by(
+            supplier_id=1, created_by=1
+        ).order_by(Order.order_date.desc()).limit(1)),
+        ('orders list', Order.query.order_by(Order.order_date.desc())),
+        ('process_order latest batch', Batch.query.filter_by(
+            medicine_id=1
+        ).order_by(Batch.expiration_date.desc()).limit(1)),
+        ('transactions of a batch', StockTransaction.query.filter_by(batch_id=1)),
+        ('transactions in date range', StockTransaction.query.filter(
+            StockTransaction.transaction_date >= start_of_day,
+            StockTransaction.transaction_date < now
+        )),
+        ('received today', StockTransaction.query.filter(
+            StockTransaction.transaction_type == 'in',
+            StockTransaction.transaction_date >= start_of_day,
+            StockTransaction.transaction_date < now
+        )),
+        ('stock balance refresh', db.session.query(Batch.medicine_id, Batch.quantity).filter(
+            Batch.medicine_id.in_([1, 2])
+        )),
+        ('medicines of a supplier', Medicine.query.filter_by(supplier_id=1)),
+    ]
+
+
+def list_page_queries():
+    """Return (name, query) pairs for the first page of every list in every sort"""
+    return [
+        (f'{name} list page by {sort}', _list_page_query(name, sort))
+        for name, view in LISTS.items() for sort in view.sorts
+    ]
+
+
+def _list_page_query(name, sort):
+    """The first page query of a list in one of its sorts, as keyset_page builds it"""
+    view = LISTS[name]
+    descending = view.default_descending if sort == view.default_sort else False
+    expression, tiebreak = view.sorts[sort], view.tiebreak(sort)
+    walk = expression.desc() if descending else expression.asc()
+    order_id = tiebreak.desc() if descending else tiebreak.asc()
+    return view.query().order_by(walk, order_id).limit(51)
+
+
+def explain(query):
+    """Return the EXPLAIN QUERY PLAN detail lines for an ORM query"""
+    # Literal values keep expanding IN lists and date parameters out of the driver call
+    compiled = query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})
+    with db.engine.connect() as conn:
+        rows = conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}').fetchall()
+    return [row[-1] for row in rows]
+
+
+def uses_index(details):
+    """False if any step of the plan walks a table without an index"""
+    for detail in details:
+        if detail.startswith('SCAN') and 'USING' not in detail:
+            return False
+    return True
+
+
+def reads_in_order(details):
+    """False if the plan sorts rows, or scans a table other than the one it walks in order"""
+    if any('TEMP B-TREE' in detail for detail in details):
+        return False
+    return uses_index(details[1:])
+
+
+def check_query_plans():
+    """Explain every hot query and list page query, returns a list of (name, details, ok)"""
+    results = []
+    for name, query in hot_queries():
+        details = explain(query)
+        results.append((name, details, uses_index(details)))
+    for name, query in list_page_queries():
+        details = explain(query)
+        results.append((name, details, reads_in_order(details)))
+    return results
@@ -0,0 +1,127 @@
+from datetime import datetime, timedelta
+from sqlalchemy import bindparam, func, insert, select, update
+from models import db, Batch, Order, OrderItem, StockTransaction
+from stock import refresh_stock_balances
+from stock_events import record_movement, RECEIVE
+
+# Receiving delivered orders into stock.
+#
+# Any number of pending orders is processed with a fixed number of statements:
+# one query for their items, one grouped query for each medicine's target
+# batch, then bulk inserts and executemany updates, all in one transaction.
+# The rules match processing orders one at a time: an item goes into the
+# medicine's latest-expiring batch if that batch has not expired, otherwise
+# into a new ORDER-<order>-<medicine> batch that later items of the same
+# medicine then share.
+
+
+class ReceiveConflict(Exception):
+    """Raised when another user processed one of the orders at the same time"""
+
+
+def _target_batches(medicine_ids):
+    """Latest-expiring batch per medicine, as {medicine_id: (batch_id, expiration_date)}"""
+    ranked = select(
+        Batch.id, Batch.medicine_id, Batch.expiration_date,
+        func.row_number().over(
+            partition_by=Batch.medicine_id,
+            order_by=(Batch.expiration_date.desc(), Batch.id.desc())
+        ).label('position')
+    ).where(Batch.medicine_id.in_(medicine_ids)).subquery()
+    rows = db.session.execute(
+        select(ranked.c.id, ranked.c.medicine_id, ranked.c.expiration_date).where(ranked.c.position == 1)
+    )
+    return {row.medicine_id: (row.id, row.expiration_date) for row in rows}
+
+
+def receive_orders(order_ids, user_id):
+    """Receive every pending order among order_ids into stock and commit
+
+    Returns a dict with the received and skipped order ids, the number of
+    items and the number of batches created. Orders that do not exist or are
+    not pending are skipped. Raises ReceiveConflict if an order stopped being
+    pending while this ran.
+    """
+    order_ids = sorted({int(order_id) for order_id in order_ids})
+    items = db.session.query(
+        OrderItem.order_id, OrderItem.medicine_id, OrderItem.quantity, OrderItem.unit_price
+    ).join(Order).filter(
+        Order.id.in_(order_ids),
+        Order.status == 'pending'
+    ).order_by(OrderItem.order_id, OrderItem.id).all()
+    pending_ids = sorted(set(db.session.scalars(
+        select(Order.id).where(Order.id.in_(order_ids), Order.status == 'pending')
+    )))
+    summary = {
+        'received': pending_ids,
+        'skipped': [order_id for order_id in order_ids if order_id not in pending_ids],
+        'items': len(items),
+        'new_batches': 0,
+    }
+    if not pending_ids:
+        return summary
+
+    # Claim the orders first; a concurrent processor makes the count come up short
+    claimed = db.session.execute(
+        update(Order).where(Order.id.in_(pending_ids), Order.status == 'pending')
+        .values(status='delivered').execution_options(synchronize_session=False)
+    ).rowcount
+    if claimed != len(pending_ids):
+        db.session.rollback()
+        raise ReceiveConflict('Some of these orders were processed by someone else, please reload.')
+
+    today = datetime.now().date()
+    medicine_ids = sorted({item.medicine_id for item in items})
+    targets = {medicine_id: batch_id for medicine_id, (batch_id, expiration_date)
+               in _target_batches(medicine_ids).items() if expiration_date >= today}
+
+    received = {}
+    for item in items:
+        received[item.medicine_id] = received.get(item.medicine_id, 0) + item.quantity
+
+    # One new batch per medicine without a usable target, named after the first item that needs it
+    new_batches = {}
+    for item in items:
+        if item.medicine_id not in targets and item.medicine_id not in new_batches:
+            new_batches[item.medicine_id] = {
+                'batch_number': f"ORDER-{item.order_id}-{item.medicine_id}",
+                'medicine_id': item.medicine_id,
+                'quantity': received[item.medicine_id],
+                'expiration_date': today + timedelta(days=365),
+                'manufacturing_date': today,
+                'unit_price': item.unit_price,
+            }
+    batch_table = Batch.__table__
+    if new_batches:
+        created = db.session.execute(
+            insert(batch_table).returning(batch_table.c.id, batch_table.c.medicine_id),
+            list(new_batches.values())
+        )
+        for row in created:
+            targets[row.medicine_id] = row.id
+        summary['new_batches'] = len(new_batches)
+
+    top_ups = [{'target_id': targets[medicine_id], 'added': quantity}
+               for medicine_id, quantity in received.items() if medicine_id not in new_batches]
+    if top_ups:
+        db.session.execute(
+            batch_table.update().where(batch_table.c.id == bindparam('target_id'))
+            .values(quantity=batch_table.c.quantity + bindparam('added')),
+            top_ups
+        )
+    if items:
+        db.session.execute(insert(StockTransaction), [{
+            'batch_id': targets[item.medicine_id],
+            'transaction_type': 'in',
+            'quantity': item.quantity,
+            'performed_by': user_id,
+            'notes': f"From Order #{item.order_id}",
+        } for item in items])
+    new_numbers = {medicine_id: batch['batch_number'] for medicine_id, batch in new_batches.items()}
+    for item in items:
+        record_movement(RECEIVE, item.medicine_id, targets[item.medicine_id], item.quantity, user_id,
+                        batch_number=new_numbers.get(item.medicine_id))
+
+    refresh_stock_balances(medicine_ids)
+    db.session.commit()
+    return summary
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from date_ranges import range_from_args
+from data_versions import watermark
+from reports import render_report
+
+# Disk cache for generated PDF reports.
+#
+# A cached file is named after the report variant (type plus resolved
+# parameters) and the data watermark it was rendered from, i.e. the change
+# counters of every table the report reads. Writing any of those tables moves
+# the watermark, so the next request misses and the variant's old file is
+# dropped. The directory is kept under REPORT_CACHE_MAX_BYTES by evicting the
+# least recently used files; hits touch their file's mtime. File names are
+# deterministic, so several worker processes can share one directory.
+
+REPORT_TABLES = {
+    'history': ('stock_transaction', 'batch', 'medicine', 'user'),
+    'today-total': ('stock_transaction', 'batch', 'medicine', 'supplier'),
+}
+
+
+def _digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()[:24]
+
+
+class ReportCache:
+    def __init__(self, app=None):
+        self.app = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('REPORT_CACHE_DIR', os.path.join(app.instance_path, 'report_cache'))
+        app.config.setdefault('REPORT_CACHE_MAX_BYTES', 200 * 1024 * 1024)
+        self.app = app
+        app.extensions['report_cache'] = self
+
+    @property
+    def directory(self):
+        return self.app.config['REPORT_CACHE_DIR']
+
+    def variant_key(self, report_type, params):
+        """Identify a report by type and resolved parameters, so 'today' differs per day"""
+        resolved = dict(params)
+        if report_type == 'history':
+            start, end, _ = range_from_args(params)
+            resolved['range'] = [start, end]
+        return _digest([report_type, resolved])
+
+    def path_for(self, report_type, params):
+        """Cache file path for a report at the current data watermark"""
+        mark = watermark(REPORT_TABLES[report_type])
+        variant = self.variant_key(report_type, params)
+        return os.path.join(self.directory, f'{variant}-{_digest(mark)}.pdf'), variant
+
+    def get_or_render(self, report_type, params, cancelled=None):
+        """Return the path of the cached report, rendering it first on a miss"""
+        path, variant = self.path_for(report_type, params)
+        if os.path.exists(path):
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            with self.lock:
+                self.hits += 1
+            return path
+
+        with self.lock:
+            self.misses += 1
+        os.makedirs(self.directory, exist_ok=True)
+        partial = f'{path}.{threading.get_ident()}.part'
+        try:
+            with open(partial, 'wb') as out:
+                render_report(report_type, params, out, cancelled)
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        self._drop_stale(variant, keep=path)
+        self.evict()
+        return path
+
+    def copy_to(self, report_type, params, destination, cancelled=None):
+        """Write the report to destination, served from the cache when possible"""
+        path = self.get_or_render(report_type, params, cancelled)
+        shutil.copyfile(path, destination)
+
+    def _drop_stale(self, variant, keep):
+        # Renders of the same variant at an older watermark can never be hit again
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(f'{variant}-') and name.endswith('.pdf') and path != keep:
+                self._remove(path)
+
+    def evict(self):
+        """Delete least recently used files until the cache fits its size cap"""
+        if not os.path.isdir(self.directory):
+            return
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.pdf'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        limit = self.app.config['REPORT_CACHE_MAX_BYTES']
+        for _, size, path in sorted(entries):
+            if total <= limit:
+                break
+            if self._remove(path):
+                total -= size
+                with self.lock:
+                    self.evictions += 1
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                self._remove(os.path.join(self.directory, name))
+
+    def stats(self):
+        files = 0
+        size = 0
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith('.pdf'):
+                    try:
+                        size += os.path.getsize(os.path.join(self.directory, name))
+                    except OSError:
+                        continue
+                    files += 1
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'files': files,
+                'bytes': size,
+                'max_bytes': self.app.config['REPORT_CACHE_MAX_BYTES'],
+            }
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+
+report_cache = ReportCache()
@@ -0,0 +1,183 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from reports import report_filename, ReportCancelled
+from report_cache import report_cache
+
+# Background PDF report jobs.
+#
+# Report routes used to render inside the request, so a handful of large
+# exports could tie up every web worker. Jobs are instead handed to a bounded
+# thread pool; the client gets a job id, polls its status and downloads the
+# finished file. Job metadata lives in this process, artifacts live on disk
+# under REPORT_JOB_DIR and are removed REPORT_JOB_TTL seconds after finishing.
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+ACTIVE_STATES = (PENDING, RUNNING)
+
+
+class TooManyReportJobs(Exception):
+    """Raised when a user already has the maximum number of active jobs"""
+
+
+class ReportJob:
+    def __init__(self, user_id, report_type, params):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.report_type = report_type
+        self.params = params
+        self.filename = report_filename(report_type, params)
+        self.status = PENDING
+        self.error = None
+        self.path = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_requested = threading.Event()
+        self.future = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'report': self.report_type,
+            'params': self.params,
+            'status': self.status,
+            'error': self.error,
+            'filename': self.filename,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+    def __repr__(self):
+        return f'<ReportJob {self.id} {self.report_type} {self.status}>'
+
+
+class ReportJobQueue:
+    def __init__(self, app=None):
+        self.app = None
+        self.executor = None
+        self.jobs = {}
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('REPORT_JOB_WORKERS', 2)
+        app.config.setdefault('REPORT_JOBS_PER_USER', 2)
+        app.config.setdefault('REPORT_JOB_TTL', 3600)
+        app.config.setdefault('REPORT_JOB_DIR', os.path.join(app.instance_path, 'report_jobs'))
+        self.app = app
+        self.executor = ThreadPoolExecutor(
+            max_workers=app.config['REPORT_JOB_WORKERS'],
+            thread_name_prefix='report-job'
+        )
+        app.extensions['report_jobs'] = self
+
+    def submit(self, user_id, report_type, params):
+        """Queue a report for a user, raises TooManyReportJobs past the per-user limit"""
+        job = ReportJob(user_id, report_type, params)
+        with self.lock:
+            active = sum(1 for other in self.jobs.values()
+                         if other.user_id == user_id and other.status in ACTIVE_STATES)
+            if active >= self.app.config['REPORT_JOBS_PER_USER']:
+                raise TooManyReportJobs(
+                    f"You already have {active} reports in progress. Wait for one to finish."
+                )
+            self.jobs[job.id] = job
+        job.future = self.executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def jobs_for(self, user_id):
+        """Jobs of a user, newest first"""
+        with self.lock:
+            jobs = [job for job in self.jobs.values() if job.user_id == user_id]
+        return sorted(jobs, key=lambda job: job.created_at, reverse=True)
+
+    def active_count(self):
+        """Jobs pending or running in this process"""
+        with self.lock:
+            return sum(1 for job in self.jobs.values() if job.status in ACTIVE_STATES)
+
+    def cancel(self, job_id):
+        """Cancel a pending job or ask a running one to stop, returns the job"""
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job.cancel_requested.set()
+        with self.lock:
+            if job.status == PENDING and job.future.cancel():
+                job.status = CANCELLED
+                job.finished_at = time.time()
+        return job
+
+    def cleanup(self):
+        """Forget finished jobs older than the TTL and delete their files, returns how many"""
+        cutoff = time.time() - self.app.config['REPORT_JOB_TTL']
+        with self.lock:
+            expired = [job for job in self.jobs.values()
+                       if job.finished_at is not None and job.finished_at < cutoff]
+            for job in expired:
+                del self.jobs[job.id]
+        for job in expired:
+            self._remove_file(job.path)
+        # Files left behind by a previous process have no job entry any more
+        directory = self.app.config['REPORT_JOB_DIR']
+        if os.path.isdir(directory):
+            with self.lock:
+                known_ids = set(self.jobs)
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if name.split('.')[0] not in known_ids and os.path.getmtime(path) < cutoff:
+                    self._remove_file(path)
+        return len(expired)
+
+    def _run(self, job):
+        with self.lock:
+            if job.status != PENDING:
+                return
+            job.status = RUNNING
+            job.started_at = time.time()
+        directory = self.app.config['REPORT_JOB_DIR']
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{job.id}.pdf')
+        partial = f'{path}.part'
+        try:
+            with self.app.app_context():
+                report_cache.copy_to(job.report_type, job.params, partial, job.cancel_requested.is_set)
+            if job.cancel_requested.is_set():
+                raise ReportCancelled()
+            os.replace(partial, path)
+            status, error = DONE, None
+        except ReportCancelled:
+            status, error, path = CANCELLED, None, None
+        except Exception as e:
+            status, error, path = FAILED, str(e), None
+        if path is None:
+            self._remove_file(partial)
+        with self.lock:
+            job.status = status
+            job.error = error
+            job.path = path
+            job.finished_at = time.time()
+
+    @staticmethod
+    def _remove_file(path):
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+report_jobs = ReportJobQueue()
@@ -0,0 +1,348 @@
+import io
+import math
+import time
+from datetime import datetime
+from tempfile import SpooledTemporaryFile
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
+from reportlab.lib.pagesizes import letter
+from reportlab.pdfgen import canvas
+from models import db, Supplier, Medicine, Batch, StockTransaction
+from date_ranges import apply_range, period_range, range_from_args
+from metrics import metrics
+from pdf_concat import PdfConcatenator
+
+# PDF report rendering shared by the report routes.
+#
+# Reports are written to a SpooledTemporaryFile that moves to disk once it
+# outgrows SPOOL_MAX_SIZE, and the caller streams that file to the client.
+# Transaction rows are read in chunks of CHUNK_SIZE with their batch, medicine
+# and user joined in, so the ORM never holds more than one chunk. ReportLab's
+# canvas keeps every finished page (about 40 KB of heap each) until it saves
+# the document, so the history is drawn as separate documents of
+# PART_PAGES pages that are appended to the output one at a time by
+# pdf_concat.PdfConcatenator, and memory stays flat however long the
+# history is.
+
+CHUNK_SIZE = 500
+PART_PAGES = 50
+SPOOL_MAX_SIZE = 1024 * 1024
+HISTORY_COLUMNS = [45, 110, 220, 280, 325, 360, 430, 510, 570]
+ROW_HEIGHT = 20
+REPORT_TYPES = ('history', 'today-total')
+
+
+class ReportCancelled(Exception):
+    """Raised from inside a render when its caller asked it to stop"""
+
+
+def report_params(report_type, args):
+    """Validate request arguments for a report type and return its normalised parameters
+
+    Raises ValueError for unknown report types and bad date ranges.
+    """
+    if report_type == 'history':
+        params = {
+            'filter': args.get('filter', 'all'),
+            'from': args.get('from') or None,
+            'to': args.get('to') or None,
+        }
+        range_from_args(params)
+        return params
+    if report_type == 'today-total':
+        return {'date': datetime.now().date().isoformat()}
+    raise ValueError(f"Unknown report type: {report_type}")
+
+
+def report_filename(report_type, params):
+    """Download name for a report"""
+    if report_type == 'history':
+        filter_type = 'custom' if params.get('from') or params.get('to') else params['filter']
+        return f"transaction_history_{filter_type}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
+    return f"today_total_stored_{params['date'].replace('-', '')}.pdf"
+
+
+def render_report(report_type, params, out, cancelled=None):
+    """Render a report by type into the file object out"""
+    if report_type not in REPORT_TYPES:
+        raise ValueError(f"Unknown report type: {report_type}")
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        if report_type == 'history':
+            start, end, range_label = range_from_args(params)
+            render_transaction_history(out, start, end, range_label, cancelled)
+        else:
+            render_today_total(out)
+        outcome = 'ok'
+    except ReportCancelled:
+        outcome = 'cancelled'
+        raise
+    finally:
+        metrics.report_seconds.observe((report_type, outcome), time.perf_counter() - started)
+
+
+def new_spool():
+    """Return a temporary file that stays in memory until it gets large"""
+    return SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+
+
+def transaction_history_query(start=None, end=None):
+    """Transactions in [start, end), newest first, with batch, medicine and user eager-joined"""
+    query = StockTransaction.query.options(
+        joinedload(StockTransaction.batch).joinedload(Batch.medicine),
+        joinedload(StockTransaction.user)
+    ).order_by(StockTransaction.transaction_date.desc(), StockTransaction.id.desc())
+    return apply_range(query, StockTransaction.transaction_date, start, end)
+
+
+def _draw_history_header(p, width, height, generated, range_label):
+    # Header
+    p.setFillColorRGB(0.13, 0.45, 0.71)  # Blue header
+    p.rect(0, height - 70, width, 70, fill=1, stroke=0)
+    p.setFillColorRGB(1, 1, 1)
+    p.setFont("Helvetica-Bold", 22)
+    p.drawString(50, height - 45, "RHU Inventory Transaction History")
+    p.setFont("Helvetica", 12)
+    p.drawString(50, height - 65, f"Generated: {generated}")
+    p.drawRightString(width - 50, height - 65, f"Filter: {range_label}")
+
+    # Table header styling
+    y = height - 90
+    p.setFillColorRGB(0.9, 0.9, 0.9)
+    p.rect(40, y - 5, width - 80, 25, fill=1, stroke=0)
+    p.setFillColorRGB(0.13, 0.45, 0.71)
+    p.setFont("Helvetica-Bold", 11)
+    for x, title in zip(HISTORY_COLUMNS, ["Date", "Medicine", "Batch", "Type", "Qty",
+                                          "Unit Price", "Total Price", "By", "Role"]):
+        p.drawString(x, y + 10, title)
+    # Draw a visible line under the table header
+    p.setStrokeColorRGB(0.13, 0.45, 0.71)
+    p.setLineWidth(1.5)
+    p.line(40, y - 2, width - 40, y - 2)
+    p.setFont("Helvetica", 10)
+    return y - 25  # More spacing after header
+
+
+def _draw_history_footer(p, width, page, pages):
+    p.setFillColorRGB(0.13, 0.45, 0.71)
+    p.rect(0, 0, width, 30, fill=1, stroke=0)
+    p.setFillColorRGB(1, 1, 1)
+    p.setFont("Helvetica", 10)
+    p.drawString(50, 12, "RHU Inventory System | Transaction History Report")
+    p.drawRightString(width - 50, 12, f"Page {page} of {pages}")
+
+
+def _history_rows_per_page(height):
+    # Rows start below the table header and stop once y drops under 60
+    first_row_y = height - 90 - 25
+    return math.floor((first_row_y - 60) / ROW_HEIGHT) + 1
+
+
+def _new_part():
+    """A canvas for the next PART_PAGES pages of a report, and the buffer it saves to"""
+    part = io.BytesIO()
+    return part, canvas.Canvas(part, pagesize=letter, pageCompression=1)
+
+
+def render_transaction_history(out, start=None, end=None, range_label='All', cancelled=None):
+    """Write the transaction history PDF for [start, end) to the file object out
+
+    cancelled is an optional callable polled once per chunk; when it returns
+    True the render stops with ReportCancelled.
+    """
+    width, height = letter
+    generated = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    # Pin the row set to what exists now so the page count matches the rows drawn
+    query = transaction_history_query(start, end)
+    max_id = db.session.query(func.max(StockTransaction.id)).scalar() or 0
+    query = query.filter(StockTransaction.id <= max_id)
+    total = apply_range(
+        db.session.query(func.count(StockTransaction.id)).filter(StockTransaction.id <= max_id),
+        StockTransaction.transaction_date, start, end
+    ).scalar()
+    pages = max(1, math.ceil(total / _history_rows_per_page(height)))
+
+    output = PdfConcatenator(out)
+    part, p = _new_part()
+    page = 1
+    y = _draw_history_header(p, width, height, generated, range_label)
+
+    # Table rows
+    alt = False
+    for index, tx in enumerate(query.yield_per(CHUNK_SIZE)):
+        if cancelled is not None and index % CHUNK_SIZE == 0 and cancelled():
+            raise ReportCancelled()
+        if y < 60:
+            _draw_history_footer(p, width, page, pages)
+            if page % PART_PAGES == 0:
+                p.save()
+                output.add_part(part.getvalue())
+                part, p = _new_part()
+            else:
+                p.showPage()
+            page += 1
+            # Redraw header and table header on new page
+            y = _draw_history_header(p, width, height, generated, range_label)
+
+        # Alternate row color
+        if alt:
+            p.setFillColorRGB(0.96, 0.98, 1)
+            p.rect(40, y - 2, width - 80, 18, fill=1, stroke=0)
+        alt = not alt
+
+        # Data extraction
+        date_str = tx.transaction_date.strftime('%Y-%m-%d\n%H:%M')
+        medicine = tx.batch.medicine.name if tx.batch and tx.batch.medicine else "N/A"
+        batch_number = tx.batch.batch_number if tx.batch else "N/A"
+        tx_type = tx.transaction_type.upper()
+        qty = str(tx.quantity)
+        unit_price_value = (tx.batch.unit_price or 0) if tx.batch else 0
+        unit_price = f"{unit_price_value:,.2f}"
+        total_price = f"{unit_price_value * tx.quantity:,.2f}"
+        username = tx.user.username if tx.user else str(tx.performed_by)
+        role = tx.user.role if tx.user and tx.user.role else "N/A"
+
+        # Draw columns with more spacing and vertical lines
+        col_x = HISTORY_COLUMNS + [width - 40]
+        p.setFont("Helvetica", 10)
+        p.setFillColorRGB(0, 0, 0)
+        p.drawRightString(col_x[1] - 5, y + 8, date_str)  # Date (right-aligned, multi-line)
+        p.drawString(col_x[1] + 2, y + 8, medicine)
+        p.drawString(col_x[2], y + 8, batch_number)
+        p.setFont("Helvetica-Bold", 10)
+        # Type color
+        if tx_type == "IN":
+            p.setFillColorRGB(0.2, 0.7, 0.2)  # Green
+        elif tx_type == "OUT":
+            p.setFillColorRGB(0.85, 0.2, 0.2)  # Red
+        else:
+            p.setFillColorRGB(0.2, 0.2, 0.2)  # Gray
+        p.drawString(col_x[3], y + 8, tx_type)
+        p.setFont("Helvetica", 10)
+        p.setFillColorRGB(0, 0, 0)
+        p.drawString(col_x[4], y + 8, qty)
+        p.drawRightString(col_x[5] + 55, y + 8, unit_price)
+        p.drawRightString(col_x[6] + 70, y + 8, total_price)
+        p.drawString(col_x[7], y + 8, username)
+        p.drawString(col_x[8], y + 8, role)
+
+        # Draw vertical lines for columns
+        p.setStrokeColorRGB(0.7, 0.7, 0.7)
+        p.setLineWidth(0.5)
+        for x in col_x:
+            p.line(x - 5, y - 2, x - 5, y + 16)
+
+        y -= ROW_HEIGHT  # Increased row height for clarity
+
+    _draw_history_footer(p, width, page, pages)
+    p.save()
+    output.add_part(part.getvalue())
+    output.finish()
+    return page
+
+
+def render_today_total(out):
+    """Write the PDF of items stored today and current stock per item to the file object out"""
+    today = datetime.now().date()
+    # Get all 'in' transactions for today
+    start, end = period_range('today')
+    transactions = apply_range(
+        StockTransaction.query.options(
+            joinedload(StockTransaction.batch).joinedload(Batch.medicine)
+        ).filter(StockTransaction.transaction_type == 'in'),
+        StockTransaction.transaction_date, start, end
+    ).all()
+    total_quantity = sum(tx.quantity for tx in transactions)
+
+    # Get total stock per medicine, supplier, and generic name
+    stock_per_medicine = db.session.query(
+        Medicine.generic_name,
+        Medicine.name,
+        Supplier.name.label('supplier_name'),
+        func.sum(Batch.quantity).label('total_quantity')
+    ).join(Supplier, Medicine.supplier_id == Supplier.id).join(Batch).group_by(Medicine.generic_name, Medicine.name, Supplier.name).all()
+
+    # Generate PDF
+    p = canvas.Canvas(out, pagesize=letter)
+    width, height = letter
+
+    # Header
+    p.setFillColorRGB(0.13, 0.45, 0.71)
+    p.rect(0, height - 70, width, 70, fill=1, stroke=0)
+    p.setFillColorRGB(1, 1, 1)
+    p.setFont("Helvetica-Bold", 22)
+    p.drawString(50, height - 45, "RHU Inventory - Today's Stored Items")
+    p.setFont("Helvetica", 12)
+    p.drawString(50, height - 65, f"Date: {today.strftime('%Y-%m-%d')}")
+
+    # Body
+    y = height - 120
+    p.setFont("Helvetica-Bold", 14)
+    p.setFillColorRGB(0, 0, 0)
+    p.drawString(50, y, f"Total Items Stored Today: {total_quantity}")
+
+    y -= 25
+    p.setFont("Helvetica-Bold", 12)
+    p.drawString(50, y, "Total Current Stock per Item:")
+    y -= 20
+    p.setFont("Helvetica", 10)
+    p.drawString(50, y, "Generic Name")
+    p.drawString(170, y, "Medicine (Brand Name)")
+    p.drawString(320, y, "Supplier")
+    p.drawString(450, y, "Total Stock")
+    y -= 15
+    p.setStrokeColorRGB(0.13, 0.45, 0.71)
+    p.line(50, y, width - 50, y)
+    y -= 10
+
+    for item in stock_per_medicine:
+        if y < 60:
+            p.showPage()
+            y = height - 80
+        p.setFont("Helvetica", 10)
+        p.drawString(50, y, str(item.generic_name))
+        p.drawString(170, y, str(item.name))
+        p.drawString(320, y, str(item.supplier_name))
+        p.drawString(450, y, str(item.total_quantity))
+        y -= 15
+
+    y -= 20
+    p.setFont("Helvetica-Bold", 12)
+    p.drawString(50, y, "Breakdown of Today's Added Items:")
+    y -= 20
+    p.setFont("Helvetica", 10)
+    p.drawString(50, y, "Generic Name")
+    p.drawString(170, y, "Medicine")
+    p.drawString(320, y, "Batch")
+    p.drawString(420, y, "Quantity")
+    y -= 15
+    p.setStrokeColorRGB(0.13, 0.45, 0.71)
+    p.line(50, y, width - 50, y)
+    y -= 10
+
+    for tx in transactions:
+        if y < 60:
+            p.showPage()
+            y = height - 80
+        generic_name = tx.batch.medicine.generic_name if tx.batch and tx.batch.medicine else "N/A"
+        medicine = tx.batch.medicine.name if tx.batch and tx.batch.medicine else "N/A"
+        batch_number = tx.batch.batch_number if tx.batch else "N/A"
+        qty = tx.quantity
+        p.setFont("Helvetica", 10)
+        p.drawString(50, y, str(generic_name))
+        p.drawString(170, y, str(medicine))
+        p.drawString(320, y, str(batch_number))
+        p.drawString(420, y, str(qty))
+        y -= 15
+
+    # Footer
+    p.setFillColorRGB(0.13, 0.45, 0.71)
+    p.rect(0, 0, width, 30, fill=1, stroke=0)
+    p.setFillColorRGB(1, 1, 1)
+    p.setFont("Helvetica", 10)
+    p.drawString(50, 12, "RHU Inventory System | Today's Stored Items Report")
+    p.drawRightString(width - 50, 12, f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+
+    p.save()
@@ -0,0 +1,313 @@
+import atexit
+import os
+import socket
+import threading
+import time
+import uuid
+import click
+from datetime import datetime, timedelta
+from apscheduler.events import EVENT_JOB_MISSED
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from sqlalchemy import case, text
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import SQLAlchemyError
+from models import db, SchedulerLock, JobStat
+from metrics import metrics
+
+# Scheduled background jobs that run once across all worker processes.
+#
+# Every worker imports app.py and registers the same jobs, but only the one
+# holding the leader lock runs a scheduler. The lock is a scheduler_lock row
+# with an owner and a lease expiry: the leader renews it every
+# SCHEDULER_LOCK_RENEW seconds, the other workers try to take it over on the
+# same beat and succeed once the lease has lapsed, e.g. after the leader
+# died. A leader that fails to renew before its lease runs out stops its
+# scheduler, so two workers only overlap if one stalls for longer than
+# SCHEDULER_LOCK_TTL. Jobs live in an SQLAlchemy job store in the app
+# database, so their next run times survive restarts and a new leader
+# carries on the schedule; runs missed while no worker led are coalesced
+# into one. Each run goes through run_job(), which records its duration,
+# outcome and error in job_stat.
+#
+# SCHEDULER_MODE = 'local' keeps the old behaviour (in-memory job store, no
+# lock) for a single process. Nothing starts at import: a process stands for
+# leader when it serves its first request, so every web worker does without
+# any configuration while flask CLI commands, the debug reloader's parent
+# process and test clients never do (they would take the lease from the
+# workers and may exit in the middle of a job). Set SCHEDULER_AUTOSTART=0
+# (config or environment) in web processes that must never run jobs, e.g.
+# when a dedicated `flask run-scheduler` process runs them; `python app.py`
+# and `flask run-scheduler` always start it.
+
+LOCK_NAME = 'scheduler'
+
+SUCCESS = 'success'
+ERROR = 'error'
+MISSED = 'missed'
+
+TRIGGERS = {'cron': CronTrigger, 'interval': IntervalTrigger}
+
+
+def run_job(job_id):
+    """Stored entry point of every job: runs the registered function and records the outcome"""
+    job_scheduler.run(job_id)
+
+
+class JobScheduler:
+    def __init__(self, app=None):
+        self.app = None
+        self.jobs = {}
+        self.scheduler = None
+        self.engine = None
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+        self.lease_expires = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.elector = None
+        self.started = False
+        self.start_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SCHEDULER_MODE', os.environ.get('SCHEDULER_MODE', 'leader'))
+        app.config.setdefault('SCHEDULER_AUTOSTART', os.environ.get('SCHEDULER_AUTOSTART', '1') != '0')
+        app.config.setdefault('SCHEDULER_LOCK_TTL', 60)
+        app.config.setdefault('SCHEDULER_LOCK_RENEW', 15)
+        app.config.setdefault('SCHEDULER_MISFIRE_GRACE', 3600)
+        app.config.setdefault('SCHEDULER_JOBS_TABLE', 'apscheduler_jobs')
+        self.app = app
+        app.before_request(self._autostart)
+        app.extensions['job_scheduler'] = self
+
+    def _autostart(self):
+        if self.started or not self.app.config['SCHEDULER_AUTOSTART'] or self.app.testing:
+            return
+        # A request handled inside a CLI command (check-query-budgets renders pages) is not serving
+        if click.get_current_context(silent=True) is not None:
+            return
+        with self.start_lock:
+            if not self.started:
+                self.start()
+
+    def add_job(self, func, trigger, id, name, **trigger_args):
+        """Register a job; it is scheduled by whichever worker becomes leader"""
+        if isinstance(trigger, str):
+            trigger = TRIGGERS[trigger](**trigger_args)
+        self.jobs[id] = {'func': func, 'trigger': trigger, 'name': name}
+
+    @property
+    def running(self):
+        return self.scheduler is not None and self.scheduler.running
+
+    @property
+    def is_leader(self):
+        return self.running
+
+    def start(self):
+        """Start scheduling in this process, as leader candidate unless SCHEDULER_MODE is local"""
+        if self.elector is not None and self.elector.is_alive():
+            return
+        self.started = True
+        # Taken here rather than at import, so forked workers of a preloaded app get their own
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+        with self.app.app_context():
+            self.engine = db.engine
+        if self.app.config['SCHEDULER_MODE'] == 'local':
+            self._start_scheduler(MemoryJobStore())
+            return
+        self.stopping.clear()
+        self.elector = threading.Thread(target=self._elect, name='scheduler-elector', daemon=True)
+        self.elector.start()
+        # Hand the lock over on a clean exit instead of making the next leader wait out the lease
+        atexit.register(self.shutdown)
+
+    def shutdown(self):
+        """Stop scheduling and give up the lock so another worker can lead straight away"""
+        self.stopping.set()
+        if self.elector is not None:
+            self.elector.join(timeout=5)
+            self.elector = None
+        self._stop_scheduler()
+        if self.engine is not None and self.app.config['SCHEDULER_MODE'] != 'local':
+            self._release()
+
+    def _elect(self):
+        while True:
+            try:
+                leading = self._acquire()
+            except SQLAlchemyError as e:
+                # A busy database is not a lost lease; only step down once it has run out
+                self.app.logger.warning('Scheduler lock renewal failed: %s', e)
+                leading = self.lease_expires is not None and datetime.utcnow() < self.lease_expires
+            if leading and not self.running:
+                self.app.logger.info('Scheduler %s is now the leader', self.owner)
+                self._start_scheduler(SQLAlchemyJobStore(
+                    engine=self.engine, tablename=self.app.config['SCHEDULER_JOBS_TABLE']
+                ))
+            elif not leading and self.running:
+                self.app.logger.warning('Scheduler %s lost the leader lock, stopping', self.owner)
+                self._stop_scheduler()
+            if self.stopping.wait(self.app.config['SCHEDULER_LOCK_RENEW']):
+                return
+
+    def _acquire(self):
+        """Take or renew the lease, returns True when this process holds it"""
+        now = datetime.utcnow()
+        expires = now + timedelta(seconds=self.app.config['SCHEDULER_LOCK_TTL'])
+        table = SchedulerLock.__table__
+        statement = insert(table).values(
+            name=LOCK_NAME, owner=self.owner, acquired_at=now, expires_at=expires
+        ).on_conflict_do_update(
+            index_elements=[table.c.name],
+            set_={
+                'owner': self.owner,
+                'expires_at': expires,
+                # A renewal keeps the original acquisition time
+                'acquired_at': case((table.c.owner == self.owner, table.c.acquired_at), else_=now),
+            },
+            where=(table.c.owner == self.owner) | (table.c.expires_at < now)
+        ).returning(table.c.owner)
+        with self.engine.begin() as conn:
+            leading = conn.execute(statement).scalar() == self.owner
+        self.lease_expires = expires if leading else None
+        return leading
+
+    def _release(self):
+        table = SchedulerLock.__table__
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(table.delete().where(table.c.name == LOCK_NAME, table.c.owner == self.owner))
+        except SQLAlchemyError as e:
+            self.app.logger.warning('Could not release the scheduler lock: %s', e)
+        self.lease_expires = None
+
+    def _start_scheduler(self, jobstore):
+        with self.lock:
+            if self.running:
+                return
+            scheduler = BackgroundScheduler(jobstores={'default': jobstore}, job_defaults={
+                'coalesce': True,
+                'max_instances': 1,
+                'misfire_grace_time': self.app.config['SCHEDULER_MISFIRE_GRACE'],
+            })
+            scheduler.add_listener(self._missed, EVENT_JOB_MISSED)
+            scheduler.start(paused=True)
+            stored = {job.id for job in scheduler.get_jobs()}
+            for job_id, job in self.jobs.items():
+                if job_id in stored:
+                    # Keep the stored next run time, so runs missed while nobody led still happen,
+                    # unless the schedule itself changed
+                    scheduler.modify_job(job_id, name=job['name'])
+                    if str(scheduler.get_job(job_id).trigger) != str(job['trigger']):
+                        scheduler.reschedule_job(job_id, trigger=job['trigger'])
+                else:
+                    scheduler.add_job(run_job, job['trigger'], args=[job_id], id=job_id, name=job['name'])
+            for job_id in stored - set(self.jobs):
+                scheduler.remove_job(job_id)
+            scheduler.resume()
+            self.scheduler = scheduler
+
+    def _stop_scheduler(self):
+        with self.lock:
+            if self.scheduler is not None:
+                if self.scheduler.running:
+                    self.scheduler.shutdown(wait=False)
+                self.scheduler = None
+
+    def run(self, job_id):
+        job = self.jobs.get(job_id)
+        started = datetime.utcnow()
+        clock = time.perf_counter()
+        error = None
+        try:
+            if job is None:
+                raise LookupError(f'No job registered as {job_id}')
+            job['func']()
+        except Exception as e:
+            error = e
+            self.app.logger.exception('Scheduled job %s failed', job_id)
+        self._record(job_id, ERROR if error else SUCCESS, started, time.perf_counter() - clock, error)
+
+    def _missed(self, event):
+        self.app.logger.warning('Scheduled job %s missed its run at %s', event.job_id, event.scheduled_run_time)
+        self._record(event.job_id, MISSED, None, None, None)
+
+    def _record(self, job_id, outcome, started, duration, error):
+        if duration is not None:
+            metrics.job_seconds.observe((job_id, outcome), duration)
+        table = JobStat.__table__
+        failed = 0 if outcome == SUCCESS else 1
+        values = {
+            'last_started_at': started,
+            'last_finished_at': datetime.utcnow(),
+            'last_duration': duration,
+            'last_outcome': outcome,
+            'last_error': str(error)[:500] if error else None,
+            'last_owner': self.owner,
+        }
+        statement = insert(table).values(
+            job_id=job_id, run_count=1, failure_count=failed, **values
+        ).on_conflict_do_update(
+            index_elements=[table.c.job_id],
+            set_=dict(values, run_count=table.c.run_count + 1, failure_count=table.c.failure_count + failed)
+        )
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(statement)
+        except SQLAlchemyError as e:
+            self.app.logger.warning('Could not record the outcome of job %s: %s', job_id, e)
+
+    def status(self):
+        """Leader and per-job stats, readable from any worker"""
+        stats = {stat.job_id: stat for stat in JobStat.query}
+        leader = db.session.get(SchedulerLock, LOCK_NAME)
+        next_runs = {}
+        table = self.app.config['SCHEDULER_JOBS_TABLE']
+        try:
+            for job_id, next_run in db.session.execute(
+                text(f'SELECT id, next_run_time FROM {table}')
+            ):
+                next_runs[job_id] = datetime.utcfromtimestamp(next_run) if next_run is not None else None
+        except SQLAlchemyError:
+            # No worker has led yet, so the job store does not exist
+            db.session.rollback()
+
+        def when(value):
+            return value.isoformat() if value else None
+
+        jobs = []
+        for job_id, job in self.jobs.items():
+            stat = stats.get(job_id)
+            jobs.append({
+                'id': job_id,
+                'name': job['name'],
+                'next_run_at': when(next_runs.get(job_id)),
+                'last_started_at': when(stat.last_started_at) if stat else None,
+                'last_finished_at': when(stat.last_finished_at) if stat else None,
+                'last_duration': round(stat.last_duration, 3) if stat and stat.last_duration is not None else None,
+                'last_outcome': stat.last_outcome if stat else None,
+                'last_error': stat.last_error if stat else None,
+                'last_owner': stat.last_owner if stat else None,
+                'run_count': stat.run_count if stat else 0,
+                'failure_count': stat.failure_count if stat else 0,
+            })
+        return {
+            'mode': self.app.config['SCHEDULER_MODE'],
+            'worker': self.owner,
+            'running_here': self.running,
+            'leader': {
+                'owner': leader.owner,
+                'acquired_at': when(leader.acquired_at),
+                'expires_at': when(leader.expires_at),
+                'expired': leader.expires_at < datetime.utcnow(),
+            } if leader else None,
+            'jobs': jobs,
+        }
+
+
+job_scheduler = JobScheduler()
@@ -0,0 +1,140 @@
+from datetime import datetime
+from sqlalchemy import event, func, case
+from sqlalchemy.dialects.sqlite import insert
+from models import db, Medicine, Batch, StockBalance, DataVersion
+from data_versions import current_versions, next_version
+from stock_events import record_movement, EXPIRE
+from alerts import queue_evaluation
+
+# The StockBalance table is a projection of the batch table: one row per medicine
+# holding on-hand and available quantity, stocked batch count and nearest expiry.
+# Every route that changes batch quantities calls refresh_stock_balances() before
+# committing so the projection is written in the same transaction as the batches.
+#
+# Balances whose figures change are stamped with the next value of the
+# stock_levels counter, so clients can ask for the medicines whose stock
+# changed after a version they already have (stock_changes). Removing a
+# balance cannot be expressed as a change, so it moves the stock_levels_reset
+# marker instead and clients older than the marker get the full list again.
+# Changed balances are also queued for the alert rules (see alerts.py).
+
+STOCK_VERSION = 'stock_levels'
+STOCK_RESET = 'stock_levels_reset'
+
+
+def refresh_stock_balances(medicine_ids=None):
+    """Recompute StockBalance rows for the given medicines (all medicines when None)"""
+    if medicine_ids is not None:
+        medicine_ids = {int(medicine_id) for medicine_id in medicine_ids if medicine_id is not None}
+        if not medicine_ids:
+            return
+    # Make pending batch changes visible to the aggregate below
+    db.session.flush()
+    today = datetime.now().date()
+    not_expired = Batch.expiration_date >= today
+    stocked = Batch.quantity > 0
+
+    totals = db.session.query(
+        Batch.medicine_id,
+        func.coalesce(func.sum(Batch.quantity), 0).label('on_hand'),
+        func.coalesce(func.sum(case((not_expired, Batch.quantity), else_=0)), 0).label('available'),
+        func.coalesce(func.sum(case((stocked, 1), else_=0)), 0).label('batch_count'),
+        func.min(case((stocked & not_expired, Batch.expiration_date))).label('nearest_expiry')
+    ).group_by(Batch.medicine_id)
+    medicines = db.session.query(Medicine.id)
+    balances = StockBalance.query
+    if medicine_ids is not None:
+        totals = totals.filter(Batch.medicine_id.in_(medicine_ids))
+        medicines = medicines.filter(Medicine.id.in_(medicine_ids))
+        balances = balances.filter(StockBalance.medicine_id.in_(medicine_ids))
+
+    totals = {row.medicine_id: row for row in totals}
+    existing = {balance.medicine_id: balance for balance in balances}
+    changed = []
+    for (medicine_id,) in medicines:
+        balance = existing.get(medicine_id)
+        if balance is None:
+            balance = StockBalance(medicine_id=medicine_id)
+            db.session.add(balance)
+        row = totals.get(medicine_id)
+        figures = (
+            row.on_hand if row else 0,
+            row.available if row else 0,
+            row.batch_count if row else 0,
+            row.nearest_expiry if row else None,
+        )
+        if figures != (balance.on_hand, balance.available, balance.batch_count, balance.nearest_expiry):
+            balance.on_hand, balance.available, balance.batch_count, balance.nearest_expiry = figures
+            changed.append(balance)
+    if changed:
+        version = next_version(STOCK_VERSION)
+        for balance in changed:
+            balance.version = version
+        queue_evaluation(balance.medicine_id for balance in changed)
+
+
+def _mark_removed(connection):
+    """Move the reset marker past every version a client may hold"""
+    version = next_version(STOCK_VERSION, connection)
+    table = DataVersion.__table__
+    connection.execute(insert(table).values(name=STOCK_RESET, version=version).on_conflict_do_update(
+        index_elements=[table.c.name],
+        set_={'version': version}
+    ))
+
+
+@event.listens_for(StockBalance, 'after_delete')
+def _balance_deleted(mapper, connection, target):
+    _mark_removed(connection)
+
+
+def stock_changes(since):
+    """Stock of medicines whose balance changed after version since
+
+    Returns a dict with the current version, whether the list is complete
+    (full) and the rows. The list is complete when since is 0 or older than
+    the last removal, so the client should replace what it has.
+    """
+    # The version is read first: rows committed in between are sent again next time, never skipped
+    versions = current_versions([STOCK_VERSION, STOCK_RESET])
+    current, reset = versions[STOCK_VERSION], versions[STOCK_RESET]
+    full = since <= 0 or since < reset or since > current
+    query = db.session.query(
+        Medicine.id, Medicine.name, StockBalance.on_hand, StockBalance.available, StockBalance.version
+    ).join(StockBalance, StockBalance.medicine_id == Medicine.id)
+    if not full:
+        query = query.filter(StockBalance.version > since)
+    return {
+        'version': current,
+        'full': full,
+        'changes': [{
+            'medicine_id': row.id,
+            'medicine': row.name,
+            'quantity': row.on_hand,
+            'available': row.available,
+            'version': row.version,
+        } for row in query.order_by(StockBalance.version, Medicine.id)],
+    }
+
+
+def refresh_stale_balances():
+    """Recompute balances whose nearest expiry has passed since they were last written"""
+    today = datetime.now().date()
+    stale_ids = [medicine_id for (medicine_id,) in db.session.query(StockBalance.medicine_id).filter(
+        StockBalance.nearest_expiry < today
+    )]
+    refresh_stock_balances(stale_ids)
+    for medicine_id in stale_ids:
+        record_movement(EXPIRE, medicine_id)
+
+
+def rebuild_stock_balances():
+    """Recompute every StockBalance row from the batch table, dropping rows of deleted medicines"""
+    removed = StockBalance.query.filter(
+        ~StockBalance.medicine_id.in_(db.session.query(Medicine.id))
+    ).delete(synchronize_session=False)
+    if removed:
+        _mark_removed(db.session.connection())
+    refresh_stock_balances()
+    db.session.commit()
+    return StockBalance.query.count()
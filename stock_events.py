@@ -0,0 +1,197 @@
+import functools
+import json
+import queue
+import threading
+from collections import deque
+from datetime import datetime
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from models import db, User, Medicine, Batch, StockBalance
+from data_versions import after_durable_commit
+
+# Live stock movement events, streamed to dashboards over Server-Sent Events.
+#
+# Code that moves stock calls record_movement() inside its transaction. Just
+# before the commit the movements are resolved in one query each for the
+# medicines (with their new balance), batches and users involved; after the
+# commit they are handed to the broker, which numbers them and puts them on
+# the queue of every connected client. Rolled back transactions publish
+# nothing. Clients never query: one publisher fans out to all of them. A
+# client whose queue fills up is disconnected and, when its EventSource
+# reconnects with Last-Event-ID, replays what it missed from the backlog, or
+# gets a reset event when that is too old. The broker lives in this process,
+# so with several workers each one streams the writes it served.
+
+# Movement kinds
+DISPENSE = 'dispense'
+RECEIVE = 'receive'
+ADJUST = 'adjust'
+REMOVE = 'remove'
+EXPIRE = 'expire'
+
+
+def record_movement(kind, medicine_id, batch_id=None, delta=0, user_id=None, batch_number=None):
+    """Queue a stock movement to publish when the current transaction commits"""
+    db.session.info.setdefault('stock_movements', []).append({
+        'kind': kind,
+        'medicine_id': int(medicine_id),
+        'batch_id': batch_id,
+        'batch_number': batch_number,
+        'delta': delta,
+        'user_id': user_id,
+        'at': datetime.utcnow().isoformat(),
+    })
+
+
+@event.listens_for(Session, 'before_commit')
+def _resolve_movements(session):
+    movements = session.info.pop('stock_movements', None)
+    if not movements:
+        return
+    medicine_ids = {m['medicine_id'] for m in movements}
+    batch_ids = {m['batch_id'] for m in movements if m['batch_id'] and not m['batch_number']}
+    user_ids = {m['user_id'] for m in movements if m['user_id']}
+    medicines = {row.id: row for row in session.execute(
+        select(Medicine.id, Medicine.name, Medicine.generic_name, StockBalance.on_hand, StockBalance.available)
+        .outerjoin(StockBalance, StockBalance.medicine_id == Medicine.id)
+        .where(Medicine.id.in_(medicine_ids))
+    )}
+    batch_numbers = dict(session.execute(
+        select(Batch.id, Batch.batch_number).where(Batch.id.in_(batch_ids))
+    ).all()) if batch_ids else {}
+    users = {row.id: row for row in session.execute(
+        select(User.id, User.username, User.role).where(User.id.in_(user_ids))
+    )} if user_ids else {}
+
+    payloads = []
+    for m in movements:
+        medicine = medicines.get(m['medicine_id'])
+        user = users.get(m['user_id'])
+        batch_number = m['batch_number'] or batch_numbers.get(m['batch_id'])
+        payloads.append({
+            'kind': m['kind'],
+            'at': m['at'],
+            'medicine': {'id': m['medicine_id'],
+                         'name': medicine.name if medicine else None,
+                         'generic_name': medicine.generic_name if medicine else None},
+            'batch': {'id': m['batch_id'], 'batch_number': batch_number} if m['batch_id'] else None,
+            'delta': m['delta'],
+            'balance': {'on_hand': medicine.on_hand or 0, 'available': medicine.available or 0} if medicine else None,
+            'user': {'username': user.username, 'role': user.role} if user else None,
+        })
+    session.info['stock_events'] = payloads
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_movements(session):
+    payloads = session.info.pop('stock_events', None)
+    if payloads:
+        after_durable_commit(session, functools.partial(stock_events.publish, payloads))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_movements(session):
+    session.info.pop('stock_movements', None)
+    session.info.pop('stock_events', None)
+
+
+class TooManyListeners(Exception):
+    """Raised when STOCK_EVENTS_MAX_CLIENTS streams are already open"""
+
+
+class Subscription:
+    def __init__(self, size):
+        self.queue = queue.Queue(maxsize=size)
+        self.dropped = False
+        self.reset = False
+
+
+class StockEventBroker:
+    def __init__(self, app=None):
+        self.app = None
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.backlog = deque(maxlen=500)
+        self.last_id = 0
+        self.published = 0
+        self.dropped = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('STOCK_EVENTS_BACKLOG', 500)
+        app.config.setdefault('STOCK_EVENTS_QUEUE_SIZE', 100)
+        app.config.setdefault('STOCK_EVENTS_KEEPALIVE', 15)
+        app.config.setdefault('STOCK_EVENTS_MAX_CLIENTS', 100)
+        self.app = app
+        with self.lock:
+            self.backlog = deque(self.backlog, maxlen=app.config['STOCK_EVENTS_BACKLOG'])
+        app.extensions['stock_events'] = self
+
+    def publish(self, payloads):
+        with self.lock:
+            for payload in payloads:
+                self.last_id += 1
+                item = (self.last_id, json.dumps(payload, separators=(',', ':')))
+                self.backlog.append(item)
+                for subscription in list(self.subscribers):
+                    try:
+                        subscription.queue.put_nowait(item)
+                    except queue.Full:
+                        # A stalled client must not hold up the rest; it catches up on reconnect
+                        subscription.dropped = True
+                        self.subscribers.discard(subscription)
+                        self.dropped += 1
+                self.published += 1
+
+    def subscribe(self, last_event_id=None):
+        """Open a Subscription, replaying the backlog after last_event_id"""
+        with self.lock:
+            if len(self.subscribers) >= self.app.config['STOCK_EVENTS_MAX_CLIENTS']:
+                raise TooManyListeners('Too many live stock listeners, try again later')
+            subscription = Subscription(self.app.config['STOCK_EVENTS_QUEUE_SIZE'])
+            if last_event_id is not None:
+                missed = [item for item in self.backlog if item[0] > last_event_id]
+                oldest = self.backlog[0][0] if self.backlog else self.last_id + 1
+                # Ids from before a restart, or older than the backlog, cannot be replayed
+                if last_event_id > self.last_id or last_event_id < oldest - 1 \
+                        or len(missed) > subscription.queue.maxsize:
+                    subscription.reset = True
+                else:
+                    for item in missed:
+                        subscription.queue.put_nowait(item)
+            self.subscribers.add(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+    def stream(self, subscription):
+        """Yield the SSE text for a subscription until the client goes away"""
+        keepalive = self.app.config['STOCK_EVENTS_KEEPALIVE']
+        try:
+            yield 'retry: 3000\n\n'
+            if subscription.reset:
+                yield 'event: reset\ndata: {}\n\n'
+            while not subscription.dropped:
+                try:
+                    event_id, data = subscription.queue.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield f'id: {event_id}\nevent: stock\ndata: {data}\n\n'
+        finally:
+            self.unsubscribe(subscription)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'clients': len(self.subscribers),
+                'last_id': self.last_id,
+                'published': self.published,
+                'dropped_clients': self.dropped,
+            }
+
+
+stock_events = StockEventBroker()
@@ -0,0 +1,397 @@
+"""Concurrent write stress test: mixed dispensing, order receiving and batch edits against a scratch database
+
+    python stress.py
+    python stress.py --workers 8 --threads 4 --duration 30 --runs 3
+    python stress.py --mix dispense=8,receive=1,edit=1 --hot 5 --scale small
+    WRITE_MODE=queue python stress.py --workers 1 --threads 16
+
+A synthetic data set is seeded into a fresh SQLite database, then --workers
+processes with --threads threads each hammer the write routes through the
+Flask test client for --duration seconds, all starting together. Requests
+are drawn from the --mix weights and aimed at the --hot best stocked
+medicines so that writers collide. Each run reports throughput, latency and
+the time spent inside write statements and commits (where SQLite waits for
+its locks) per operation, with every outcome counted: handled conflicts and
+shortages are fine, errors such as "database is locked" are not. After each
+run the database is checked:
+
+- no batch quantity is negative,
+- every batch changed by exactly the net of the ledger entries (stock
+  transactions) written during the run,
+- the stock balances agree with the batch table,
+- every order received during the run has one ledger entry per item.
+
+The exit status is 1 when an invariant fails or the error rate is above
+--max-error-rate.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+OPERATIONS = ('dispense', 'receive', 'edit')
+# Outcomes the routes handle on purpose; anything else is an error
+HANDLED = ('ok', 'conflict', 'short', 'skipped')
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+READY_TIMEOUT = 120
+
+_local = threading.local()
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of a list, 0 when empty"""
+    if not samples:
+        return 0
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def _parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name not in OPERATIONS:
+            raise SystemExit(f"Unknown operation {name}, use {', '.join(OPERATIONS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+# Lock wait: SQLite takes its write lock inside the first write statement of a transaction and
+# waits for readers at commit, so the time spent in those is what writers lose to each other.
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if statement.lstrip()[:7].upper().startswith(WRITE_STATEMENTS):
+        conn.info['stress_started'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('stress_started', None)
+    if started is not None:
+        _local.wait += time.perf_counter() - started
+
+
+def _before_commit(conn):
+    _local.commit_started = time.perf_counter()
+
+
+def _after_commit(session):
+    started = getattr(_local, 'commit_started', None)
+    if started is not None:
+        _local.wait += time.perf_counter() - started
+        _local.commit_started = None
+
+
+def _install_timers():
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from sqlalchemy.orm import Session
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Engine, 'commit', _before_commit)
+    event.listen(Session, 'after_commit', _after_commit)
+
+
+def _dispense(client, app, plan, rng):
+    medicine_id = rng.choice(plan['medicines'])
+    response = client.post('/api/dispense', json={'items': [{'medicine_id': medicine_id,
+                                                             'quantity': rng.randint(1, 5)}]})
+    if response.status_code == 200:
+        return 'ok'
+    if response.status_code == 409:
+        return 'short' if 'available' in response.get_json() else 'conflict'
+    return f'HTTP {response.status_code}'
+
+
+def _receive(client, app, plan, rng):
+    order_ids = rng.sample(plan['orders'], min(len(plan['orders']), rng.randint(1, 3)))
+    response = client.post('/api/orders/receive', json={'order_ids': order_ids})
+    if response.status_code == 200:
+        return 'ok' if response.get_json()['received'] else 'skipped'
+    if response.status_code == 409:
+        return 'conflict'
+    return f'HTTP {response.status_code}'
+
+
+def _edit(client, app, plan, rng):
+    from models import db, Batch
+    # Read the batch as the edit form would show it, then submit a recount
+    batch_id = rng.choice(plan['batches'])
+    with app.app_context():
+        batch = db.session.get(Batch, batch_id)
+        form = {
+            'batch_number': batch.batch_number,
+            'medicine_id': str(batch.medicine_id),
+            'expected_quantity': str(batch.quantity),
+            'quantity': str(max(0, batch.quantity + rng.randint(-5, 10))),
+            'expiration_date': batch.expiration_date.isoformat(),
+            'manufacturing_date': batch.manufacturing_date.isoformat(),
+            'unit_price': str(batch.unit_price),
+        }
+    response = client.post(f'/batch/{batch_id}/edit', data=form)
+    if response.status_code != 302:
+        return f'HTTP {response.status_code}'
+    # Both outcomes redirect to the batch list; a conflict is told apart by its flashed warning
+    with client.session_transaction() as session:
+        flashes = session.pop('_flashes', [])
+    return 'conflict' if any(category == 'warning' for category, _ in flashes) else 'ok'
+
+
+RUNNERS = {'dispense': _dispense, 'receive': _receive, 'edit': _edit}
+
+
+def _thread(app, plan, mix, seed, deadline, samples):
+    rng = random.Random(seed)
+    client = app.test_client()
+    response = client.post('/login', data={'username': 'bench', 'password': 'bench'})
+    assert response.status_code == 302, 'stress user could not log in'
+    names, weights = list(mix), list(mix.values())
+    _local.commit_started = None
+    while time.time() < deadline:
+        operation = rng.choices(names, weights)[0]
+        _local.wait = 0.0
+        started = time.perf_counter()
+        try:
+            outcome = RUNNERS[operation](client, app, plan, rng)
+        except Exception as e:
+            outcome = 'database is locked' if 'database is locked' in str(e) else type(e).__name__
+        samples.append((operation, time.perf_counter() - started, _local.wait, outcome))
+
+
+def run_worker(threads, duration, mix, hot, seed, output):
+    """One worker process: --threads threads writing until the run's deadline, results to output"""
+    from app import app
+    from models import db, Batch, Order, StockBalance
+    app.config.update(TESTING=False, PROPAGATE_EXCEPTIONS=True, QUERY_BUDGET_ENFORCE=False)
+    _install_timers()
+    with app.app_context():
+        medicines = [medicine_id for (medicine_id,) in db.session.query(StockBalance.medicine_id)
+                     .order_by(StockBalance.available.desc()).limit(hot)]
+        plan = {
+            'medicines': medicines,
+            'batches': [batch_id for (batch_id,) in db.session.query(Batch.id)
+                        .filter(Batch.medicine_id.in_(medicines))],
+            'orders': [order_id for (order_id,) in db.session.query(Order.id).filter_by(status='pending')],
+        }
+    # Tell the parent this process is ready, then wait for everyone to start together
+    with open(output + '.ready', 'w'):
+        pass
+    while not os.path.exists(output + '.go'):
+        time.sleep(0.01)
+    with open(output + '.go') as go:
+        start_at = float(go.read())
+    time.sleep(max(0.0, start_at - time.time()))
+    deadline = start_at + duration
+    samples = []
+    workers = [threading.Thread(target=_thread, args=(app, plan, mix, seed * 1000 + n, deadline, samples))
+               for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    with open(output, 'w') as out:
+        json.dump(samples, out)
+
+
+def snapshot():
+    """What the invariants compare against: batch quantities, the last ledger entry and the pending orders"""
+    from models import db, Batch, Order, StockTransaction
+    from sqlalchemy import func
+    return {
+        'quantities': dict(db.session.query(Batch.id, Batch.quantity)),
+        'last_transaction': db.session.query(func.max(StockTransaction.id)).scalar() or 0,
+        'pending': {order_id for (order_id,) in db.session.query(Order.id).filter_by(status='pending')},
+    }
+
+
+def check_invariants(before):
+    """Invariant violations of the database against the snapshot taken before the run"""
+    from models import db, Batch, Order, OrderItem, StockBalance, StockTransaction
+    from sqlalchemy import case, func
+    problems = []
+    db.session.remove()
+
+    negative = db.session.query(Batch.id, Batch.quantity).filter(Batch.quantity < 0).all()
+    for batch_id, quantity in negative:
+        problems.append(f'batch {batch_id} has quantity {quantity}')
+
+    signed = case((StockTransaction.transaction_type == 'out', -StockTransaction.quantity),
+                  else_=StockTransaction.quantity)
+    ledger = dict(db.session.query(StockTransaction.batch_id, func.sum(signed))
+                  .filter(StockTransaction.id > before['last_transaction'])
+                  .group_by(StockTransaction.batch_id))
+    quantities = dict(db.session.query(Batch.id, Batch.quantity))
+    for batch_id, quantity in quantities.items():
+        change = quantity - before['quantities'].get(batch_id, 0)
+        if change != ledger.get(batch_id, 0):
+            problems.append(f'batch {batch_id} changed by {change} but the ledger records {ledger.get(batch_id, 0)}')
+
+    on_hand = dict(db.session.query(Batch.medicine_id, func.sum(Batch.quantity)).group_by(Batch.medicine_id))
+    for medicine_id, balance in db.session.query(StockBalance.medicine_id, StockBalance.on_hand):
+        if balance != on_hand.get(medicine_id, 0):
+            problems.append(f'medicine {medicine_id} balance says {balance}, batches hold {on_hand.get(medicine_id, 0)}')
+
+    received = {order_id for (order_id,) in db.session.query(Order.id).filter(
+        Order.id.in_(before['pending']), Order.status != 'pending')}
+    item_counts = dict(db.session.query(OrderItem.order_id, func.count(OrderItem.id))
+                       .filter(OrderItem.order_id.in_(before['pending'])).group_by(OrderItem.order_id))
+    entries = {}
+    for (notes,) in db.session.query(StockTransaction.notes).filter(
+            StockTransaction.id > before['last_transaction'], StockTransaction.notes.like('From Order #%')):
+        order_id = int(notes.rsplit('#', 1)[1])
+        entries[order_id] = entries.get(order_id, 0) + 1
+    for order_id in sorted(set(received) | set(entries)):
+        expected = item_counts.get(order_id, 0) if order_id in received else 0
+        if entries.get(order_id, 0) != expected:
+            problems.append(f'order {order_id} has {entries.get(order_id, 0)} ledger entries for {expected} items')
+    return problems
+
+
+def summarize(samples, elapsed):
+    """Per-operation and overall figures of one run"""
+    rows = {}
+    for operation in OPERATIONS + ('all',):
+        mine = [sample for sample in samples if operation in ('all', sample[0])]
+        if not mine:
+            continue
+        outcomes = {}
+        for sample in mine:
+            outcomes[sample[3]] = outcomes.get(sample[3], 0) + 1
+        latencies = [sample[1] * 1000 for sample in mine]
+        busy = sum(sample[1] for sample in mine)
+        waits = sum(sample[2] for sample in mine)
+        errors = sum(count for outcome, count in outcomes.items() if outcome not in HANDLED)
+        rows[operation] = {
+            'requests': len(mine),
+            'per_second': round(len(mine) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.50), 2),
+            'p95_ms': round(percentile(latencies, 0.95), 2),
+            'p99_ms': round(percentile(latencies, 0.99), 2),
+            'lock_wait_s': round(waits, 3),
+            'lock_wait_share': round(waits / busy, 3) if busy else 0.0,
+            'error_rate': round(errors / len(mine), 4),
+            'outcomes': outcomes,
+        }
+    return rows
+
+
+def print_run(number, result):
+    print(f"\n== run {number}: {result['workers']} processes x {result['threads']} threads, "
+          f"{result['elapsed_s']}s")
+    print(f"{'operation':10} {'requests':>8} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'wait s':>8} {'wait %':>7} {'errors':>7}  outcomes")
+    for operation, row in result['operations'].items():
+        outcomes = ', '.join(f'{name} {count}' for name, count in sorted(row['outcomes'].items()))
+        print(f"{operation:10} {row['requests']:8} {row['per_second']:8} {row['p50_ms']:8} {row['p95_ms']:8} "
+              f"{row['p99_ms']:8} {row['lock_wait_s']:8} {row['lock_wait_share'] * 100:6.1f}% "
+              f"{row['error_rate'] * 100:6.2f}%  {outcomes}")
+    if result['invariants']:
+        print('Invariant violations:')
+        for problem in result['invariants'][:20]:
+            print(f'  {problem}')
+        if len(result['invariants']) > 20:
+            print(f"  ... and {len(result['invariants']) - 20} more")
+    else:
+        print('Invariants hold')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4, help='Worker processes')
+    parser.add_argument('--threads', type=int, default=4, help='Threads per worker process')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds each run lasts')
+    parser.add_argument('--runs', type=int, default=1, help='Runs against the same database')
+    parser.add_argument('--mix', default='dispense=6,receive=2,edit=2', help='Operation weights')
+    parser.add_argument('--hot', type=int, default=20, help='Medicines the writes are aimed at')
+    parser.add_argument('--scale', default='tiny', help='Synthetic data scale to seed')
+    parser.add_argument('--set', action='append', default=[], metavar='COUNT=N',
+                        help='Override a row count of the scale, e.g. batches=5000')
+    parser.add_argument('--pending', type=int, default=2000, help='Extra pending orders to receive')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--max-error-rate', type=float, default=0.0,
+                        help='Fraction of requests allowed to fail before the run counts as failed')
+    parser.add_argument('--output', help='Also write the results as JSON to this file')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    mix = _parse_mix(args.mix)
+
+    if args.worker:
+        run_worker(args.threads, args.duration, mix, args.hot, args.seed, args.worker)
+        return 0
+
+    scratch = tempfile.mkdtemp(prefix='rhu-stress-')
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(scratch, 'stress.db')}",
+               SCHEDULER_AUTOSTART='0')
+    os.environ.update(env)
+    from app import app
+    from models import db
+    from migrations import upgrade
+    from synthetic import generate, scale_counts
+    app.config.update(REPORT_CACHE_DIR=os.path.join(scratch, 'report_cache'),
+                      REPORT_JOB_DIR=os.path.join(scratch, 'report_jobs'))
+    counts = scale_counts(args.scale, **dict(item.split('=', 1) for item in args.set))
+    results = []
+    failed = False
+    try:
+        with app.app_context():
+            db.create_all()
+            upgrade(db.engine)
+            rows, seconds = generate(seed=args.seed, pending=args.pending, **counts)
+            print(f"Seeded {sum(rows.values())} rows in {seconds:.1f}s", file=sys.stderr)
+            for run in range(1, args.runs + 1):
+                before = snapshot()
+                db.session.remove()
+                outputs = [os.path.join(scratch, f'run{run}-worker{n}.json') for n in range(args.workers)]
+                processes = [subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__), '--worker', output, '--threads', str(args.threads),
+                     '--duration', str(args.duration), '--mix', args.mix, '--hot', str(args.hot),
+                     '--seed', str(args.seed + run * 100 + n)],
+                    env=env, cwd=os.path.dirname(os.path.abspath(__file__))
+                ) for n, output in enumerate(outputs)]
+                waited = time.time()
+                while not all(os.path.exists(output + '.ready') for output in outputs):
+                    if time.time() - waited > READY_TIMEOUT or any(p.poll() is not None for p in processes):
+                        for process in processes:
+                            process.kill()
+                        raise SystemExit('Stress workers did not start')
+                    time.sleep(0.05)
+                # Leave every worker the time to notice the go file before the clock starts
+                start_at = time.time() + 0.2
+                for output in outputs:
+                    with open(output + '.go', 'w') as go:
+                        go.write(repr(start_at))
+                for process in processes:
+                    process.wait()
+                elapsed = time.time() - start_at
+                samples = []
+                for output in outputs:
+                    with open(output) as result_file:
+                        samples.extend(json.load(result_file))
+                result = {
+                    'workers': args.workers,
+                    'threads': args.threads,
+                    'elapsed_s': round(elapsed, 1),
+                    'operations': summarize(samples, elapsed),
+                    'invariants': check_invariants(before),
+                }
+                results.append(result)
+                print_run(run, result)
+                if result['invariants'] or result['operations'].get('all', {}).get('error_rate', 0) > args.max_error_rate:
+                    failed = True
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+import pickle
+import threading
+from data_versions import watermark
+
+# Versioned cache for page summaries such as the dashboard figures.
+#
+# Entries are stored with the data version current when they were computed,
+# and only a lookup at that same version is a hit. The version is the
+# persisted data_versions watermark of the tables listed in SUMMARY_TABLES,
+# read with one query per lookup, so a write made by any worker process
+# moves it, and so does the nightly expiry refresh, which stamps the
+# stock_levels counter when it rewrites balances. A page refreshed between
+# writes costs that one query and never shows data older than the last
+# write. The version is read before computing, so a write that lands
+# mid-computation leaves an entry that is already outdated and never served.
+#
+# The default backend keeps the entries in this process, each worker
+# computing its own copy. Set SUMMARY_CACHE_URL to a redis:// URL (needs the
+# redis package) to share them between worker processes.
+
+SUMMARY_TABLES = frozenset({'medicine', 'batch', 'supplier', 'order', 'order_item',
+                            'stock_transaction', 'user', 'stock_alert', 'stock_levels'})
+
+
+class MemoryBackend:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, key, version):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == version:
+            return True, entry[1]
+        return False, None
+
+    def set(self, key, version, value):
+        with self.lock:
+            # Entries of other versions would never be read again
+            self.entries = {name: entry for name, entry in self.entries.items() if entry[0] == version}
+            self.entries[key] = (version, value)
+
+
+class RedisBackend:
+    def __init__(self, url, prefix, ttl):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('SUMMARY_CACHE_URL needs the redis package: pip install redis')
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key, version):
+        raw = self.client.get(f'{self.prefix}{key}:{version}')
+        if raw is None:
+            return False, None
+        return True, pickle.loads(raw)
+
+    def set(self, key, version, value):
+        # Entries of older versions are never read again and expire on their own
+        self.client.set(f'{self.prefix}{key}:{version}', pickle.dumps(value), ex=self.ttl)
+
+
+class SummaryCache:
+    def __init__(self, app=None):
+        self.app = None
+        self.backend = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SUMMARY_CACHE_URL', None)
+        app.config.setdefault('SUMMARY_CACHE_PREFIX', 'rhu:summary:')
+        app.config.setdefault('SUMMARY_CACHE_TTL', 24 * 3600)
+        self.app = app
+        url = app.config['SUMMARY_CACHE_URL']
+        if url:
+            self.backend = RedisBackend(url, app.config['SUMMARY_CACHE_PREFIX'], app.config['SUMMARY_CACHE_TTL'])
+        else:
+            self.backend = MemoryBackend()
+        app.extensions['summary_cache'] = self
+
+    def current_version(self):
+        """Version of the summarised data, as stored by every worker"""
+        return '-'.join(str(version) for _, version in watermark(SUMMARY_TABLES))
+
+    def get_or_compute(self, key, compute):
+        """Return the cached value for key at the current version, computing it on a miss"""
+        version = self.current_version()
+        found, value = self.backend.get(key, version)
+        with self.lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not found:
+            value = compute()
+            self.backend.set(key, version, value)
+        return value
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': type(self.backend).__name__,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+summary_cache = SummaryCache()
@@ -0,0 +1,188 @@
+import random
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import func, insert
+from werkzeug.security import generate_password_hash
+from models import db, User, Supplier, Medicine, Batch, Order, OrderItem, StockTransaction
+from stock import rebuild_stock_balances
+
+# Synthetic data sets for benchmarks and load tests.
+#
+# generate() appends suppliers, medicines, batches, orders with their items
+# and stock transactions to the current database, written with executemany
+# inserts of CHUNK_SIZE rows in one transaction, then rebuilds the stock
+# balances. Ids are assigned here, after the current maximum of each table,
+# so rows can refer to each other without reading anything back. The same
+# seed gives the same data. Batches follow a realistic expiry spread: a few
+# already expired, some inside the 30 day warning window, most months or
+# years away, and some sold out.
+
+CHUNK_SIZE = 10000
+
+SCALES = {
+    'tiny': dict(suppliers=5, medicines=50, batches=200, orders=50, transactions=1000, users=3),
+    'small': dict(suppliers=20, medicines=500, batches=2500, orders=500, transactions=20000, users=5),
+    'medium': dict(suppliers=100, medicines=5000, batches=25000, orders=5000, transactions=500000, users=10),
+    'large': dict(suppliers=300, medicines=20000, batches=100000, orders=20000, transactions=3000000, users=25),
+}
+
+CATEGORIES = ['Antibiotics', 'Analgesics', 'Vitamins', 'Antacids', 'Antiseptics', 'Other']
+UNITS = ['Tablets', 'Capsules', 'Bottles', 'Vials', 'Boxes', 'Pieces']
+GENERICS = ['Paracetamol', 'Amoxicillin', 'Ibuprofen', 'Cetirizine', 'Metformin', 'Losartan', 'Omeprazole',
+            'Salbutamol', 'Ascorbic Acid', 'Ferrous Sulfate', 'Mefenamic Acid', 'Cefalexin', 'Zinc Sulfate']
+BENCH_PASSWORD = 'bench'
+
+
+def scale_counts(scale, **overrides):
+    """Row counts of a named scale with individual counts replaced"""
+    if scale not in SCALES:
+        raise ValueError(f"Unknown scale {scale}, use one of {', '.join(SCALES)}")
+    counts = dict(SCALES[scale])
+    for name, value in overrides.items():
+        if name not in counts:
+            raise ValueError(f"Unknown count {name}, use one of {', '.join(counts)}")
+        counts[name] = int(value)
+    return counts
+
+
+def _next_id(model):
+    return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+
+def _insert(model, rows):
+    """Insert an iterable of dicts in chunks, returns how many"""
+    table = model.__table__
+    count = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            db.session.execute(insert(table), chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(insert(table), chunk)
+        count += len(chunk)
+    return count
+
+
+def _expiry_offset(rng):
+    """Days from today to a batch's expiry: 5% expired, 10% within 30 days, 15% within 90, the rest later"""
+    roll = rng.random()
+    if roll < 0.05:
+        return -rng.randint(1, 365)
+    if roll < 0.15:
+        return rng.randint(0, 30)
+    if roll < 0.30:
+        return rng.randint(31, 90)
+    return rng.randint(91, 1095)
+
+
+def generate(suppliers, medicines, batches, orders, transactions, users=5, items_per_order=4, pending=0, seed=42):
+    """Append a synthetic data set and commit, returns {table: rows} and the seconds taken
+
+    pending adds that many orders still waiting to be received, on top of
+    the pending share of orders.
+    """
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    now = datetime.now()
+    today = now.date()
+    counts = {}
+
+    # One shared hash: hashing a password per user would dominate small data sets
+    password = generate_password_hash(BENCH_PASSWORD)
+    first_user = _next_id(User)
+    user_rows = [{
+        'id': first_user + n,
+        'username': 'bench' if n == 0 and not User.query.filter_by(username='bench').first() else f'bench{first_user + n}',
+        'password': password,
+        'role': 'admin' if n == 0 else rng.choice(['employee', 'sub-admin', 'employee']),
+        'email': f'bench{first_user + n}@example.com',
+        'created_at': now,
+    } for n in range(users)]
+    counts['user'] = _insert(User, user_rows)
+    user_ids = [row['id'] for row in user_rows]
+
+    first_supplier = _next_id(Supplier)
+    counts['supplier'] = _insert(Supplier, ({
+        'id': first_supplier + n,
+        'name': f'Supplier {first_supplier + n:05d}',
+        'contact_person': f'Contact {n}',
+        'phone': f'09{rng.randint(100000000, 999999999)}',
+        'email': f'supplier{first_supplier + n}@example.com',
+        'address': f'{rng.randint(1, 999)} Main Street',
+        'created_at': now,
+    } for n in range(suppliers)))
+    supplier_ids = range(first_supplier, first_supplier + suppliers)
+
+    first_medicine = _next_id(Medicine)
+    counts['medicine'] = _insert(Medicine, ({
+        'id': first_medicine + n,
+        'name': f'{rng.choice(GENERICS)} {rng.choice([100, 250, 500])}mg #{first_medicine + n}',
+        'generic_name': rng.choice(GENERICS),
+        'category': rng.choice(CATEGORIES),
+        'unit': rng.choice(UNITS),
+        'supplier_id': rng.choice(supplier_ids),
+        'created_at': now,
+    } for n in range(medicines)))
+    medicine_ids = range(first_medicine, first_medicine + medicines)
+
+    first_batch = _next_id(Batch)
+
+    def batch_rows():
+        for n in range(batches):
+            expiry = today + timedelta(days=_expiry_offset(rng))
+            yield {
+                'id': first_batch + n,
+                'batch_number': f'SB-{first_batch + n:08d}',
+                'medicine_id': rng.choice(medicine_ids),
+                'quantity': 0 if rng.random() < 0.1 else int(rng.expovariate(1 / 150)) + 1,
+                'expiration_date': expiry,
+                'manufacturing_date': expiry - timedelta(days=rng.randint(540, 1095)),
+                'unit_price': round(rng.uniform(0.5, 50), 2),
+                'created_at': now,
+            }
+    counts['batch'] = _insert(Batch, batch_rows())
+    batch_ids = range(first_batch, first_batch + batches)
+
+    first_order = _next_id(Order)
+    first_item = _next_id(OrderItem)
+    order_rows = []
+    item_rows = []
+    for n in range(orders + pending):
+        order_id = first_order + n
+        order_rows.append({
+            'id': order_id,
+            'supplier_id': rng.choice(supplier_ids),
+            'order_date': now - timedelta(minutes=rng.randint(10, 365 * 24 * 60)),
+            'status': 'pending' if n >= orders else rng.choices(['pending', 'delivered', 'cancelled'], [2, 7, 1])[0],
+            'created_by': rng.choice(user_ids),
+        })
+        for _ in range(rng.randint(1, items_per_order)):
+            item_rows.append({
+                'id': first_item + len(item_rows),
+                'order_id': order_id,
+                'medicine_id': rng.choice(medicine_ids),
+                'quantity': rng.randint(10, 500),
+                'unit_price': round(rng.uniform(0.5, 50), 2),
+            })
+    counts['order'] = _insert(Order, order_rows)
+    counts['order_item'] = _insert(OrderItem, item_rows)
+
+    def transaction_rows():
+        for n in range(transactions):
+            incoming = rng.random() < 0.3
+            yield {
+                'batch_id': rng.choice(batch_ids),
+                'transaction_type': 'in' if incoming else 'out',
+                'quantity': rng.randint(10, 500) if incoming else rng.randint(1, 60),
+                'transaction_date': now - timedelta(seconds=rng.randint(0, 365 * 24 * 3600)),
+                'performed_by': rng.choice(user_ids),
+                'notes': 'Synthetic restock' if incoming else 'Dispensed to patient',
+            }
+    counts['stock_transaction'] = _insert(StockTransaction, transaction_rows()) if batches else 0
+
+    db.session.commit()
+    rebuild_stock_balances()
+    return counts, time.perf_counter() - started
@@ -0,0 +1,108 @@
+import threading
+import time
+from collections import OrderedDict
+from flask_login import UserMixin
+from sqlalchemy import select
+from models import db, User
+from data_versions import on_commit
+
+# Identity cache behind Flask-Login's user loader.
+#
+# Requests only read the id, username, role and email of current_user, so
+# instead of loading the User row on every authenticated request those
+# fields are kept in memory for USER_CACHE_TTL seconds and handed out as a
+# UserIdentity, which needs no database session. Any commit that writes the
+# user table (a role or password change, a new or deleted account) clears
+# the cache of the process that made it; other worker processes pick the
+# change up when their entries expire, so keep the TTL short. Unknown ids
+# are not cached.
+
+
+class UserIdentity(UserMixin):
+    """What a request knows about the logged in user, detached from the database"""
+
+    def __init__(self, id, username, role, email):
+        self.id = id
+        self.username = username
+        self.role = role
+        self.email = email
+
+    def __repr__(self):
+        return f'<UserIdentity {self.username}>'
+
+
+class UserCache:
+    def __init__(self, app=None):
+        self.app = None
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # Bumped by every invalidation, so a lookup that raced a commit does not store what it read
+        self.generation = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('USER_CACHE_TTL', 60)
+        app.config.setdefault('USER_CACHE_SIZE', 1000)
+        self.app = app
+        on_commit(self._changed)
+        app.extensions['user_cache'] = self
+
+    def _changed(self, tables):
+        if 'user' in tables:
+            self.clear()
+
+    def get(self, user_id):
+        """UserIdentity for user_id, from the cache when fresh, None for unknown users"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self.generation
+        row = db.session.execute(
+            select(User.id, User.username, User.role, User.email).where(User.id == user_id)
+        ).first()
+        if row is None:
+            return None
+        identity = UserIdentity(row.id, row.username, row.role, row.email)
+        with self.lock:
+            if generation != self.generation:
+                return identity
+            self.entries[user_id] = (now + self.app.config['USER_CACHE_TTL'], identity)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.app.config['USER_CACHE_SIZE']:
+                self.entries.popitem(last=False)
+        return identity
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+            self.generation += 1
+            self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'ttl': self.app.config['USER_CACHE_TTL'],
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+user_cache = UserCache()
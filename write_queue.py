@@ -0,0 +1,196 @@
+import functools
+import os
+import threading
+from flask import current_app, request
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+from models import db
+from data_versions import DEFERRED_CALLBACKS
+
+# Single-writer path for SQLite with group commit.
+#
+# With WRITE_MODE = 'queue', the POST requests of views marked @queued_write
+# take turns on one dedicated writer connection instead of each committing its
+# own transaction. The first request of a group opens a BEGIN IMMEDIATE
+# transaction and every request runs inside a SAVEPOINT of it, so its
+# db.session.commit() and rollback() behave as before but only release or
+# roll back the savepoint. A request that finishes while others are queued
+# hands the connection on; the last one of the group (or the
+# WRITE_GROUP_SIZE-th) commits the lot with a single COMMIT and fsync. Every
+# request waits for that commit before it responds, gets its own view's
+# result or exception, and gets the commit's error if the group fails.
+# Commit callbacks (cache invalidation, stock events) are held until the
+# group has committed.
+#
+# The view runs in the request's own thread, so current_user, flash() and g
+# keep working; only db.session is swapped for one bound to the writer
+# connection. Writes outside the queue (the scheduler, imports, CLI
+# commands, other worker processes) still take SQLite's lock directly and
+# wait up to SQLITE_BUSY_TIMEOUT ms for it. Every connection gets that
+# busy_timeout, and WAL journaling when SQLITE_WAL is set (the default in
+# queue mode) so that readers neither block nor are blocked by the writer.
+# Queue mode needs a database file: an in-memory database is not shared by
+# the writer connection.
+
+
+class WriteGroup:
+    """Requests sharing one transaction on the writer connection"""
+
+    def __init__(self):
+        self.size = 0
+        self.callbacks = []
+        self.error = None
+        self.done = threading.Event()
+
+
+def queued_write(view):
+    """Run a view's POST requests on the shared writer connection when WRITE_MODE is queue"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method == 'GET' or current_app.config['WRITE_MODE'] != 'queue':
+            return view(*args, **kwargs)
+        return write_queue.run(view, args, kwargs)
+    return wrapper
+
+
+class WriteQueue:
+    def __init__(self, app=None):
+        self.app = None
+        self.engine = None
+        self.connection = None
+        self.group = None
+        # Held by the request using the writer connection; waiting counts the requests queued for it
+        self.lock = threading.Lock()
+        self.counter = threading.Lock()
+        self.waiting = 0
+        self.groups = 0
+        self.writes = 0
+        self.failed_groups = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('WRITE_MODE', os.environ.get('WRITE_MODE', 'direct'))
+        app.config.setdefault('SQLITE_WAL', app.config['WRITE_MODE'] == 'queue')
+        app.config.setdefault('SQLITE_BUSY_TIMEOUT', 5000)
+        app.config.setdefault('WRITE_GROUP_SIZE', 32)
+        self.app = app
+        with app.app_context():
+            engine = db.engine
+        if engine.dialect.name == 'sqlite':
+            event.listen(engine, 'connect', self._configure)
+        app.extensions['write_queue'] = self
+
+    def _configure(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA busy_timeout = {int(self.app.config['SQLITE_BUSY_TIMEOUT'])}")
+        if self.app.config['SQLITE_WAL']:
+            cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.close()
+
+    def _writer_engine(self):
+        if self.engine is None:
+            with self.app.app_context():
+                url = db.engine.url
+            # One connection shared by the request threads in turn, transactions begun explicitly so
+            # that SAVEPOINTs nest inside them (the sqlite3 module would otherwise commit at the first)
+            self.engine = create_engine(url, poolclass=StaticPool, connect_args={'check_same_thread': False})
+            event.listen(self.engine, 'connect', self._configure)
+            event.listen(self.engine, 'connect', _manual_transactions)
+            event.listen(self.engine, 'begin', _begin_immediate)
+        return self.engine
+
+    def run(self, view, args, kwargs):
+        """Call view inside the current write group, returns its result once the group has committed"""
+        with self.counter:
+            self.waiting += 1
+        self.lock.acquire()
+        try:
+            with self.counter:
+                self.waiting -= 1
+            if self.group is None:
+                self.connection = self._writer_engine().connect()
+                self.connection.begin()
+                self.group = WriteGroup()
+            group = self.group
+            group.size += 1
+            result, error = self._call(group, view, args, kwargs)
+            with self.counter:
+                last = self.waiting == 0 or group.size >= self.app.config['WRITE_GROUP_SIZE']
+            if last:
+                self.group = None
+                self._commit(group)
+        except BaseException:
+            if self.group is None and self.connection is not None:
+                self.connection.close()
+                self.connection = None
+            raise
+        finally:
+            self.lock.release()
+        if not last:
+            group.done.wait()
+        if error is not None:
+            raise error
+        if group.error is not None:
+            raise group.error
+        return result
+
+    def _call(self, group, view, args, kwargs):
+        # Whatever the request's session read so far was on another connection; start afresh on the writer
+        db.session.remove()
+        db.session.registry.set(Session(bind=self.connection, join_transaction_mode='create_savepoint',
+                                        info={DEFERRED_CALLBACKS: group.callbacks}))
+        try:
+            return view(*args, **kwargs), None
+        except BaseException as e:
+            return None, e
+        finally:
+            try:
+                # Rolls back the savepoint of a view that did not commit
+                db.session.remove()
+            except Exception:
+                self.app.logger.exception('Could not close a queued write session')
+
+    def _commit(self, group):
+        try:
+            self.connection.commit()
+        except Exception as e:
+            group.error = e
+            self.failed_groups += 1
+            self.app.logger.exception('Group commit of %s writes failed', group.size)
+        finally:
+            self.connection.close()
+            self.connection = None
+        self.groups += 1
+        self.writes += group.size
+        if group.error is None:
+            for callback in group.callbacks:
+                try:
+                    callback()
+                except Exception:
+                    self.app.logger.exception('Commit callback failed')
+        group.done.set()
+
+    def stats(self):
+        with self.counter:
+            waiting = self.waiting
+        return {
+            'mode': self.app.config['WRITE_MODE'],
+            'groups': self.groups,
+            'writes': self.writes,
+            'failed_groups': self.failed_groups,
+            'waiting': waiting,
+            'average_group': round(self.writes / self.groups, 2) if self.groups else 0.0,
+        }
+
+
+def _manual_transactions(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
+
+
+def _begin_immediate(conn):
+    conn.exec_driver_sql('BEGIN IMMEDIATE')
+
+
+write_queue = WriteQueue()